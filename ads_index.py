@@ -0,0 +1,118 @@
+import json
+import re
+import time
+from collections import OrderedDict
+
+from rides_db import RidesDB
+
+# === Схема базы объявлений ===
+ADS_MIGRATIONS = [
+    '''
+        CREATE TABLE IF NOT EXISTS ads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            ad_type TEXT,
+            text TEXT,
+            contact TEXT,
+            message_id INTEGER,
+            photos TEXT,
+            created_at INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_ads_created_at ON ads (created_at);
+        CREATE VIRTUAL TABLE IF NOT EXISTS ads_fts USING fts5(
+            text, content='ads', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS ads_ai AFTER INSERT ON ads BEGIN
+            INSERT INTO ads_fts (rowid, text) VALUES (new.id, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS ads_ad AFTER DELETE ON ads BEGIN
+            INSERT INTO ads_fts (ads_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    ''',
+]
+
+
+class AdsDB(RidesDB):
+    migrations = ADS_MIGRATIONS
+
+
+_TOKEN = re.compile(r"\w+")
+
+
+def query_terms(query: str) -> tuple:
+    return tuple(_TOKEN.findall(query.lower().replace("ё", "е")))
+
+
+class AdsIndex:
+    """
+    Полнотекстовый поиск по опубликованным объявлениям (FTS5, ранжирование bm25)
+    с LRU-кэшем популярных запросов.
+    Кэш сбрасывается выборочно: при публикации нового объявления удаляются
+    только те запросы, все слова которых встречаются в его тексте.
+    """
+
+    def __init__(self, db: AdsDB, page_size: int = 20, max_age_days: int = 30, cache_size: int = 512):
+        self.db = db
+        self.page_size = page_size
+        self.max_age_days = max_age_days
+        self.cache_size = cache_size
+        self._cache = OrderedDict()    # (terms, offset) -> (rows, has_more)
+        self.hits = 0
+        self.misses = 0
+
+    async def add(self, user_id: int, ad_type: str, text: str, contact: str, message_id: int, photos: list):
+        ad_id = await self.db.execute(
+            "INSERT INTO ads (user_id, ad_type, text, contact, message_id, photos, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, ad_type, text, contact, message_id, json.dumps(photos), int(time.time()))
+        )
+        self._invalidate(text)
+        return ad_id
+
+    async def search(self, query: str, offset: int = 0):
+        """Возвращает (строки, есть_ещё) для страницы, начинающейся с offset."""
+        terms = query_terms(query)
+        if not terms:
+            return [], False
+        key = (terms, offset)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+        self.misses += 1
+
+        # Каждое слово — префиксный поиск, слова объединяются по И
+        match = " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+        rows = await self.db.fetchall('''
+            SELECT ads.id, ads.ad_type, ads.text, ads.contact, ads.message_id, ads.photos
+            FROM ads_fts
+            JOIN ads ON ads.id = ads_fts.rowid
+            WHERE ads_fts MATCH ? AND ads.created_at >= ?
+            ORDER BY ads_fts.rank, ads.id DESC
+            LIMIT ? OFFSET ?
+        ''', (match, int(time.time()) - self.max_age_days * 24 * 60 * 60, self.page_size + 1, offset))
+
+        result = (rows[:self.page_size], len(rows) > self.page_size)
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    async def remove(self, message_ids: list):
+        placeholders = ", ".join("?" * len(message_ids))
+        await self.db.execute(f"DELETE FROM ads WHERE message_id IN ({placeholders})", tuple(message_ids))
+        self._cache.clear()
+
+    async def prune(self):
+        await self.db.execute(
+            "DELETE FROM ads WHERE created_at < ?",
+            (int(time.time()) - self.max_age_days * 24 * 60 * 60,)
+        )
+        self._cache.clear()
+
+    def _invalidate(self, text: str):
+        words = set(query_terms(text))
+        for key in list(self._cache):
+            terms, _ = key
+            if all(any(word.startswith(term) for word in words) for term in terms):
+                del self._cache[key]
@@ -0,0 +1,346 @@
+"""
+Сквозной бенчмарк обоих ботов без настоящего токена: боты работают через
+локальную замену Bot API (bench/fake_api.py), виртуальные пользователи
+параллельно проходят полный сценарий подачи объявления.
+
+    python -m bench.e2e --users 50
+    python -m bench.e2e --bot poput --latency 0.05 --jitter 0.02
+    python -m bench.e2e --rate-429 0.05 --methods-429 sendMessage,sendMediaGroup
+    python -m bench.e2e --bot poput --shards 4 --users 200 --think 0.5
+
+Задержка ответа (end-to-end) — от постановки апдейта в getUpdates до первого
+видимого ответа бота в чат пользователя. Очереди публикации в канал на время
+прогона получают лимит --channel-rate постов в секунду вместо боевых 20 в минуту,
+иначе прогон упирается в него; 429 от канала проверяются через --rate-429.
+Антифлуд по той же причине получает лимиты с запасом: виртуальные пользователи
+нажимают кнопки без пауз (паузу между шагами задаёт --think).
+
+С --shards N бот запускается отдельным процессом в режиме BOT_MODE=sharded
+(ингресс + N воркеров), апдейты приходят на вебхук ингресса. Лимит канала
+передаётся через CHANNEL_RATE, а антифлуд остаётся боевым, поэтому для
+такого прогона нужен --think около 0.5 с.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+
+from bench.fake_api import BOT_USER, FakeBotAPI
+from throttling import Throttler
+
+DOSKA_TOKEN = "1001:doska"
+POPUT_TOKEN = "1002:poput"
+STEP_TIMEOUT = 15
+POST_TIMEOUT = 60
+USER_ID_BASE = 10_000_000
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_message_ids = itertools.count(1)
+
+
+# --- Конструкторы апдейтов ---
+
+def user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+
+def message(uid: int, text: str = None, photo: str = None, media_group_id: str = None) -> dict:
+    msg = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": user(uid),
+    }
+    if text is not None:
+        msg["text"] = text
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if photo is not None:
+        msg["photo"] = [{"file_id": photo, "file_unique_id": "u" + photo, "width": 800, "height": 600}]
+    if media_group_id is not None:
+        msg["media_group_id"] = media_group_id
+    return {"message": msg}
+
+
+def callback(uid: int, data: str) -> dict:
+    return {"callback_query": {
+        "id": str(next(_message_ids)),
+        "from": user(uid),
+        "chat_instance": str(uid),
+        "data": data,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": BOT_USER,
+            "text": "..."
+        }
+    }}
+
+
+# --- Сценарии: список шагов, шаг — апдейты, на которые ждём один ответ ---
+
+def doska_script(uid: int, album: bool) -> list:
+    steps = [
+        [message(uid, "/start")],
+        [callback(uid, "SELL")],
+        [message(uid, f"Продам велосипед Stels №{uid}, почти новый, самовывоз")],
+    ]
+    if album:
+        group = f"album{uid}"
+        steps.append([message(uid, photo=f"p{uid}_{i}", media_group_id=group) for i in range(3)])
+    else:
+        steps.append([message(uid, photo=f"p{uid}_0")])
+        steps.append([callback(uid, "SKIP_PHOTOS")])
+    steps.append([callback(uid, "CONTACT_SKIP")])
+    return steps
+
+
+def poput_script(uid: int) -> list:
+    tomorrow = (date.today() + timedelta(days=1)).isoformat()
+    return [
+        [message(uid, "/start")],
+        [callback(uid, "role_driver")],
+        [callback(uid, "route_asino_tomsk")],
+        [callback(uid, f"date_{tomorrow}")],
+        [callback(uid, "time_10:00_11:00")],
+        [callback(uid, "price_450")],
+        [callback(uid, "seats_3")],
+        [callback(uid, "skip_comment")],
+        [callback(uid, "contact_phone")],
+        [message(uid, "89001234567")],
+        [callback(uid, "publish_yes")],
+    ]
+
+
+# --- Прогон ---
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.updates = 0
+        self.failed_users = 0
+        self.duration = 0.0
+        self.ads = 0
+        self.api_calls = 0
+
+
+def bench_throttler() -> Throttler:
+    return Throttler(limits={}, default=(1000, 1000))
+
+
+async def run_user(api: FakeBotAPI, token: str, uid: int, steps: list, result: Result, think: float):
+    for updates in steps:
+        if think:
+            await asyncio.sleep(think)
+        reply = api.wait_reply(uid)
+        queued_at = None
+        for update in updates:
+            queued_at = queued_at or api.push(token, update)
+        result.updates += len(updates)
+        try:
+            replied_at = await asyncio.wait_for(reply, STEP_TIMEOUT)
+        except asyncio.TimeoutError:
+            result.failed_users += 1
+            return
+        result.latencies.append(replied_at - queued_at)
+
+
+async def run_flow(api: FakeBotAPI, token: str, name: str, scripts: list, channel_id, think: float) -> Result:
+    result = Result(name)
+    calls_before = api.api_calls()
+    posts_before = api.posts[str(channel_id)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(api, token, uid, steps, result, think) for uid, steps in scripts))
+    result.duration = time.perf_counter() - started
+
+    # Публикация в канал идёт в фоне — ждём, пока дойдут все объявления
+    expected = len(scripts) - result.failed_users
+    deadline = time.perf_counter() + POST_TIMEOUT
+    while api.posts[str(channel_id)] - posts_before < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)    # последние правки статуса после публикации
+    result.ads = api.posts[str(channel_id)] - posts_before
+    result.api_calls = api.api_calls() - calls_before
+    return result
+
+
+@asynccontextmanager
+async def running_doska(channel_rate: float, relax_throttling: bool = True):
+    """Запускает bot_doska в режиме polling против уже поднятого FakeBotAPI."""
+    os.environ["BOT_TOKEN"] = DOSKA_TOKEN
+    import bot_doska
+    from publish_queue import PublishQueue
+
+    bot_doska.publish_queue = PublishQueue(
+        rate=channel_rate, burst=channel_rate,
+        permanent_errors=bot_doska.publish_queue.permanent_errors
+    )
+    if relax_throttling:
+        bot_doska.throttler = bench_throttler()
+    deferred = await bot_doska.startup()
+    polling = asyncio.create_task(bot_doska.dp.start_polling(
+        bot_doska.bot, handle_signals=False, close_bot_session=False, polling_timeout=1
+    ))
+    try:
+        yield bot_doska
+    finally:
+        # Поллинг останавливает сам shutdown — после очереди публикации и чистки сессий
+        await bot_doska.shutdown(deferred, polling)
+
+
+@asynccontextmanager
+async def running_poput(channel_rate: float, relax_throttling: bool = True):
+    """Запускает bot_poput в режиме polling против уже поднятого FakeBotAPI."""
+    os.environ["BOT_TOKEN"] = POPUT_TOKEN
+    import bot_poput
+    from publish_queue import PublishQueue
+
+    bot_poput.PUBLISH_QUEUE = PublishQueue(
+        rate=channel_rate, burst=channel_rate,
+        permanent_errors=bot_poput.PUBLISH_QUEUE.permanent_errors
+    )
+    if relax_throttling:
+        bot_poput.THROTTLER = bench_throttler()
+    application = bot_poput.build_application()
+    await application.initialize()
+    await bot_poput.post_init(application)
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    try:
+        yield application
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await bot_poput.post_shutdown(application)
+
+
+@asynccontextmanager
+async def running_sharded(api: FakeBotAPI, name: str, token: str, shards: int, channel_rate: float):
+    """Запускает bot_<name> отдельным процессом в режиме BOT_MODE=sharded."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    socket_dir = os.path.join(os.getcwd(), f"sockets-{name}")
+    env = dict(
+        os.environ, BOT_TOKEN=token, BOT_MODE="sharded", SHARDS=str(shards), SHARD_SOCKET_DIR=socket_dir,
+        WEBHOOK_URL=f"http://127.0.0.1:{port}", WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(port),
+        WEBHOOK_SECRET="bench", CHANNEL_RATE=str(channel_rate)
+    )
+    proc = await asyncio.create_subprocess_exec(sys.executable, os.path.join(REPO_DIR, f"bot_{name}.py"), env=env)
+    try:
+        # Готов, когда ингресс выставил вебхук и все воркеры открыли сокеты
+        deadline = time.perf_counter() + 60
+        while not (api.webhook_set(token) and all(
+                os.path.exists(os.path.join(socket_dir, f"shard-{i}.sock")) for i in range(shards))):
+            if proc.returncode is not None or time.perf_counter() > deadline:
+                raise RuntimeError(f"bot_{name} не запустился")
+            await asyncio.sleep(0.1)
+        yield
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+        await proc.wait()
+
+
+async def bench_doska(api: FakeBotAPI, args) -> Result:
+    scripts = [(USER_ID_BASE + i, doska_script(USER_ID_BASE + i, args.album)) for i in range(args.users)]
+    if args.shards:
+        async with running_sharded(api, "doska", DOSKA_TOKEN, args.shards, args.channel_rate):
+            return await run_flow(api, DOSKA_TOKEN, f"bot_doska x{args.shards}", scripts, "ID", args.think)
+    async with running_doska(args.channel_rate) as bot_doska:
+        return await run_flow(api, DOSKA_TOKEN, "bot_doska", scripts, bot_doska.CHANNEL_ID, args.think)
+
+
+async def bench_poput(api: FakeBotAPI, args) -> Result:
+    base = USER_ID_BASE + 1_000_000
+    scripts = [(base + i, poput_script(base + i)) for i in range(args.users)]
+    if args.shards:
+        async with running_sharded(api, "poput", POPUT_TOKEN, args.shards, args.channel_rate):
+            return await run_flow(api, POPUT_TOKEN, f"bot_poput x{args.shards}", scripts, os.environ["GROUP_CHAT_ID"], args.think)
+    async with running_poput(args.channel_rate):
+        import bot_poput
+        return await run_flow(api, POPUT_TOKEN, "bot_poput", scripts, bot_poput.GROUP_CHAT_ID, args.think)
+
+
+async def start_environment(api: FakeBotAPI):
+    url = await api.start()
+    # Настройки ботов читаются при импорте, поэтому импорт — только после запуска сервера
+    os.environ.update({
+        "BOT_API_URL": url, "GROUP_CHAT_ID": "-1001",
+        "METRICS_PORT": "0", "BOT_MODE": "polling",
+    })
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+    print(f"Fake Bot API: {url}, база в {os.getcwd()}")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(result: Result, api: FakeBotAPI):
+    per_ad = result.api_calls / result.ads if result.ads else float("nan")
+    print(f"\n== {result.name} ==")
+    print(f"апдейтов:            {result.updates} за {result.duration:.2f} с ({result.updates / result.duration:.0f}/с)")
+    print(f"задержка p50 / p99:  {percentile(result.latencies, 0.5) * 1000:.1f} / "
+          f"{percentile(result.latencies, 0.99) * 1000:.1f} мс")
+    print(f"опубликовано:        {result.ads}, не дошли до конца: {result.failed_users}")
+    print(f"вызовов API:         {result.api_calls} ({per_ad:.1f} на объявление)")
+
+
+async def main(args):
+    api = FakeBotAPI(
+        latency=args.latency, jitter=args.jitter, rate_429=args.rate_429, retry_after=args.retry_after,
+        methods_429=set(args.methods_429.split(",")) if args.methods_429 else None
+    )
+    await start_environment(api)
+
+    results = []
+    try:
+        if args.bot in ("doska", "both"):
+            results.append(await bench_doska(api, args))
+        if args.bot in ("poput", "both"):
+            results.append(await bench_poput(api, args))
+    finally:
+        await api.stop()
+
+    for result in results:
+        report(result, api)
+    print("\nвызовы по методам:", ", ".join(f"{m}={n}" for m, n in api.calls.most_common()))
+    if api.throttled:
+        print("выданные 429:", ", ".join(f"{m}={n}" for m, n in api.throttled.most_common()))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", choices=("doska", "poput", "both"), default="both")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--album", action="store_true", help="doska: присылать 3 фото альбомом")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка каждого вызова API, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля вызовов, получающих 429")
+    parser.add_argument("--methods-429", default="", help="методы для 429 через запятую (по умолчанию все)")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя перед каждым шагом, с")
+    parser.add_argument("--channel-rate", type=float, default=100, help="постов в канал в секунду")
+    parser.add_argument("--shards", type=int, default=0, help="запустить бота отдельным процессом с N воркерами")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, os.getcwd())
+    asyncio.run(main(parse_args()))
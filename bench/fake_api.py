@@ -0,0 +1,222 @@
+"""
+Локальная замена Bot API для офлайн-бенчмарков: принимает запросы обоих
+ботов (aiogram и PTB), отвечает правдоподобными объектами, умеет добавлять
+задержку и случайные 429, а входящие апдейты отдаёт через getUpdates или,
+после setWebhook, как Telegram — POST-запросами на адрес вебхука.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+WEBHOOK_CONNECTIONS = 40    # как max_connections по умолчанию у Telegram
+
+# Методы, ответ на которые пользователь видит в своём чате
+REPLY_METHODS = {"sendMessage", "editMessageText", "sendMediaGroup", "sendPhoto"}
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_429: float = 0.0,
+                 retry_after: int = 1, methods_429: set = None, seed: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.methods_429 = methods_429
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.posts = Counter()    # chat_id -> отправленные сообщения/альбомы
+        self.last_reply = {}      # chat_id -> параметры последнего видимого ответа
+        self._updates = {}    # токен бота -> очередь апдейтов для его getUpdates
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._waiters = {}    # chat_id -> список future, ждущих ответа в этот чат
+        self._webhooks = {}   # токен бота -> (url, secret_token)
+        self._deliveries = {}    # токен бота -> задачи доставки на вебхук
+        self._client = None
+        self._runner = None
+        self.url = None
+
+    # --- Сервер ---
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        for task in [t for tasks in self._deliveries.values() for t in tasks]:
+            task.cancel()
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # --- Апдейты ---
+
+    def push(self, token: str, update: dict) -> float:
+        """Ставит апдейт в очередь getUpdates бота с токеном token. Возвращает момент постановки."""
+        update = dict(update, update_id=next(self._update_ids))
+        queued_at = time.perf_counter()
+        self._queue(token).put_nowait(update)
+        if token in self._webhooks and token not in self._deliveries:
+            self._deliveries[token] = [asyncio.create_task(self._deliver(token)) for _ in range(WEBHOOK_CONNECTIONS)]
+        return queued_at
+
+    def webhook_set(self, token: str) -> bool:
+        return token in self._webhooks
+
+    async def _deliver(self, token: str):
+        # Апдейт, на который вебхук не ответил 200, доставляется повторно
+        if self._client is None:
+            self._client = aiohttp.ClientSession()
+        queue = self._queue(token)
+        while True:
+            update = await queue.get()
+            url, secret = self._webhooks[token]
+            while True:
+                try:
+                    async with self._client.post(url, json=update, headers={
+                        "X-Telegram-Bot-Api-Secret-Token": secret
+                    }) as response:
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.1)
+
+    def _queue(self, token: str) -> asyncio.Queue:
+        queue = self._updates.get(token)
+        if queue is None:
+            queue = self._updates[token] = asyncio.Queue()
+        return queue
+
+    def wait_reply(self, chat_id) -> asyncio.Future:
+        """Future, который завершится при следующем видимом ответе бота в чат chat_id."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(str(chat_id), []).append(future)
+        return future
+
+    def reply_buttons(self, chat_id) -> list:
+        """callback_data кнопок последнего ответа бота в чат chat_id."""
+        markup = self.last_reply.get(str(chat_id), {}).get("reply_markup") or {}
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        return [button.get("callback_data") for row in markup.get("inline_keyboard", []) for button in row]
+
+    def api_calls(self) -> int:
+        return sum(n for method, n in self.calls.items() if method not in ("getUpdates", "getMe"))
+
+    # --- Обработка запросов ---
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str) and value[:1] in "[{":
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(request, self._queue(request.match_info["token"]), params))
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.random() * self.jitter)
+        if (self.rate_429 and (self.methods_429 is None or method in self.methods_429)
+                and self.random.random() < self.rate_429):
+            self.throttled[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+
+        result = self._result(request.match_info["token"], method, params)
+        chat_id = params.get("chat_id")
+        if method in ("sendMessage", "sendMediaGroup", "sendPhoto"):
+            self.posts[str(chat_id)] += 1
+        if method in REPLY_METHODS and chat_id is not None:
+            self.last_reply[str(chat_id)] = params
+            for future in self._waiters.pop(str(chat_id), ()):
+                if not future.done():
+                    future.set_result(time.perf_counter())
+        return self._ok(result)
+
+    async def _get_updates(self, request: web.Request, queue: asyncio.Queue, params) -> list:
+        timeout = float(params.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(queue.get(), timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        if request.transport is None or request.transport.is_closing():
+            # Бот, начавший этот long poll, уже остановлен — апдейт достанется следующему
+            queue.put_nowait(updates[0])
+            return []
+        while not queue.empty() and len(updates) < 100:
+            updates.append(queue.get_nowait())
+        return updates
+
+    def _message(self, chat_id, text=None) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+            "from": BOT_USER,
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def _result(self, token: str, method: str, params: dict):
+        chat_id = params.get("chat_id", 0)
+        if method == "setWebhook":
+            self._webhooks[token] = (params.get("url"), params.get("secret_token", ""))
+            return True
+        if method == "deleteWebhook":
+            self._webhooks.pop(token, None)
+            for task in self._deliveries.pop(token, ()):
+                task.cancel()
+            return True
+        if method == "getMe":
+            return dict(BOT_USER, id=int(token.split(":")[0]))
+        if method in ("sendMessage", "sendPhoto"):
+            return self._message(chat_id, params.get("text", ""))
+        if method == "sendMediaGroup":
+            return [self._message(chat_id) for _ in params.get("media", [None])]
+        if method == "editMessageText":
+            message = self._message(chat_id, params.get("text", ""))
+            message["message_id"] = int(params.get("message_id") or message["message_id"])
+            return message
+        return True
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
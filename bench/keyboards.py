@@ -0,0 +1,74 @@
+"""
+Микробенчмарк клавиатур bot_poput: сборка + сериализация на один апдейт
+до и после кэширования.
+
+    python -m bench.keyboards
+"""
+import timeit
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import bot_poput
+
+N = 20000
+
+
+# --- Как было: клавиатура собирается заново на каждый апдейт ---
+
+def legacy_time_slots(selected_date):
+    now = datetime.now(bot_poput.TZ)
+    is_today = (selected_date == now.date())
+    slots = []
+    for h in range(6, 24):
+        slot_start = f"{h:02d}:00"
+        slot_end = f"{(h + 1) % 24:02d}:00"
+        if is_today:
+            slot_time = datetime.strptime(slot_start, "%H:%M").time()
+            if now.time() >= slot_time:
+                continue
+        slots.append(InlineKeyboardButton(f"{slot_start} - {slot_end}", callback_data=f"time_{slot_start}_{slot_end}"))
+    rows = [slots[i:i+2] for i in range(0, len(slots), 2)]
+    rows.append([InlineKeyboardButton("✏️ Указать время вручную", callback_data="time_manual")])
+    return InlineKeyboardMarkup(rows)
+
+
+def legacy_date_slots():
+    today = datetime.now(bot_poput.TZ).date()
+    buttons = [InlineKeyboardButton((today + timedelta(days=i)).strftime("%d.%m"), callback_data=f"date_{(today + timedelta(days=i)).isoformat()}") for i in range(7)]
+    return InlineKeyboardMarkup([buttons[:4], buttons[4:]])
+
+
+def legacy_seats():
+    return InlineKeyboardMarkup([[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, 6)]])
+
+
+def legacy_preview():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Опубликовать", callback_data="publish_yes")],
+        [InlineKeyboardButton("✏️ Изменить", callback_data="publish_edit"),
+         InlineKeyboardButton("❌ Отменить", callback_data="publish_cancel")]
+    ])
+
+
+def report(name, legacy, cached):
+    # to_dict() — то, что PTB делает с reply_markup при каждом запросе
+    before = timeit.timeit(lambda: legacy().to_dict(), number=N) / N * 1e6
+    after = timeit.timeit(lambda: cached().to_dict(), number=N) / N * 1e6
+    print(f"{name:<14} {before:8.1f} мкс -> {after:6.2f} мкс  (x{before / after:.0f})")
+
+
+def main():
+    # Завтрашняя дата, чтобы оба варианта строили полный набор слотов
+    tomorrow = datetime.now(bot_poput.TZ).date() + timedelta(days=1)
+    print(f"Сборка + to_dict() на апдейт, {N} повторов")
+    report("get_time_slots", lambda: legacy_time_slots(tomorrow), lambda: bot_poput.get_time_slots(tomorrow))
+    today = datetime.now(bot_poput.TZ).date()
+    report("time (сегодня)", lambda: legacy_time_slots(today), lambda: bot_poput.get_time_slots(today))
+    report("get_date_slots", legacy_date_slots, bot_poput.get_date_slots)
+    report("seats", legacy_seats, lambda: bot_poput.DRIVER_SEATS_KEYBOARD)
+    report("preview", legacy_preview, lambda: bot_poput.PREVIEW_KEYBOARD)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Генератор нагрузки: популяция виртуальных пользователей, которые с паузами
+на раздумье проходят разговоры обоих ботов по всем веткам (ручной маршрут,
+ручное время и цена, ввод телефона, фото по одному и альбомом) и бросают
+их на полпути с заданной вероятностью. Число одновременных пользователей
+растёт ступенями; на каждой ступени ушедших сразу заменяют новые.
+
+    python -m bench.load --stages 100,500,1000 --stage-duration 30
+    python -m bench.load --bot poput --stages 5000 --think 3 --abandon 0.05
+
+По каждой ступени: апдейты в секунду, перцентили задержки ответа, сколько
+разговоров завершено / брошено / зависло, RSS процесса и задержка event loop.
+Боты, генератор и замена Bot API работают в одном процессе, поэтому RSS и
+задержка loop относятся ко всем трём. Антифлуд остаётся боевым.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import resource
+import sys
+import time
+from datetime import date, timedelta
+
+from bench.e2e import DOSKA_TOKEN, POPUT_TOKEN, callback, message, percentile, running_doska, running_poput, start_environment
+from bench.fake_api import FakeBotAPI
+
+STEP_TIMEOUT = 30
+LAG_INTERVAL = 0.05
+
+AD_ITEMS = ["Продам велосипед", "Куплю диван", "Отдам котят", "Продам коляску", "Ищу репетитора",
+            "Продам картофель", "Меняю телефон", "Сдам гараж", "Продам шины R15", "Куплю дрова"]
+PLACES_TYPED = ["Асино", "Томск", "г. Северск", "Новокусково", "Батурино", "Первомайка",
+                "Тамск", "Новосиб", "Причулымский", "с. Ягодное"]
+
+
+class Abandoned(Exception):
+    pass
+
+
+class Stage:
+    def __init__(self, users: int):
+        self.users = users
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.updates = 0
+        self.latencies = []
+        self.completed = 0
+        self.abandoned = 0
+        self.timeouts = 0
+        self.lag = []
+        self.rss = 0.0
+
+
+class VirtualUser:
+    def __init__(self, run, uid: int, token: str):
+        self.run = run
+        self.uid = uid
+        self.token = token
+        self.rng = random.Random(uid)
+
+    async def step(self, *updates):
+        run = self.run
+        await asyncio.sleep(self.rng.expovariate(1 / run.think) if run.think else 0)
+        if self.rng.random() < run.abandon:
+            run.stage.abandoned += 1
+            raise Abandoned
+        reply = run.api.wait_reply(self.uid)
+        queued_at = None
+        for update in updates:
+            queued_at = queued_at or run.api.push(self.token, update)
+        try:
+            replied_at = await asyncio.wait_for(reply, STEP_TIMEOUT)
+        except asyncio.TimeoutError:
+            run.stage.timeouts += 1
+            raise Abandoned
+        run.stage.updates += len(updates)
+        run.stage.latencies.append(replied_at - queued_at)
+
+    def pick(self, prefix: str, default: str = None) -> str:
+        """Случайная кнопка с данным префиксом из последнего ответа бота."""
+        options = [data for data in self.run.api.reply_buttons(self.uid) if data and data.startswith(prefix)]
+        return self.rng.choice(options) if options else default
+
+    # --- bot_doska ---
+
+    async def doska(self):
+        uid, rng = self.uid, self.rng
+        await self.step(message(uid, "/start"))
+        await self.step(callback(uid, rng.choice(["SELL", "BUY", "EXCHANGE", "SERVICE", "MISC"])))
+        if rng.random() < 0.1:
+            await self.step(callback(uid, "SKIP_TEXT"))
+        else:
+            await self.step(message(uid, f"{rng.choice(AD_ITEMS)}, недорого, объявление {uid}"))
+
+        photos = rng.choice([0, 1, 2, 3])
+        if photos > 1 and rng.random() < 0.5:
+            group = f"album{uid}"
+            await self.step(*(message(uid, photo=f"p{uid}_{i}", media_group_id=group) for i in range(photos)))
+        else:
+            for i in range(photos):
+                await self.step(message(uid, photo=f"p{uid}_{i}"))
+        if photos < 3:
+            await self.step(callback(uid, "SKIP_PHOTOS"))
+
+        contact = rng.choice(["CONTACT_PRIVATE", "CONTACT_PHONE", "CONTACT_SKIP"])
+        await self.step(callback(uid, contact))
+        if contact == "CONTACT_PHONE":
+            await self.step(message(uid, f"89{rng.randrange(10 ** 9):09d}"))
+
+    # --- bot_poput ---
+
+    async def poput(self):
+        uid, rng = self.uid, self.rng
+        await self.step(message(uid, "/start"))
+        role = rng.choice(["driver", "passenger"])
+        await self.step(callback(uid, f"role_{role}"))
+
+        route = rng.choices(["route_asino_tomsk", "route_tomsk_asino", "route_manual"], weights=[4, 4, 2])[0]
+        await self.step(callback(uid, route))
+        if route == "route_manual":
+            for prefix in ("loc_from_", "loc_to_"):
+                await self.step(message(uid, rng.choice(PLACES_TYPED)))
+                choice = self.pick(prefix)
+                if choice is not None:
+                    # Предложены варианты из справочника
+                    await self.step(callback(uid, choice))
+
+        tomorrow = (date.today() + timedelta(days=1)).isoformat()
+        await self.step(callback(uid, self.pick("date_", f"date_{tomorrow}")))
+
+        slot = self.pick("time_", "time_manual")
+        if rng.random() < 0.2:
+            slot = "time_manual"
+        await self.step(callback(uid, slot))
+        if slot == "time_manual":
+            await self.step(message(uid, rng.choice(["15:30", "около 16 часов", "вечером, после работы"])))
+
+        if role == "driver":
+            price = rng.choice(["price_480", "price_450", "price_420", "price_text_По цене билета", "price_manual"])
+            await self.step(callback(uid, price))
+            if price == "price_manual":
+                await self.step(message(uid, str(rng.randrange(300, 800, 10))))
+        await self.step(callback(uid, self.pick("seats_", "seats_1")))
+
+        if rng.random() < 0.5:
+            await self.step(message(uid, "Могу забрать с адреса"))
+        else:
+            await self.step(callback(uid, "skip_comment"))
+
+        if rng.random() < 0.5:
+            await self.step(callback(uid, "contact_phone"))
+            await self.step(message(uid, f"89{rng.randrange(10 ** 9):09d}"))
+        else:
+            await self.step(callback(uid, "contact_pm"))
+
+        await self.step(callback(uid, "publish_yes" if rng.random() < 0.9 else "publish_cancel"))
+
+
+class LoadRun:
+    def __init__(self, api: FakeBotAPI, bots: list, think: float, abandon: float):
+        self.api = api
+        self.bots = bots
+        self.think = think
+        self.abandon = abandon
+        self.stage = None
+        self.target = 0
+        self.stopping = False
+        self._uids = itertools.count(20_000_000)
+        self._bot_cycle = itertools.cycle(bots)
+        self._active = set()
+
+    def spawn(self):
+        while not self.stopping and len(self._active) < self.target:
+            bot = next(self._bot_cycle)
+            user = VirtualUser(self, next(self._uids), DOSKA_TOKEN if bot == "doska" else POPUT_TOKEN)
+            task = asyncio.create_task(self._live(user, bot))
+            self._active.add(task)
+            task.add_done_callback(self._finished)
+
+    async def _live(self, user: VirtualUser, bot: str):
+        try:
+            await getattr(user, bot)()
+            self.stage.completed += 1
+        except Abandoned:
+            pass
+
+    def _finished(self, task):
+        self._active.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Ошибка виртуального пользователя", exc_info=task.exception())
+        self.spawn()
+
+    async def run_stage(self, users: int, duration: float) -> Stage:
+        self.stage = Stage(users)
+        self.target = users
+        self.spawn()
+        monitor = asyncio.create_task(monitor_lag(self.stage.lag))
+        await asyncio.sleep(duration)
+        monitor.cancel()
+        self.stage.duration = time.perf_counter() - self.stage.started
+        self.stage.rss = rss_mb()
+        return self.stage
+
+    async def stop(self):
+        self.stopping = True
+        for task in list(self._active):
+            task.cancel()
+        await asyncio.gather(*self._active, return_exceptions=True)
+
+
+async def monitor_lag(samples: list):
+    # Насколько позже положенного просыпается sleep — это и есть задержка loop
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(loop.time() - started - LAG_INTERVAL)
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Без /proc — только пиковое значение (на Linux в КБ)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(stages: list, baseline_rss: float):
+    print(f"\n{'польз.':>7} {'апд/с':>7} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} "
+          f"{'готово':>7} {'брошено':>8} {'зависло':>8} {'RSS МБ':>8} {'+RSS':>7} {'lag p99':>8} {'lag max':>8}")
+    for s in stages:
+        print(f"{s.users:>7} {s.updates / s.duration:>7.0f} "
+              f"{percentile(s.latencies, 0.5) * 1000:>8.1f} {percentile(s.latencies, 0.95) * 1000:>8.1f} "
+              f"{percentile(s.latencies, 0.99) * 1000:>8.1f} {s.completed:>7} {s.abandoned:>8} {s.timeouts:>8} "
+              f"{s.rss:>8.1f} {s.rss - baseline_rss:>+7.1f} "
+              f"{percentile(s.lag, 0.99) * 1000:>8.1f} {max(s.lag, default=0) * 1000:>8.1f}")
+
+
+async def main(args):
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter)
+    await start_environment(api)
+    bots = ["doska", "poput"] if args.bot == "both" else [args.bot]
+    stages = [int(n) for n in args.stages.split(",")]
+
+    try:
+        async with running_doska(args.channel_rate, relax_throttling=False) if "doska" in bots else _nothing():
+            async with running_poput(args.channel_rate, relax_throttling=False) if "poput" in bots else _nothing():
+                baseline_rss = rss_mb()
+                run = LoadRun(api, bots, args.think, args.abandon)
+                results = []
+                for users in stages:
+                    stage = await run.run_stage(users, args.stage_duration)
+                    print(f"ступень {users}: {stage.updates} апдейтов, RSS {stage.rss:.1f} МБ")
+                    results.append(stage)
+                await run.stop()
+    finally:
+        await api.stop()
+    report(results, baseline_rss)
+
+
+class _nothing:
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", choices=("doska", "poput", "both"), default="both")
+    parser.add_argument("--stages", default="50,200,500", help="число одновременных пользователей по ступеням")
+    parser.add_argument("--stage-duration", type=float, default=20, help="длительность ступени, с")
+    parser.add_argument("--think", type=float, default=2.0, help="средняя пауза перед шагом, с (экспоненциальная)")
+    parser.add_argument("--abandon", type=float, default=0.03, help="вероятность бросить разговор на каждом шаге")
+    parser.add_argument("--latency", type=float, default=0.03, help="задержка каждого вызова API, с")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--channel-rate", type=float, default=100, help="постов в канал в секунду")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, os.getcwd())
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,121 @@
+"""
+Холодный старт ботов: время импорта модуля и время до первого ответа.
+
+    python -m bench.startup
+    python -m bench.startup --bot poput --runs 5 --latency 0.05
+    python -m bench.startup --import-budget poput=0.5 --first-update-budget poput=1.5
+
+Импорт меряется в отдельном интерпретаторе (python -c "import bot_poput").
+Время до первого ответа — от запуска процесса бота (python bot_poput.py,
+режим polling, пустая база) до его ответа на /start, поставленный в
+getUpdates заранее: сюда входят запуск интерпретатора, импорт, миграции
+и все вызовы Bot API до первого getUpdates. Берётся медиана по --runs
+запускам; при превышении бюджета — код выхода 1.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from bench.e2e import DOSKA_TOKEN, POPUT_TOKEN, REPO_DIR, message
+from bench.fake_api import FakeBotAPI
+
+# Бюджеты по умолчанию, секунды: (импорт, до первого ответа)
+BUDGETS = {
+    "doska": (5.5, 6.0),
+    "poput": (0.4, 1.0),
+}
+TOKENS = {"doska": DOSKA_TOKEN, "poput": POPUT_TOKEN}
+FIRST_UPDATE_TIMEOUT = 60
+USER_ID = 30_000_000
+
+
+def bot_env(api: FakeBotAPI, name: str) -> dict:
+    return dict(
+        os.environ, BOT_TOKEN=TOKENS[name], BOT_API_URL=api.url, BOT_MODE="polling",
+        GROUP_CHAT_ID="-1001", METRICS_PORT="0", PYTHONPATH=REPO_DIR
+    )
+
+
+async def measure_import(api: FakeBotAPI, name: str) -> float:
+    code = f"import time; t = time.perf_counter(); import bot_{name}; print(time.perf_counter() - t)"
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", code, env=bot_env(api, name),
+        cwd=tempfile.mkdtemp(prefix="startup-"), stdout=asyncio.subprocess.PIPE
+    )
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"bot_{name} не импортируется")
+    return float(out.decode().strip().splitlines()[-1])
+
+
+async def measure_first_update(api: FakeBotAPI, name: str) -> float:
+    reply = api.wait_reply(USER_ID)
+    api.push(TOKENS[name], message(USER_ID, "/start"))
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(REPO_DIR, f"bot_{name}.py"), env=bot_env(api, name),
+        cwd=tempfile.mkdtemp(prefix="startup-"), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        replied_at = await asyncio.wait_for(reply, FIRST_UPDATE_TIMEOUT)
+    finally:
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), 15)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+    return replied_at - started
+
+
+def parse_budgets(values: list, index: int) -> dict:
+    budgets = {name: limits[index] for name, limits in BUDGETS.items()}
+    for value in values or ():
+        name, _, seconds = value.partition("=")
+        budgets[name] = float(seconds)
+    return budgets
+
+
+async def main(args) -> bool:
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+    import_budgets = parse_budgets(args.import_budget, 0)
+    first_update_budgets = parse_budgets(args.first_update_budget, 1)
+    bots = ["doska", "poput"] if args.bot == "both" else [args.bot]
+
+    ok = True
+    try:
+        for name in bots:
+            imports = [await measure_import(api, name) for _ in range(args.runs)]
+            firsts = [await measure_first_update(api, name) for _ in range(args.runs)]
+            for label, values, budget in (("импорт", imports, import_budgets[name]),
+                                          ("до первого ответа", firsts, first_update_budgets[name])):
+                median = statistics.median(values)
+                passed = median <= budget
+                ok = ok and passed
+                print(f"bot_{name} {label:<18} медиана {median * 1000:7.0f} мс, макс. {max(values) * 1000:7.0f} мс, "
+                      f"бюджет {budget * 1000:.0f} мс — {'OK' if passed else 'ПРЕВЫШЕН'}")
+    finally:
+        await api.stop()
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", choices=("doska", "poput", "both"), default="both")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка каждого вызова API, с")
+    parser.add_argument("--import-budget", action="append", metavar="БОТ=С", help="бюджет импорта, например poput=0.5")
+    parser.add_argument("--first-update-budget", action="append", metavar="БОТ=С", help="бюджет до первого ответа")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, os.getcwd())
+    sys.exit(0 if asyncio.run(main(parse_args())) else 1)
@@ -1,12 +1,33 @@
 import asyncio
+import copy
+import html
+import json
+import os
 import re
-from aiogram import Bot, Dispatcher, types
+import signal
+import time
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
+from ads_index import AdsDB, AdsIndex
+from dedup import DuplicateIndex, Fingerprint
+from fsm_storage import SQLiteStorage
+from metrics import API_ERRORS, API_LATENCY, API_RETRY_AFTER, HANDLER_ERRORS, HANDLER_LATENCY, REGISTRY, UPDATES, make_metrics_app
+from profiling import Profiler, parse_admin_ids
+from publish_queue import PublishQueue
+from sessions import SessionStore
+from sharding import SHARD_ENV, run_ingress, serve_shard, shard_socket, wait_for_stop
+from throttling import Throttler
+from webhook import UpdateQueue, make_webhook_app, start_server
+
 # === Состояния ===
 class AdStates(StatesGroup):
     waiting_for_text = State()
@@ -15,7 +36,18 @@ class AdStates(StatesGroup):
     waiting_for_phone = State()
 
 # === Хранилище ===
-user_data = {}
+SESSION_TTL = 2 * 60 * 60      # черновик без активности дольше 2 часов считается брошенным
+SESSION_MAX = 10000
+
+
+async def evict_session(user_id: int, data: dict):
+    # Вместе с черновиком сбрасываем и шаг FSM, иначе пользователь останется в состоянии без данных
+    key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+    await storage.set_state(key, None)
+    await storage.set_data(key, {})
+
+
+user_data = SessionStore(ttl=SESSION_TTL, max_size=SESSION_MAX, on_evict=evict_session)
 
 # === Типы объявлений ===
 ad_type_map = {
@@ -26,16 +58,232 @@ ad_type_map = {
     "MISC": ("🟣 Разное", "📦")
 }
 
+# === Клавиатуры ===
+# Собираются один раз при импорте и переиспользуются всеми обработчиками
+START_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔴 Продать", callback_data="SELL"), InlineKeyboardButton(text="🟢 Куплю", callback_data="BUY")],
+    [InlineKeyboardButton(text="🔵 Обменяю", callback_data="EXCHANGE"), InlineKeyboardButton(text="🟡 Услуги", callback_data="SERVICE")],
+    [InlineKeyboardButton(text="🟣 Разное", callback_data="MISC")]
+])
+
+SKIP_TEXT_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⏭️ Пропустить", callback_data="SKIP_TEXT")]
+])
+
+SKIP_PHOTOS_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⏭️ Пропустить / продолжить", callback_data="SKIP_PHOTOS")]
+])
+
+CONTACT_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📩 В личку", callback_data="CONTACT_PRIVATE"), InlineKeyboardButton(text="📞 По телефону", callback_data="CONTACT_PHONE")],
+    [InlineKeyboardButton(text="⏭️ Пропустить", callback_data="CONTACT_SKIP")]
+])
+
+RESTART_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Подать объявление снова", callback_data="RESTART_AD")]
+])
+
 # === Настройки ===
-BOT_TOKEN = "TOKEN"
+BOT_TOKEN = os.getenv("BOT_TOKEN", "TOKEN")
+BOT_API_URL = os.getenv("BOT_API_URL", "")          # свой сервер Bot API, например http://127.0.0.1:8090
 CHANNEL_ID = "ID"
+CHANNEL_USERNAME = "asinoobyav"
 BOT_USERNAME = "@_bot"
-
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+INLINE_CACHE_TIME = 30
+ALBUM_DEBOUNCE = 0.6              # сколько ждём остальные сообщения альбома, сек
+MAX_PHOTOS = 3
+DUPLICATE_WINDOW = 24 * 60 * 60   # сколько помним опубликованные объявления
+BUMP_AFTER = 12 * 60 * 60         # через сколько повтор можно "поднять"
+
+# Режим приёма апдейтов: "polling" (по умолчанию), "webhook" или "sharded" —
+# вебхук принимает ингресс и раскладывает апдейты по SHARDS процессам-воркерам
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # внешний адрес, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/doska")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")    # обязателен в режимах webhook и sharded
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+WEBHOOK_QUEUE_SIZE = 1000
+SHARDS = int(os.getenv("SHARDS", "1")) if BOT_MODE == "sharded" else 1
+SHARD_INDEX = int(os.environ[SHARD_ENV]) if SHARD_ENV in os.environ else None
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp/obyav-doska")
+
+# Лимит публикаций в канал; воркеры делят его поровну
+CHANNEL_RATE = float(os.getenv("CHANNEL_RATE", str(20 / 60)))
+CHANNEL_BURST = 3
+
+# Метрики Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0 — отключены)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+# В режиме sharded: воркер i — на METRICS_PORT_BASE + i (у ботов диапазоны не пересекаются)
+METRICS_PORT_BASE = int(os.getenv("METRICS_PORT_BASE", "9110"))
+
+# Через сколько секунд после запуска поднимать то, что не нужно первому апдейту
+STARTUP_DEFER = 2
+
+# Кому доступна команда /profile (id через запятую)
+ADMIN_IDS = parse_admin_ids(os.getenv("ADMIN_IDS", ""))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles/doska")
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+)
+storage = SQLiteStorage('doska_fsm.db')
 dp = Dispatcher(storage=storage)
+publish_queue = PublishQueue(
+    rate=CHANNEL_RATE / SHARDS, burst=max(1, CHANNEL_BURST // SHARDS),
+    permanent_errors=(TelegramBadRequest, TelegramForbiddenError)
+)
+ads_db = AdsDB('doska_ads.db')
+# Объявления добавляют все воркеры, а кэш поиска сбрасывается только в своём процессе
+ads_index = AdsIndex(ads_db, cache_size=512 if SHARDS == 1 else 0)
+duplicates = DuplicateIndex(window=DUPLICATE_WINDOW)
 
 notified_users = set()
+throttler = Throttler()
+
+FLOOD_WARNING = "⏳ Слишком часто. Подождите пару секунд и повторите."
+
+
+# === Антифлуд ===
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает апдейты сверх лимита пользователя до того, как они дойдут до обработчиков."""
+
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get("event_from_user")
+        kind = event.event_type
+        if user is None or kind not in ("message", "callback_query", "inline_query"):
+            return await handler(event, data)
+
+        allowed, warn = throttler.check(user.id, kind)
+        if allowed:
+            return await handler(event, data)
+        if warn:
+            try:
+                if event.message:
+                    await event.message.answer(FLOOD_WARNING)
+                elif event.callback_query:
+                    await event.callback_query.answer(FLOOD_WARNING)
+            except TelegramBadRequest:
+                pass
+        return None
+
+
+dp.update.outer_middleware(ThrottlingMiddleware())
+
+
+# === Метрики ===
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        UPDATES.inc(name)
+        with HANDLER_LATENCY.time(name):
+            try:
+                return await handler(event, data)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        with API_LATENCY.time(name):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter:
+                API_RETRY_AFTER.inc(name)
+                API_ERRORS.inc(name)
+                raise
+            except Exception:
+                API_ERRORS.inc(name)
+                raise
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        if not profiler.enabled:
+            return await handler(event, data)
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        return await profiler.run(name, data.get("raw_state"), lambda: handler(event, data))
+
+
+profiler = Profiler(PROFILE_DIR)
+
+for observer in (dp.message, dp.callback_query, dp.inline_query, dp.my_chat_member):
+    observer.middleware(HandlerMetricsMiddleware())
+    observer.middleware(ProfilingMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+
+REGISTRY.gauge("bot_sessions_live", "Черновики объявлений в памяти", fn=lambda: user_data.stats()["live"])
+REGISTRY.gauge("doska_notified_users", "Пользователи, получившие уведомление о добавлении в канал", fn=lambda: len(notified_users))
+REGISTRY.gauge("doska_publish_pending", "Объявления в очереди на публикацию", fn=lambda: publish_queue.pending())
+
+
+# === Сохранение черновика вместе с состоянием FSM ===
+class DraftMiddleware(BaseMiddleware):
+    """
+    Подгружает черновик из хранилища FSM перед обработчиком и сохраняет после —
+    только если обработчик его изменил (большинство апдейтов черновик не трогают).
+    """
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        user = data.get("event_from_user")
+        if state is None or user is None:
+            return await handler(event, data)
+
+        if user.id not in user_data:
+            draft = (await state.get_data()).get("draft")
+            if draft is not None:
+                user_data[user.id] = draft
+        # Копия, а не ссылка: обработчики меняют черновик на месте (список фото и т.п.)
+        before = copy.deepcopy(user_data.get(user.id))
+        try:
+            return await handler(event, data)
+        finally:
+            draft = user_data.get(user.id)
+            if draft != before:
+                await state.set_data({"draft": draft} if draft is not None else {})
+
+
+# === Сборка альбомов ===
+class AlbumMiddleware(BaseMiddleware):
+    """
+    Альбом приходит отдельными сообщениями с общим media_group_id.
+    Первое сообщение ждёт ALBUM_DEBOUNCE секунд и уходит в обработчик
+    со всем альбомом в data["album"], остальные дальше не передаются.
+    """
+
+    def __init__(self, debounce: float = ALBUM_DEBOUNCE):
+        self.debounce = debounce
+        self._albums = {}    # (chat_id, media_group_id) -> [сообщения]
+
+    async def __call__(self, handler, event: types.Message, data):
+        if event.media_group_id is None:
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return None
+
+        album = self._albums[key] = [event]
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            del self._albums[key]
+        data["album"] = sorted(album, key=lambda m: m.message_id)
+        return await handler(event, data)
+
+
+dp.message.outer_middleware(AlbumMiddleware())
+dp.message.middleware(DraftMiddleware())
+dp.callback_query.middleware(DraftMiddleware())
 
 # === Вспомогательные функции ===
 def format_phone(phone_str: str) -> str:
@@ -50,6 +298,14 @@ def format_phone(phone_str: str) -> str:
         return digits
 
 
+def contact_html(contact: str) -> str:
+    # Контакт хранится вместе с разметкой бота: экранируем только то, что внутри неё
+    match = re.fullmatch(r"<tg-spoiler>(.*)</tg-spoiler>", contact, re.S)
+    if match is None:
+        return html.escape(contact)
+    return f"<tg-spoiler>{html.escape(match.group(1))}</tg-spoiler>"
+
+
 # === Команда /info ===
 @dp.message(Command("info"))
 async def cmd_info(message: types.Message):
@@ -65,6 +321,13 @@ async def cmd_info(message: types.Message):
     await message.answer(info_text)
 
 
+# === Команда /profile ===
+@dp.message(Command("profile"), lambda m: m.from_user.id in ADMIN_IDS)
+async def cmd_profile(message: types.Message):
+    # /profile on [доля] [порог_мс] | off | stats
+    await message.answer(profiler.command(message.text.split()[1:]))
+
+
 # === Команда /start ===
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
@@ -74,12 +337,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
         "Выберите тип объявления:"
     )
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔴 Продать", callback_data="SELL"), InlineKeyboardButton(text="🟢 Куплю", callback_data="BUY")],
-        [InlineKeyboardButton(text="🔵 Обменяю", callback_data="EXCHANGE"), InlineKeyboardButton(text="🟡 Услуги", callback_data="SERVICE")],
-        [InlineKeyboardButton(text="🟣 Разное", callback_data="MISC")]
-    ])
-    await message.answer(start_msg, reply_markup=keyboard)
+    await message.answer(start_msg, reply_markup=START_KEYBOARD)
 
 
 # === Подписка на канал ===
@@ -108,11 +366,7 @@ async def handle_ad_type(callback_query: types.CallbackQuery, state: FSMContext)
     user_id = callback_query.from_user.id
     user_data[user_id] = {"ad_type": ad_type}
     await state.set_state(AdStates.waiting_for_text)
-
-    skip_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏭️ Пропустить", callback_data="SKIP_TEXT")]
-    ])
-    await callback_query.message.edit_text("📝 Введите текст объявления:", reply_markup=skip_kb)
+    await callback_query.message.edit_text("📝 Введите текст объявления:", reply_markup=SKIP_TEXT_KEYBOARD)
 
 
 # === Пропустить текст ===
@@ -126,10 +380,7 @@ async def skip_ad_text(callback_query: types.CallbackQuery, state: FSMContext):
         await callback_query.message.delete()
     except:
         pass
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏭️ Пропустить / продолжить", callback_data="SKIP_PHOTOS")]
-    ])
-    await callback_query.message.answer("🖼️ Пришлите до 3 фото:", reply_markup=kb)
+    await callback_query.message.answer("🖼️ Пришлите до 3 фото:", reply_markup=SKIP_PHOTOS_KEYBOARD)
 
 
 # === Ввод текста ===
@@ -139,40 +390,42 @@ async def handle_ad_text(message: types.Message, state: FSMContext):
     user_data[user_id] = user_data.get(user_id, {})
     user_data[user_id]["text"] = message.text
     await state.set_state(AdStates.waiting_for_photos)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏭️ Пропустить / продолжить", callback_data="SKIP_PHOTOS")]
-    ])
-    await message.answer("🖼️ Пришлите до 3 фото:", reply_markup=kb)
+    await message.answer("🖼️ Пришлите до 3 фото:", reply_markup=SKIP_PHOTOS_KEYBOARD)
 
 
-# === Обработка фото: новое сообщение под каждым фото ===
+# === Обработка фото: одно сообщение на фото или на весь альбом ===
 @dp.message(AdStates.waiting_for_photos)
-async def handle_photos(message: types.Message, state: FSMContext):
+async def handle_photos(message: types.Message, state: FSMContext, album: list[types.Message] | None = None):
     user_id = message.from_user.id
 
-    if not message.photo:
+    incoming = [m for m in (album or [message]) if m.photo]
+    if not incoming:
         await message.answer("⚠️ Это не фото. Пришлите изображение.")
         return
 
-    if "photos" not in user_data[user_id]:
-        user_data[user_id]["photos"] = []
-    user_data[user_id]["photos"].append(message.photo[-1].file_id)
+    photos = user_data[user_id].setdefault("photos", [])
+    photo_uids = user_data[user_id].setdefault("photo_uids", [])
+    # Альбом отсортирован по message_id, поэтому лишние фото отбрасываются всегда одни и те же
+    accepted = incoming[:MAX_PHOTOS - len(photos)]
+    for m in accepted:
+        photos.append(m.photo[-1].file_id)
+        photo_uids.append(m.photo[-1].file_unique_id)
+    skipped = len(incoming) - len(accepted)
 
-    current_count = len(user_data[user_id]["photos"])
+    current_count = len(photos)
 
-    if current_count >= 3:
+    if current_count >= MAX_PHOTOS:
         # Все фото загружены — переходим к контакту
+        if skipped:
+            await message.answer(f"📸 Принято {MAX_PHOTOS} фото, лишние ({skipped}) пропущены.")
         await proceed_to_contact(message, state, user_id)
     else:
         # Отправляем новое сообщение ПОД фото
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⏭️ Пропустить / продолжить", callback_data="SKIP_PHOTOS")]
-        ])
         status_msg = (
-            f"📸 Фото добавлено ({current_count}/3).\n"
+            f"📸 Фото добавлено ({current_count}/{MAX_PHOTOS}).\n"
             f"Продолжайте присылать или нажмите кнопку ниже:"
         )
-        await message.answer(status_msg, reply_markup=kb)
+        await message.answer(status_msg, reply_markup=SKIP_PHOTOS_KEYBOARD)
 
 
 # === Пропустить фото ===
@@ -196,11 +449,7 @@ async def proceed_to_contact(message_or_callback, state: FSMContext, user_id: in
     else:
         chat_id = message_or_callback.chat.id
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📩 В личку", callback_data="CONTACT_PRIVATE"), InlineKeyboardButton(text="📞 По телефону", callback_data="CONTACT_PHONE")],
-        [InlineKeyboardButton(text="⏭️ Пропустить", callback_data="CONTACT_SKIP")]
-    ])
-    contact_msg = await bot.send_message(chat_id, "Как с вами связаться?", reply_markup=keyboard)
+    contact_msg = await bot.send_message(chat_id, "Как с вами связаться?", reply_markup=CONTACT_KEYBOARD)
     user_data[user_id]["contact_msg_id"] = contact_msg.message_id
 
 
@@ -267,16 +516,38 @@ async def publish_ad(message_or_callback: types.Message | types.CallbackQuery, u
             "Укажите **текст объявления** или пришлите **фото**.\n\n"
             "Контакт сам по себе не является объявлением."
         )
-        restart_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Подать объявление снова", callback_data="RESTART_AD")]
-        ])
         if isinstance(message_or_callback, types.CallbackQuery):
-            await message_or_callback.message.answer(error_msg, reply_markup=restart_kb)
+            await message_or_callback.message.answer(error_msg, reply_markup=RESTART_KEYBOARD)
         else:
-            await message_or_callback.answer(error_msg, reply_markup=restart_kb)
+            await message_or_callback.answer(error_msg, reply_markup=RESTART_KEYBOARD)
         user_data.pop(user_id, None)
         return
 
+    if isinstance(message_or_callback, types.CallbackQuery):
+        reply_to = message_or_callback.message
+    else:
+        reply_to = message_or_callback
+
+    # Повтор недавнего объявления: слишком свежий отклоняем, более старый "поднимаем" —
+    # удаляем прежний пост из канала и публикуем заново
+    fingerprint = Fingerprint(ad_text, data.get("photo_uids", []))
+    previous = duplicates.find(user_id, fingerprint)
+    bumped_ids = []
+    if previous is not None:
+        wait = BUMP_AFTER - (time.time() - previous.created_at)
+        if wait > 0 or not previous.message_ids:
+            hours = max(1, round(wait / 3600))
+            await reply_to.answer(
+                "🔁 Такое объявление уже опубликовано в канале - @asinoobyav.\n"
+                f"Поднять его можно будет примерно через {hours} ч.",
+                reply_markup=RESTART_KEYBOARD
+            )
+            user_data.pop(user_id, None)
+            return
+        bumped_ids = previous.message_ids
+        duplicates.remove(user_id, previous)
+    duplicates.add(user_id, fingerprint)
+
     ad_type_code = data["ad_type"]
     header, emoji_item = ad_type_map.get(ad_type_code, ("❓ Неизвестный", "❓"))
 
@@ -296,39 +567,55 @@ async def publish_ad(message_or_callback: types.Message | types.CallbackQuery, u
 
     message_html = "\n".join(lines)
 
-    try:
-        if photos:
-            media_group = []
-            for i, photo_id in enumerate(photos):
-                if i == 0:
-                    media_group.append(types.InputMediaPhoto(media=photo_id, caption=message_html, parse_mode="HTML"))
-                else:
-                    media_group.append(types.InputMediaPhoto(media=photo_id))
-            await bot.send_media_group(chat_id=CHANNEL_ID, media=media_group)
-        else:
-            await bot.send_message(chat_id=CHANNEL_ID, text=message_html, parse_mode="HTML")
+    status_msg = await reply_to.answer("⏳ Объявление поставлено в очередь на публикацию...")
+
+    if photos:
+        media_group = []
+        for i, photo_id in enumerate(photos):
+            if i == 0:
+                media_group.append(types.InputMediaPhoto(media=photo_id, caption=message_html, parse_mode="HTML"))
+            else:
+                media_group.append(types.InputMediaPhoto(media=photo_id))
 
+        async def send():
+            return await bot.send_media_group(chat_id=CHANNEL_ID, media=media_group)
+    else:
+        async def send():
+            return await bot.send_message(chat_id=CHANNEL_ID, text=message_html, parse_mode="HTML")
+
+    async def on_success(result):
+        # send_media_group возвращает список сообщений, ссылка ведёт на первое
+        sent = result[0] if isinstance(result, list) else result
+        fingerprint.message_ids = [m.message_id for m in result] if isinstance(result, list) else [result.message_id]
+        if bumped_ids:
+            try:
+                await bot.delete_messages(chat_id=CHANNEL_ID, message_ids=bumped_ids)
+                await ads_index.remove(bumped_ids)
+            except Exception as e:
+                print(f"Не удалось удалить прежнюю публикацию: {e}")
+        try:
+            await ads_index.add(user_id, ad_type_code, ad_text, contact_info_raw, sent.message_id, photos)
+        except Exception as e:
+            print(f"Не удалось сохранить объявление для поиска: {e}")
         final_msg = (
             "✅ Ваше объявление опубликовано в канале - @asinoobyav.\n\n"
             "Чтобы создать новое объявление нажмите - /start"
         )
-        if isinstance(message_or_callback, types.CallbackQuery):
-            await message_or_callback.message.answer(final_msg)
-        else:
-            await message_or_callback.answer(final_msg)
+        await status_msg.edit_text(final_msg)
 
-    except Exception as e:
-        error_msg = f"❌ Ошибка публикации: {e}"
-        if isinstance(message_or_callback, types.CallbackQuery):
-            await message_or_callback.message.answer(error_msg)
-        else:
-            await message_or_callback.answer(error_msg)
+    async def on_failure(e):
+        print(f"Ошибка публикации объявления пользователя {user_id}: {e}")
+        duplicates.remove(user_id, fingerprint)
+        if previous is not None:
+            duplicates.add(user_id, previous)
+        await status_msg.edit_text(f"❌ Ошибка публикации: {e}")
 
+    publish_queue.submit(CHANNEL_ID, send, cost=max(1, len(photos)), on_success=on_success, on_failure=on_failure)
     user_data.pop(user_id, None)
 
 
 # === Кнопка "Подать объявление снова" ===
-@dp.callback_query(lambda c: c.data == "REASTART_AD")
+@dp.callback_query(lambda c: c.data == "RESTART_AD")
 async def restart_ad(callback_query: types.CallbackQuery, state: FSMContext):
     await state.clear()
     start_msg = (
@@ -336,18 +623,158 @@ async def restart_ad(callback_query: types.CallbackQuery, state: FSMContext):
         "Как создать объявление? - /info\n\n"
         "Выберите тип объявления:"
     )
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔴 Продать", callback_data="SELL"), InlineKeyboardButton(text="🟢 Куплю", callback_data="BUY")],
-        [InlineKeyboardButton(text="🔵 Обменяю", callback_data="EXCHANGE"), InlineKeyboardButton(text="🟡 Услуги", callback_data="SERVICE")],
-        [InlineKeyboardButton(text="🟣 Разное", callback_data="MISC")]
-    ])
-    await callback_query.message.answer(start_msg, reply_markup=keyboard)
+    await callback_query.message.answer(start_msg, reply_markup=START_KEYBOARD)
     await callback_query.answer()
 
 
+# === Поиск объявлений в inline-режиме (@бот запрос) ===
+@dp.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    rows, has_more = await ads_index.search(inline_query.query, offset)
+
+    results = []
+    for row in rows:
+        header, emoji_item = ad_type_map.get(row['ad_type'], ("❓ Неизвестный", "❓"))
+        link = f"https://t.me/{CHANNEL_USERNAME}/{row['message_id']}"
+        # Текст объявления написал пользователь: один символ "<" сломал бы разметку всего ответа
+        text = f"{header}\n\n{emoji_item} {html.escape(row['text'])}\n\n📞 Контакт: {contact_html(row['contact'])}\n\n🔗 {link}"
+        photos = json.loads(row['photos'])
+        if photos:
+            results.append(types.InlineQueryResultCachedPhoto(
+                id=str(row['id']),
+                photo_file_id=photos[0],
+                caption=text,
+                parse_mode="HTML"
+            ))
+        else:
+            results.append(types.InlineQueryResultArticle(
+                id=str(row['id']),
+                title=header,
+                description=row['text'][:100],
+                url=link,
+                input_message_content=types.InputTextMessageContent(message_text=text, parse_mode="HTML")
+            ))
+
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=str(offset + len(rows)) if has_more else ""
+    )
+
+
 # === Запуск ===
+async def run_webhook():
+    updates = UpdateQueue(lambda data: dp.feed_raw_update(bot, data), maxsize=WEBHOOK_QUEUE_SIZE)
+    app = make_webhook_app(WEBHOOK_PATH, WEBHOOK_SECRET, updates.put_nowait)
+    await dp.emit_startup(bot=bot)
+    await updates.start()
+    runner = await start_server(app, WEBHOOK_HOST, WEBHOOK_PORT)
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await updates.stop()
+
+
+async def run_shard():
+    # Воркер многопроцессного режима: апдейты приходят от ингресса через unix-сокет
+    updates = UpdateQueue(lambda data: dp.feed_raw_update(bot, data), maxsize=WEBHOOK_QUEUE_SIZE)
+    await dp.emit_startup(bot=bot)
+    await updates.start()
+    server = await serve_shard(shard_socket(SHARD_SOCKET_DIR, SHARD_INDEX), updates.put)
+    try:
+        await wait_for_stop()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await updates.stop()
+
+
+async def startup() -> asyncio.Task:
+    # До первого апдейта — только базы; обе открываются и мигрируют в своих потоках, параллельно
+    await asyncio.gather(storage.start(), ads_db.start())
+    user_data.start_purge()
+    return asyncio.create_task(deferred_startup())
+
+
+async def deferred_startup():
+    # Чистка старых объявлений и сервер метрик ждут, пока бот начнёт отвечать
+    await asyncio.sleep(STARTUP_DEFER)
+    await ads_index.prune()
+    if not METRICS_PORT:
+        return None
+    try:
+        return await start_server(make_metrics_app(), METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        print(f"Сервер метрик не запущен ({METRICS_HOST}:{METRICS_PORT}): {e}")
+        return None
+
+
+async def wait_for_signal(polling: asyncio.Task):
+    # Сигналы ловим сами, а не в aiogram: поллинг останавливает shutdown(), когда всё остальное уже остановлено
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    waiter = asyncio.create_task(stop.wait())
+    await asyncio.wait((polling, waiter), return_when=asyncio.FIRST_COMPLETED)
+    waiter.cancel()
+    if polling.done():
+        polling.result()
+
+
+async def shutdown(deferred: asyncio.Task, polling: asyncio.Task = None):
+    if not deferred.done():
+        deferred.cancel()
+        await asyncio.gather(deferred, return_exceptions=True)
+    elif not deferred.cancelled() and deferred.exception() is None and deferred.result() is not None:
+        await deferred.result().cleanup()
+    # Порядок важен: очередь досылает накопленное, пока сессия бота открыта, а чистка
+    # сессий останавливается до того, как dispatcher закроет FSM-хранилище
+    await publish_queue.stop()
+    await user_data.stop_purge()
+    if polling is None:
+        await dp.emit_shutdown(bot=bot)
+    elif not polling.done():
+        # emit_shutdown вызовет сам start_polling
+        await dp.stop_polling()
+        await asyncio.gather(polling, return_exceptions=True)
+    await bot.session.close()
+    await ads_db.close()
+
+
 async def main():
-    await dp.start_polling(bot)
+    if BOT_MODE == "sharded" and SHARD_INDEX is None:
+        await run_ingress(
+            shards=SHARDS, socket_dir=SHARD_SOCKET_DIR, token=BOT_TOKEN,
+            api_url=BOT_API_URL or "https://api.telegram.org",
+            webhook_url=WEBHOOK_URL, webhook_path=WEBHOOK_PATH, webhook_secret=WEBHOOK_SECRET,
+            webhook_host=WEBHOOK_HOST, webhook_port=WEBHOOK_PORT,
+            allowed_updates=dp.resolve_used_update_types(),
+            metrics_host=METRICS_HOST, metrics_port=METRICS_PORT, metrics_port_base=METRICS_PORT_BASE,
+            queue_size=WEBHOOK_QUEUE_SIZE
+        )
+        return
+    deferred = await startup()
+    polling = None
+    try:
+        if SHARD_INDEX is not None:
+            await run_shard()
+        elif BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+            await wait_for_signal(polling)
+    finally:
+        await shutdown(deferred, polling)
 
 
 if __name__ == "__main__":
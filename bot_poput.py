@@ -1,5 +1,8 @@
+import asyncio
+import functools
 import os
 import re
+import sqlite3
 import logging
 import html
 from datetime import datetime, timedelta
@@ -7,19 +10,78 @@ from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, ConversationHandler, filters, JobQueue
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ContextTypes, ConversationHandler, TypeHandler, filters
 )
-import sqlite3
 import pytz
 
+from digest import ChannelDigest, mark_dirty as mark_digest_dirty
+from locations import PLACES
+from metrics import API_ERRORS, API_LATENCY, API_RETRY_AFTER, HANDLER_ERRORS, HANDLER_LATENCY, REGISTRY, UPDATES, make_metrics_app
+from outbox import OutboxEntry, OutboxRelay, enqueue as enqueue_post, enqueue_edit
+from persistence import SQLitePersistence
+from profiling import Profiler, parse_admin_ids
+from publish_queue import PublishQueue
+from rides_db import RidesDB
+from sharding import SHARD_ENV, run_ingress, serve_shard, shard_of, shard_socket, wait_for_stop
+from subscriptions import FanOut, SubscriptionIndex
+from throttling import Throttler
+from update_processor import PerUserUpdateProcessor
+from webhook import make_webhook_app, start_server
+
 # === НАСТРОЙКИ ===
-BOT_TOKEN = "TOKEN"
-GROUP_CHAT_ID = ID  # ID канала @poputchik_asino
+BOT_TOKEN = os.getenv("BOT_TOKEN", "TOKEN")
+BOT_API_URL = os.getenv("BOT_API_URL", "")          # свой сервер Bot API, например http://127.0.0.1:8090
+GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "0"))  # ID канала @poputchik_asino
 
 TZ = pytz.timezone('Asia/Novosibirsk')
 
+SWEEP_INTERVAL = 60        # секунд между проверками просроченных поездок
+SWEEP_LIMIT = 1000         # максимум поездок за один проход
+DELETE_BATCH = 100         # лимит deleteMessages на один вызов
+EDIT_DEBOUNCE = 5          # секунд: правки объявления за это окно уходят в канал одним editMessageText
+MY_RIDES_LIMIT = 10        # сколько своих поездок показывать в /my
+
+# Режим приёма апдейтов: "polling" (по умолчанию), "webhook" или "sharded" —
+# вебхук принимает ингресс и раскладывает апдейты по SHARDS процессам-воркерам
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # внешний адрес, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/poput")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")    # обязателен в режимах webhook и sharded
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8082"))
+WEBHOOK_QUEUE_SIZE = 1000
+SHARDS = int(os.getenv("SHARDS", "1")) if BOT_MODE == "sharded" else 1
+SHARD_INDEX = int(os.environ[SHARD_ENV]) if SHARD_ENV in os.environ else None
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp/obyav-poput")
+# Публикацию в канал, удаление просроченных и рассылки ведёт один процесс,
+# поэтому лимиты канала и Bot API на рассылку не делятся между воркерами
+IS_PUBLISHER = SHARD_INDEX in (None, 0)
+CHANNEL_RATE = float(os.getenv("CHANNEL_RATE", str(20 / 60)))   # постов в канал в секунду
+# posts — пост на каждую поездку, digest — один пост-сводка на дату и маршрут
+CHANNEL_MODE = os.getenv("CHANNEL_MODE", "posts")
+DIGEST_DELAY = 5           # секунд: изменения сводки за это окно — одной перерисовкой
+DIGEST_LIMIT = 3800        # символов в посте сводки (лимит Telegram — 4096)
+
+# Метрики Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0 — отключены)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))
+# В режиме sharded: воркер i — на METRICS_PORT_BASE + i (у ботов диапазоны не пересекаются)
+METRICS_PORT_BASE = int(os.getenv("METRICS_PORT_BASE", "9120"))
+
+PERSISTENCE_INTERVAL = 10  # секунд между сохранениями разговоров и user_data
+STARTUP_DEFER = 2          # через сколько секунд после запуска поднимать всё, что не нужно первому апдейту
+
+# Сколько апдейтов обрабатывается одновременно; апдейты одного пользователя — всегда по порядку
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Кому доступна команда /profile (id через запятую)
+ADMIN_IDS = parse_admin_ids(os.getenv("ADMIN_IDS", ""))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles/poput")
+
 (
     SELECT_ROLE,
     SELECT_ROUTE,
@@ -35,30 +97,53 @@ TZ = pytz.timezone('Asia/Novosibirsk')
     CONTACT_PHONE
 ) = range(12)
 
-def init_db():
-    conn = sqlite3.connect('rides.db', check_same_thread=False)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS rides (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            role TEXT,
-            from_loc TEXT,
-            to_loc TEXT,
-            date TEXT,
-            time_slot TEXT,
-            seats INTEGER,
-            comment TEXT,
-            contact TEXT,
-            username TEXT,
-            message_id INTEGER,
-            price TEXT
-        )
-    ''')
-    conn.commit()
-    return conn
-
-DB_CONN = init_db()
+# Состояния поиска /find
+(
+    FIND_ROLE,
+    FIND_ROUTE,
+    FIND_FROM,
+    FIND_TO,
+    FIND_DATE,
+    FIND_TIME,
+    FIND_RESULTS
+) = range(12, 19)
+
+# Состояния редактирования (черновика и опубликованной поездки)
+(
+    EDIT_FIELD,
+    EDIT_TIME,
+    EDIT_MANUAL_TIME,
+    EDIT_PRICE,
+    EDIT_SEATS,
+    EDIT_COMMENT
+) = range(19, 25)
+
+# Имена состояний для метрик и профилей
+STATE_NAMES = dict(enumerate([
+    "SELECT_ROLE", "SELECT_ROUTE", "FROM_LOCATION", "TO_LOCATION", "SELECT_DATE", "SELECT_TIME",
+    "MANUAL_TIME_INPUT", "PRICE", "SEATS", "COMMENT", "CONTACT_METHOD", "CONTACT_PHONE",
+    "FIND_ROLE", "FIND_ROUTE", "FIND_FROM", "FIND_TO", "FIND_DATE", "FIND_TIME", "FIND_RESULTS",
+    "EDIT_FIELD", "EDIT_TIME", "EDIT_MANUAL_TIME", "EDIT_PRICE", "EDIT_SEATS", "EDIT_COMMENT"
+]))
+
+CHANNEL_USERNAME = "poputchik_asino"
+FIND_PAGE_SIZE = 5
+# Окна времени отправления для поиска: (подпись, час начала, час конца)
+FIND_WINDOWS = {
+    "any": ("Любое время", 0, 24),
+    "morning": ("Утро 06–12", 6, 12),
+    "day": ("День 12–18", 12, 18),
+    "evening": ("Вечер 18–24", 18, 24),
+}
+
+DB = RidesDB('rides.db')
+PUBLISH_QUEUE = PublishQueue(rate=CHANNEL_RATE, permanent_errors=(BadRequest, Forbidden))
+SUBSCRIPTIONS = SubscriptionIndex(DB, location_id=PLACES.location_id)
+FANOUT = FanOut(concurrency=10, rate=25, permanent_errors=(Forbidden,), on_permanent=SUBSCRIPTIONS.remove_user)  # заблокировавшим бота больше не пишем
+THROTTLER = Throttler()
+PROFILER = Profiler(PROFILE_DIR)
+PENDING_DELETIONS = REGISTRY.gauge("poput_pending_deletions", "Поездки, ожидающие удаления из канала")
+FLOOD_WARNING = "⏳ Слишком часто. Подождите пару секунд и повторите."
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -79,60 +164,161 @@ def format_phone(phone: str) -> str:
         return f"8 {digits[:3]} {digits[3:6]} {digits[6:8]} {digits[8:]}"
     return f"8 {digits}"
 
-def get_date_slots():
-    today = datetime.now(TZ).date()
-    buttons = []
-    for i in range(7):
-        d = today + timedelta(days=i)
-        buttons.append(InlineKeyboardButton(d.strftime("%d.%m"), callback_data=f"date_{d.isoformat()}"))
-    return [buttons[:4], buttons[4:]]
+# === КЛАВИАТУРЫ ===
+class StaticKeyboard(InlineKeyboardMarkup):
+    """Неизменяемая клавиатура: собирается один раз, to_dict() считается один раз и переиспользуется."""
 
-def get_time_slots(selected_date):
-    now = datetime.now(TZ)
-    today = now.date()
-    is_today = (selected_date == today)
-    slots = []
-
-    for h in range(6, 24):
-        slot_start = f"{h:02d}:00"
-        next_h = (h + 1) % 24
-        slot_end = f"{next_h:02d}:00"
-        slot_label = f"{slot_start} - {slot_end}"
-
-        if is_today:
-            slot_time = datetime.strptime(slot_start, "%H:%M").time()
-            if now.time() >= slot_time:
-                continue
-        slots.append(InlineKeyboardButton(slot_label, callback_data=f"time_{slot_start}_{slot_end}"))
-
-    # Формируем ряды по 2 кнопки из временных слотов
-    rows = []
-    for i in range(0, len(slots), 2):
-        rows.append(slots[i:i+2])
-    
-    # Добавляем "Указать время вручную" ОТДЕЛЬНОЙ СТРОКОЙ ВНИЗУ
-    rows.append([InlineKeyboardButton("✏️ Указать время вручную", callback_data="time_manual")])
-    
-    return rows
+    __slots__ = ("_cached_dict",)
 
-def get_price_slots():
-    prices = [480, 450, 420]
-    buttons = [
-        [InlineKeyboardButton("По цене билета", callback_data="price_text_По цене билета")],
-        [InlineKeyboardButton(f"{p} ₽", callback_data=f"price_{p}") for p in prices]
+    def to_dict(self, recursive: bool = True):
+        if not recursive:
+            return super().to_dict(recursive=False)
+        try:
+            return self._cached_dict
+        except AttributeError:
+            self._cached_dict = super().to_dict()
+            return self._cached_dict
+
+ROLE_KEYBOARD = StaticKeyboard([
+    [InlineKeyboardButton("🚗 Я водитель", callback_data="role_driver")],
+    [InlineKeyboardButton("👤 Я пассажир", callback_data="role_passenger")]
+])
+
+ROUTE_KEYBOARD = StaticKeyboard([
+    [
+        InlineKeyboardButton("  Асино — Томск  ", callback_data="route_asino_tomsk"),
+        InlineKeyboardButton("  Томск — Асино  ", callback_data="route_tomsk_asino")
+    ],
+    [
+        InlineKeyboardButton("✏️ Указать вручную", callback_data="route_manual")
     ]
-    buttons.append([InlineKeyboardButton("✏️ Указать вручную", callback_data="price_manual")])
-    return buttons
-
-def get_deletion_time(ride_data):
+])
+
+PRICE_KEYBOARD = StaticKeyboard([
+    [InlineKeyboardButton("По цене билета", callback_data="price_text_По цене билета")],
+    [InlineKeyboardButton(f"{p} ₽", callback_data=f"price_{p}") for p in (480, 450, 420)],
+    [InlineKeyboardButton("✏️ Указать вручную", callback_data="price_manual")]
+])
+
+# Пассажиру нужно до 4 мест, водитель предлагает до 5
+PASSENGER_SEATS_KEYBOARD = StaticKeyboard([[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, 5)]])
+DRIVER_SEATS_KEYBOARD = StaticKeyboard([[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, 6)]])
+
+SKIP_COMMENT_KEYBOARD = StaticKeyboard([[InlineKeyboardButton("Пропустить", callback_data="skip_comment")]])
+
+CONTACT_KEYBOARD = StaticKeyboard([
+    [InlineKeyboardButton("📱 Указать номер", callback_data="contact_phone")],
+    [InlineKeyboardButton("💬 Принимать в ЛС", callback_data="contact_pm")]
+])
+
+PREVIEW_KEYBOARD = StaticKeyboard([
+    [InlineKeyboardButton("✅ Опубликовать", callback_data="publish_yes")],
+    [InlineKeyboardButton("✏️ Изменить", callback_data="publish_edit"),
+     InlineKeyboardButton("❌ Отменить", callback_data="publish_cancel")]
+])
+
+# Что можно поменять в поездке; цена есть только у водителя
+EDIT_KEYBOARDS = {
+    'driver': StaticKeyboard([
+        [InlineKeyboardButton("🕗 Время", callback_data="efield_time"),
+         InlineKeyboardButton("👤 Места", callback_data="efield_seats")],
+        [InlineKeyboardButton("💰 Цена", callback_data="efield_price"),
+         InlineKeyboardButton("💬 Комментарий", callback_data="efield_comment")],
+        [InlineKeyboardButton("✅ Готово", callback_data="efield_done")]
+    ]),
+    'passenger': StaticKeyboard([
+        [InlineKeyboardButton("🕗 Время", callback_data="efield_time"),
+         InlineKeyboardButton("👤 Места", callback_data="efield_seats")],
+        [InlineKeyboardButton("💬 Комментарий", callback_data="efield_comment")],
+        [InlineKeyboardButton("✅ Готово", callback_data="efield_done")]
+    ]),
+}
+
+REMOVE_COMMENT_KEYBOARD = StaticKeyboard([[InlineKeyboardButton("Без комментария", callback_data="skip_comment")]])
+
+FIND_ROLE_KEYBOARD = StaticKeyboard([
+    [InlineKeyboardButton("🚗 Ищу водителя", callback_data="frole_driver")],
+    [InlineKeyboardButton("👤 Ищу пассажиров", callback_data="frole_passenger")]
+])
+
+FIND_ROUTE_KEYBOARD = StaticKeyboard([
+    [
+        InlineKeyboardButton("  Асино — Томск  ", callback_data="froute_asino_tomsk"),
+        InlineKeyboardButton("  Томск — Асино  ", callback_data="froute_tomsk_asino")
+    ],
+    [
+        InlineKeyboardButton("✏️ Указать вручную", callback_data="froute_manual")
+    ]
+])
+
+FIND_TIME_KEYBOARD = StaticKeyboard([
+    [InlineKeyboardButton(label, callback_data=f"ftime_{key}")]
+    for key, (label, _, _) in FIND_WINDOWS.items()
+])
+
+UNSUBSCRIBE_KEYBOARD = StaticKeyboard([[InlineKeyboardButton("🔕 Отписаться", callback_data="unsubscribe")]])
+
+BACK_KEYBOARD = StaticKeyboard([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]])
+
+# Кнопки часовых слотов 06:00–24:00, фильтруются по текущему часу
+TIME_SLOT_BUTTONS = [
+    (h, InlineKeyboardButton(f"{h:02d}:00 - {(h + 1) % 24:02d}:00", callback_data=f"time_{h:02d}:00_{(h + 1) % 24:02d}:00"))
+    for h in range(6, 24)
+]
+MANUAL_TIME_BUTTON = InlineKeyboardButton("✏️ Указать время вручную", callback_data="time_manual")
+
+# Клавиатуры дат и времени зависят только от текущего часа:
+# кэш сбрасывается целиком, как только меняются дата или час
+_slots_cache = {}
+_slots_cache_hour = None
+
+def _slots_cache_for(now: datetime) -> dict:
+    global _slots_cache, _slots_cache_hour
+    hour_key = (now.date(), now.hour)
+    if hour_key != _slots_cache_hour:
+        _slots_cache = {}
+        _slots_cache_hour = hour_key
+    return _slots_cache
+
+def get_date_slots(prefix: str = "date_") -> StaticKeyboard:
+    now = datetime.now(TZ)
+    cache = _slots_cache_for(now)
+    markup = cache.get(prefix)
+    if markup is None:
+        today = now.date()
+        buttons = []
+        for i in range(7):
+            d = today + timedelta(days=i)
+            buttons.append(InlineKeyboardButton(d.strftime("%d.%m"), callback_data=f"{prefix}{d.isoformat()}"))
+        markup = cache[prefix] = StaticKeyboard([buttons[:4], buttons[4:]])
+    return markup
+
+def get_time_slots(selected_date) -> StaticKeyboard:
+    now = datetime.now(TZ)
+    cache = _slots_cache_for(now)
+    markup = cache.get(selected_date)
+    if markup is None:
+        # На сегодня показываем только слоты, которые ещё не начались
+        is_today = (selected_date == now.date())
+        slots = [button for h, button in TIME_SLOT_BUTTONS if not (is_today and h <= now.hour)]
+
+        # Формируем ряды по 2 кнопки из временных слотов
+        rows = [slots[i:i+2] for i in range(0, len(slots), 2)]
+
+        # Добавляем "Указать время вручную" ОТДЕЛЬНОЙ СТРОКОЙ ВНИЗУ
+        rows.append([MANUAL_TIME_BUTTON])
+        markup = cache[selected_date] = StaticKeyboard(rows)
+    return markup
+
+def parse_time_slot(ride_data):
     """
-    Всегда возвращает datetime. Никогда не вызывает исключение.
-    - Для стандартных слотов: удаляем после поездки + 2 часа
-    - Для всего остального: через 48 часов
+    Разбирает стандартный слот вида "07:00 - 08:00".
+    Возвращает (date, start_h, end_h) или None, если время указано вручную
+    или данные некорректны. Никогда не вызывает исключение.
     """
     try:
         time_slot = ride_data['time']
-        
+
         if " - " in time_slot:
             parts = time_slot.split(" - ")
             if len(parts) == 2:
@@ -143,44 +329,77 @@ def get_deletion_time(ride_data):
                     start_m = int(start_parts[1])
                     end_h = int(end_parts[0])
                     end_m = int(end_parts[1])
-                    
+
                     if 0 <= start_h <= 23 and 0 <= end_h <= 23 and start_m == 0 and end_m == 0:
                         date_part = datetime.fromisoformat(ride_data['date']).date()
-                        is_hourly = (end_h - start_h == 1) or (start_h == 23 and end_h == 0)
-
-                        if is_hourly:
-                            deletion_hour = start_h + 2
-                            deletion_minute = 0
-                            deletion_date = date_part
-                        else:
-                            deletion_hour = end_h + 1
-                            deletion_minute = 0
-                            if deletion_hour >= 24:
-                                deletion_hour = 0
-                                deletion_date = date_part + timedelta(days=1)
-                            else:
-                                deletion_date = date_part
-
-                        dt = datetime.combine(deletion_date, datetime.min.time().replace(hour=deletion_hour, minute=deletion_minute))
-                        return TZ.localize(dt)
+                        return date_part, start_h, end_h
+    except Exception:
+        pass
+    return None
+
+def get_deletion_time(ride_data):
+    """
+    Всегда возвращает datetime. Никогда не вызывает исключение.
+    - Для стандартных слотов: удаляем после поездки + 2 часа
+    - Для всего остального: через 48 часов
+    """
+    try:
+        slot = parse_time_slot(ride_data)
+        if slot:
+            date_part, start_h, end_h = slot
+            is_hourly = (end_h - start_h == 1) or (start_h == 23 and end_h == 0)
+
+            if is_hourly:
+                deletion_hour = start_h + 2
+                deletion_minute = 0
+                deletion_date = date_part
+            else:
+                deletion_hour = end_h + 1
+                deletion_minute = 0
+                if deletion_hour >= 24:
+                    deletion_hour = 0
+                    deletion_date = date_part + timedelta(days=1)
+                else:
+                    deletion_date = date_part
+
+            dt = datetime.combine(deletion_date, datetime.min.time().replace(hour=deletion_hour, minute=deletion_minute))
+            return TZ.localize(dt)
     except Exception:
         pass  # Любая ошибка → fallback на 48 часов
 
     return datetime.now(TZ) + timedelta(hours=48)
 
+def get_departure_window(ride_data):
+    """
+    Интервал отправления (unix-время начала и конца) для поиска.
+    - Для стандартных слотов: границы слота
+    - Для времени, указанного вручную: весь день поездки
+    - Если не разобрать даже дату: (None, None)
+    """
+    slot = parse_time_slot(ride_data)
+    try:
+        if slot:
+            date_part, start_h, end_h = slot
+            start = TZ.localize(datetime.combine(date_part, datetime.min.time().replace(hour=start_h)))
+            end = TZ.localize(datetime.combine(date_part, datetime.min.time().replace(hour=end_h)))
+            if end <= start:
+                end += timedelta(days=1)
+        else:
+            date_part = datetime.fromisoformat(ride_data['date']).date()
+            start = TZ.localize(datetime.combine(date_part, datetime.min.time()))
+            end = start + timedelta(days=1)
+    except Exception:
+        return None, None
+    return int(start.timestamp()), int(end.timestamp())
+
 # === ОБРАБОТЧИКИ ===
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("🚗 Я водитель", callback_data="role_driver")],
-        [InlineKeyboardButton("👤 Я пассажир", callback_data="role_passenger")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "Все поездки публикуются в канале: @poputchik_asino\n\n"
         "Как создать поездку: нажмите МЕНЮ - Инструкция или /info\n\n"
         "Вы водитель или пассажир?",
-        reply_markup=reply_markup
+        reply_markup=ROLE_KEYBOARD
     )
     return SELECT_ROLE
 
@@ -190,17 +409,7 @@ async def role_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role = query.data.split("_")[1]
     context.user_data['ride'] = {'role': role}
 
-    keyboard = [
-        [
-            InlineKeyboardButton("  Асино — Томск  ", callback_data="route_asino_tomsk"),
-            InlineKeyboardButton("  Томск — Асино  ", callback_data="route_tomsk_asino")
-        ],
-        [
-            InlineKeyboardButton("✏️ Указать вручную", callback_data="route_manual")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("📍 Выберите маршрут:", reply_markup=reply_markup)
+    await query.edit_message_text("📍 Выберите маршрут:", reply_markup=ROUTE_KEYBOARD)
     return SELECT_ROUTE
 
 async def route_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -211,14 +420,14 @@ async def route_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "route_asino_tomsk":
         context.user_data['ride']['from'] = "Асино"
         context.user_data['ride']['to'] = "Томск"
-        reply_markup = InlineKeyboardMarkup(get_date_slots())
+        reply_markup = get_date_slots()
         await query.edit_message_text("📅 Выберите дату поездки:", reply_markup=reply_markup)
         return SELECT_DATE
 
     elif data == "route_tomsk_asino":
         context.user_data['ride']['from'] = "Томск"
         context.user_data['ride']['to'] = "Асино"
-        reply_markup = InlineKeyboardMarkup(get_date_slots())
+        reply_markup = get_date_slots()
         await query.edit_message_text("📅 Выберите дату поездки:", reply_markup=reply_markup)
         return SELECT_DATE
 
@@ -230,17 +439,58 @@ async def route_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ Неизвестный маршрут. Начните заново: /start")
         return ConversationHandler.END
 
+async def ask_location(update: Update, target: dict, field: str, prefix: str) -> bool:
+    """
+    Приводит введённое место к названию из справочника.
+    Возвращает True, если место определено; иначе показывает кнопки
+    "возможно, вы имели в виду" (prefix + id) и возвращает False.
+    """
+    text = update.message.text.strip()
+    place = PLACES.lookup(text)
+    if place is not None:
+        target[field] = place.name
+        return True
+
+    target[field] = text
+    suggestions = PLACES.suggest(text)
+    if not suggestions:
+        return True
+    buttons = [[InlineKeyboardButton(p.name, callback_data=f"{prefix}{p.id}")] for p in suggestions]
+    buttons.append([InlineKeyboardButton(f"Оставить «{text[:30]}»", callback_data=f"{prefix}keep")])
+    await update.message.reply_text("🤔 Возможно, вы имели в виду:", reply_markup=InlineKeyboardMarkup(buttons))
+    return False
+
+async def apply_location_choice(update: Update, target: dict, field: str, prefix: str):
+    query = update.callback_query
+    await query.answer()
+    place = PLACES.get(query.data[len(prefix):])
+    if place is not None:
+        target[field] = place.name
+    return query
+
 async def from_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['ride']['from'] = update.message.text.strip()
+    if not await ask_location(update, context.user_data['ride'], 'from', "loc_from_"):
+        return FROM_LOCATION
     await update.message.reply_text("📍 Куда едете / куда вам нужно попасть?")
     return TO_LOCATION
 
+async def from_location_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = await apply_location_choice(update, context.user_data['ride'], 'from', "loc_from_")
+    await query.edit_message_text("📍 Куда едете / куда вам нужно попасть?")
+    return TO_LOCATION
+
 async def to_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['ride']['to'] = update.message.text.strip()
-    reply_markup = InlineKeyboardMarkup(get_date_slots())
+    if not await ask_location(update, context.user_data['ride'], 'to', "loc_to_"):
+        return TO_LOCATION
+    reply_markup = get_date_slots()
     await update.message.reply_text("📅 Выберите дату поездки:", reply_markup=reply_markup)
     return SELECT_DATE
 
+async def to_location_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = await apply_location_choice(update, context.user_data['ride'], 'to', "loc_to_")
+    await query.edit_message_text("📅 Выберите дату поездки:", reply_markup=get_date_slots())
+    return SELECT_DATE
+
 async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -248,7 +498,7 @@ async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['ride']['date'] = date_iso
 
     selected_date = datetime.fromisoformat(date_iso).date()
-    reply_markup = InlineKeyboardMarkup(get_time_slots(selected_date))
+    reply_markup = get_time_slots(selected_date)
     await query.edit_message_text("🕗 Выберите время:", reply_markup=reply_markup)
     return SELECT_TIME
 
@@ -269,15 +519,13 @@ async def time_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         role = context.user_data['ride']['role']
         if role == 'driver':
-            reply_markup = InlineKeyboardMarkup(get_price_slots())
+            reply_markup = PRICE_KEYBOARD
             await query.edit_message_text("💰 Выберите цену за поездку:", reply_markup=reply_markup)
             return PRICE
         else:
-            max_seats = 4
-            keyboard = [[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, max_seats + 1)]]
             await query.edit_message_text(
                 "👤 Сколько нужно мест?",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=PASSENGER_SEATS_KEYBOARD
             )
             return SEATS
     else:
@@ -294,15 +542,13 @@ async def manual_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     role = context.user_data['ride']['role']
     if role == 'driver':
-        reply_markup = InlineKeyboardMarkup(get_price_slots())
+        reply_markup = PRICE_KEYBOARD
         await update.message.reply_text("💰 Выберите цену за поездку:", reply_markup=reply_markup)
         return PRICE
     else:
-        max_seats = 4
-        keyboard = [[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, max_seats + 1)]]
         await update.message.reply_text(
             "👤 Сколько нужно мест?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=PASSENGER_SEATS_KEYBOARD
         )
         return SEATS
 
@@ -318,11 +564,9 @@ async def price_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith("price_text_"):
         price_text = data.split("price_text_", 1)[1]
         context.user_data['ride']['price'] = price_text
-        max_seats = 5
-        keyboard = [[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, max_seats + 1)]]
         await query.edit_message_text(
             "👤 Сколько свободных мест?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DRIVER_SEATS_KEYBOARD
         )
         return SEATS
 
@@ -330,11 +574,9 @@ async def price_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             price = int(data.split("_", 1)[1])
             context.user_data['ride']['price'] = str(price)
-            max_seats = 5
-            keyboard = [[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, max_seats + 1)]]
             await query.edit_message_text(
                 "👤 Сколько свободных мест?",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=DRIVER_SEATS_KEYBOARD
             )
             return SEATS
         except ValueError:
@@ -344,24 +586,26 @@ async def price_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ Неизвестный выбор. /start")
         return ConversationHandler.END
 
-async def manual_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
+def price_input_error(text: str):
+    """Текст ошибки для цены, введённой вручную, или None, если цена подходит."""
     if not text.isdigit():
-        await update.message.reply_text("❌ Введите только цифры (например: 500)")
-        return PRICE
+        return "❌ Введите только цифры (например: 500)"
+    if not 0 < int(text) <= 5000:
+        return "❌ Укажите разумную цену (от 1 до 5000)"
+    return None
 
-    price = int(text)
-    if price <= 0 or price > 5000:
-        await update.message.reply_text("❌ Укажите разумную цену (от 1 до 5000)")
+async def manual_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    error = price_input_error(text)
+    if error:
+        await update.message.reply_text(error)
         return PRICE
 
-    context.user_data['ride']['price'] = str(price)
+    context.user_data['ride']['price'] = str(int(text))
 
-    max_seats = 5
-    keyboard = [[InlineKeyboardButton(str(i), callback_data=f"seats_{i}") for i in range(1, max_seats + 1)]]
     await update.message.reply_text(
         "👤 Сколько свободных мест?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=DRIVER_SEATS_KEYBOARD
     )
     return SEATS
 
@@ -371,11 +615,9 @@ async def seats_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     seats = int(query.data.split("_")[1])
     context.user_data['ride']['seats'] = seats
     
-    keyboard = [[InlineKeyboardButton("Пропустить", callback_data="skip_comment")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(
         "💬 Добавьте комментарий (ребёнок, груз, \"могу забрать с адреса\" и т.д.)",
-        reply_markup=reply_markup
+        reply_markup=SKIP_COMMENT_KEYBOARD
     )
     return COMMENT
 
@@ -392,11 +634,7 @@ async def skip_comment_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     return CONTACT_METHOD
 
 async def show_contact_options(update_or_query, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("📱 Указать номер", callback_data="contact_phone")],
-        [InlineKeyboardButton("💬 Принимать в ЛС", callback_data="contact_pm")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = CONTACT_KEYBOARD
     if isinstance(update_or_query, Update):
         await update_or_query.message.reply_text("Как связаться с вами?", reply_markup=reply_markup)
     else:
@@ -483,48 +721,51 @@ def build_message(ride: dict) -> str:
 async def show_preview_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ride = context.user_data['ride']
     msg = build_message(ride)
-    keyboard = [
-        [InlineKeyboardButton("✅ Опубликовать", callback_data="publish_yes")],
-        [InlineKeyboardButton("✏️ Изменить", callback_data="publish_edit"),
-         InlineKeyboardButton("❌ Отменить", callback_data="publish_cancel")]
-    ]
-    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=PREVIEW_KEYBOARD)
 
 async def show_preview_callback(query, context: ContextTypes.DEFAULT_TYPE):
     ride = context.user_data['ride']
     msg = build_message(ride)
-    keyboard = [
-        [InlineKeyboardButton("✅ Опубликовать", callback_data="publish_yes")],
-        [InlineKeyboardButton("✏️ Изменить", callback_data="publish_edit"),
-         InlineKeyboardButton("❌ Отменить", callback_data="publish_cancel")]
-    ]
-    await query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=PREVIEW_KEYBOARD)
 
 async def publish_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     decision = query.data.split("_")[1]
 
+    if decision == "edit":
+        context.user_data['edit'] = {'message_id': None}
+        await show_edit_menu(query, context)
+        return EDIT_FIELD
     if decision != "yes":
-        await query.edit_message_text("❌ Объявление отменено." if decision == "cancel" else "Начните заново командой /start.")
+        await query.edit_message_text("❌ Объявление отменено.")
         return ConversationHandler.END
 
+    ride = context.user_data['ride']
+    user_id = update.effective_user.id
     try:
-        ride = context.user_data['ride']
         msg = build_message(ride)
+    except Exception as e:
+        logger.error(f"Ошибка публикации: {e}", exc_info=True)
+        await query.edit_message_text("❌ Ошибка при публикации. Проверьте данные.")
+        return ConversationHandler.END
 
-        sent = await context.bot.send_message(
-            chat_id=GROUP_CHAT_ID,
-            text=msg,
-            parse_mode=ParseMode.HTML
-        )
-
-        c = DB_CONN.cursor()
-        c.execute('''
-            INSERT INTO rides (user_id, role, from_loc, to_loc, date, time_slot, seats, comment, contact, username, message_id, price)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    departure_start, departure_end = get_departure_window(ride)
+    from_loc_id, to_loc_id = PLACES.location_id(ride['from']), PLACES.location_id(ride['to'])
+    payload = {
+        'text': msg,
+        'ride': dict(ride, from_loc_id=from_loc_id, to_loc_id=to_loc_id),
+        'user_id': user_id,
+        'status': [query.message.chat_id, query.message.message_id],
+    }
+
+    def insert(conn):
+        # Поездка и пост в outbox — одной транзакцией; message_id проставит OutboxRelay после отправки
+        ride_id = conn.execute('''
+            INSERT INTO rides (user_id, role, from_loc, to_loc, date, time_slot, seats, comment, contact, username, price, delete_at, departure_start, departure_end, from_loc_id, to_loc_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
-            update.effective_user.id,
+            user_id,
             ride['role'],
             ride['from'],
             ride['to'],
@@ -534,45 +775,468 @@ async def publish_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ride.get('comment', ''),
             ride['contact'],
             ride.get('username'),
-            sent.message_id,
-            ride.get('price', '')
-        ))
-        DB_CONN.commit()
+            ride.get('price', ''),
+            int(get_deletion_time(ride).timestamp()),
+            departure_start,
+            departure_end,
+            from_loc_id,
+            to_loc_id
+        )).lastrowid
+        if CHANNEL_MODE == "digest":
+            enqueue_post(conn, f"publish:{query.id}", GROUP_CHAT_ID, ride_id, payload, status='digest')
+            mark_digest_dirty(conn, ride['date'], from_loc_id, to_loc_id)
+        else:
+            enqueue_post(conn, f"publish:{query.id}", GROUP_CHAT_ID, ride_id, payload)
+
+    try:
+        await DB.transaction(insert)
+    except sqlite3.IntegrityError:
+        # Тот же апдейт пришёл повторно — поездка уже в очереди
+        logger.info(f"Повторная публикация {query.id} пропущена")
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Ошибка публикации: {e}", exc_info=True)
+        await query.edit_message_text("❌ Ошибка при публикации. Попробуйте ещё раз.")
+        return ConversationHandler.END
 
-        deletion_dt = get_deletion_time(ride)
-        now = datetime.now(TZ)
-        delay = max(1, (deletion_dt - now).total_seconds())
+    publisher = context.bot_data.get('digest' if CHANNEL_MODE == "digest" else 'outbox_relay')
+    if publisher is not None:
+        publisher.wake()
+    await query.edit_message_text("⏳ Объявление поставлено в очередь на публикацию...")
+    return ConversationHandler.END
 
-        context.job_queue.run_once(
-            delete_single_ride_job,
-            delay,
-            data={'ride_id': c.lastrowid, 'message_id': sent.message_id}
-        )
+async def send_outbox_post(bot, entry):
+    if entry.kind == 'edit':
+        return await edit_channel_post(bot, entry.ride_id)
+    return await bot.send_message(
+        chat_id=entry.chat_id,
+        text=entry.payload['text'],
+        parse_mode=ParseMode.HTML
+    )
 
-        await query.edit_message_text(
+async def outbox_post_sent(bot, entry, message_id: int):
+    chat_id, status_message_id = entry.payload['status']
+    try:
+        await bot.edit_message_text(
             "✅ Объявление опубликовано в канале - @poputchik_asino.\n\n"
-            "Для создания новой поездки нажмите МЕНЮ - Создать поездку или /start"
+            "Для создания новой поездки нажмите МЕНЮ - Создать поездку или /start",
+            chat_id=chat_id, message_id=status_message_id,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✏️ Изменить", callback_data=f"edit_{entry.ride_id}")]])
         )
     except Exception as e:
-        logger.error(f"Ошибка публикации: {e}", exc_info=True)
-        await query.edit_message_text("❌ Ошибка при публикации. Проверьте данные.")
+        logger.warning(f"Не удалось обновить статус публикации: {e}")
+    ride = entry.payload['ride']
+    # Записи outbox, поставленные до появления id мест в payload
+    ride.setdefault('from_loc_id', PLACES.location_id(ride['from']))
+    ride.setdefault('to_loc_id', PLACES.location_id(ride['to']))
+    await notify_subscribers(bot, entry.payload['user_id'], ride, message_id)
+
+async def outbox_post_failed(bot, entry, error: Exception):
+    if entry.kind == 'edit':
+        logger.warning(f"Не удалось обновить объявление поездки {entry.ride_id}: {error}")
+        return
+    logger.error(f"Ошибка публикации: {error}", exc_info=error)
+    chat_id, status_message_id = entry.payload['status']
+    try:
+        await bot.edit_message_text(
+            "❌ Ошибка при публикации. Проверьте данные.", chat_id=chat_id, message_id=status_message_id
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось обновить статус публикации: {e}")
+
+async def delete_channel_post(bot, chat_id: int, message_id: int):
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.warning(f"Не удалось удалить сообщение {message_id}: {e}")
+
+# === РЕДАКТИРОВАНИЕ ПОЕЗДОК ===
+RIDE_COLUMNS = "id, user_id, message_id, role, from_loc, to_loc, date, time_slot, seats, comment, contact, username, price"
+
+def ride_from_row(row) -> dict:
+    return {
+        'role': row['role'],
+        'from': row['from_loc'],
+        'to': row['to_loc'],
+        'date': row['date'],
+        'time': row['time_slot'],
+        'seats': row['seats'],
+        'comment': row['comment'] or "",
+        'contact': row['contact'],
+        'username': row['username'],
+        'price': row['price'] or "",
+    }
+
+def edit_target(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    # Черновик правится прямо в user_data['ride'], опубликованная поездка — в своей копии
+    edit = context.user_data['edit']
+    return edit['ride'] if edit.get('message_id') else context.user_data['ride']
+
+async def my_rides(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = await DB.fetchall(
+        f"SELECT {RIDE_COLUMNS} FROM rides WHERE user_id = ? AND message_id IS NOT NULL "
+        "ORDER BY departure_start, id LIMIT ?",
+        (update.effective_user.id, MY_RIDES_LIMIT)
+    )
+    if not rows:
+        await update.message.reply_text("У вас нет опубликованных поездок.\n\nСоздать поездку - /start")
+        return
+    buttons = [
+        [InlineKeyboardButton(
+            f"✏️ {datetime.fromisoformat(row['date']).strftime('%d.%m')} {row['time_slot']}, {row['from_loc']} — {row['to_loc']}",
+            callback_data=f"edit_{row['id']}"
+        )]
+        for row in rows
+    ]
+    await update.message.reply_text("Ваши поездки в канале. Какую изменить?", reply_markup=InlineKeyboardMarkup(buttons))
 
+async def edit_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    # В режиме сводки у нескольких поездок один message_id, поэтому в кнопке — id поездки
+    ride_id = int(query.data.split("_")[1])
+    row = await DB.fetchone(
+        f"SELECT {RIDE_COLUMNS} FROM rides WHERE id = ? AND user_id = ? AND message_id IS NOT NULL",
+        (ride_id, update.effective_user.id)
+    )
+    if row is None:
+        await query.edit_message_text("❌ Объявление не найдено или уже снято с публикации.")
+        return ConversationHandler.END
+    context.user_data['edit'] = {'id': row['id'], 'message_id': row['message_id'], 'ride': ride_from_row(row)}
+    await show_edit_menu(query, context)
+    return EDIT_FIELD
+
+async def show_edit_menu(update_or_query, context: ContextTypes.DEFAULT_TYPE, note: str = ""):
+    ride = edit_target(context)
+    text = (f"{note}\n\n" if note else "") + build_message(ride) + "\n\n<b>Что изменить?</b>"
+    reply_markup = EDIT_KEYBOARDS[ride['role']]
+    if isinstance(update_or_query, Update):
+        await update_or_query.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    else:
+        await update_or_query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+async def edit_field_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    field = query.data.split("_", 1)[1]
+    ride = edit_target(context)
+
+    if field == "time":
+        selected_date = datetime.fromisoformat(ride['date']).date()
+        await query.edit_message_text("🕗 Выберите время:", reply_markup=get_time_slots(selected_date))
+        return EDIT_TIME
+    elif field == "seats":
+        reply_markup = DRIVER_SEATS_KEYBOARD if ride['role'] == 'driver' else PASSENGER_SEATS_KEYBOARD
+        await query.edit_message_text("👤 Сколько мест?", reply_markup=reply_markup)
+        return EDIT_SEATS
+    elif field == "price" and ride['role'] == 'driver':
+        await query.edit_message_text("💰 Выберите цену за поездку:", reply_markup=PRICE_KEYBOARD)
+        return EDIT_PRICE
+    elif field == "comment":
+        await query.edit_message_text("💬 Напишите новый комментарий:", reply_markup=REMOVE_COMMENT_KEYBOARD)
+        return EDIT_COMMENT
+
+    # Готово
+    if not context.user_data['edit'].get('message_id'):
+        await show_preview_callback(query, context)
+        return CONTACT_PHONE
+    await query.edit_message_text("✅ Изменения сохранены.\n\nВаши поездки - /my")
     return ConversationHandler.END
 
-async def delete_single_ride_job(context: ContextTypes.DEFAULT_TYPE):
-    data = context.job.data
+async def edit_time_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.data == "time_manual":
+        await query.edit_message_text("🕗 Укажите желаемое время:")
+        return EDIT_MANUAL_TIME
+    _, start_time, end_time = query.data.split("_")
+    edit_target(context)['time'] = f"{start_time} - {end_time}"
+    return await apply_edit(update, context)
+
+async def edit_manual_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if not text:
+        await update.message.reply_text("🕗 Введите хотя бы что-нибудь:")
+        return EDIT_MANUAL_TIME
+    edit_target(context)['time'] = text
+    return await apply_edit(update, context)
+
+async def edit_price_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.data == "price_manual":
+        await query.edit_message_text("💰 Введите цену (только цифры):")
+        return EDIT_PRICE
+    if query.data.startswith("price_text_"):
+        edit_target(context)['price'] = query.data.split("price_text_", 1)[1]
+    else:
+        edit_target(context)['price'] = str(int(query.data.split("_", 1)[1]))
+    return await apply_edit(update, context)
+
+async def edit_manual_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    error = price_input_error(text)
+    if error:
+        await update.message.reply_text(error)
+        return EDIT_PRICE
+    edit_target(context)['price'] = str(int(text))
+    return await apply_edit(update, context)
+
+async def edit_seats_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    edit_target(context)['seats'] = int(query.data.split("_")[1])
+    return await apply_edit(update, context)
+
+async def edit_comment_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    edit_target(context)['comment'] = update.message.text.strip()[:200]
+    return await apply_edit(update, context)
+
+async def edit_remove_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    edit_target(context)['comment'] = ""
+    return await apply_edit(update, context)
+
+async def apply_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    target = update.callback_query or update
+    edit = context.user_data['edit']
+    if not edit.get('message_id'):
+        # Черновик: возвращаемся к предпросмотру
+        if update.callback_query:
+            await show_preview_callback(update.callback_query, context)
+        else:
+            await show_preview_message(update, context)
+        return CONTACT_PHONE
+
+    ride = edit['ride']
+    departure_start, departure_end = get_departure_window(ride)
+    params = (
+        ride['time'], ride['seats'], ride['price'], ride['comment'],
+        int(get_deletion_time(ride).timestamp()), departure_start, departure_end,
+        edit['id'], update.effective_user.id
+    )
+    new_key = (ride['date'], PLACES.location_id(ride['from']), PLACES.location_id(ride['to']))
+
+    def update_ride(conn):
+        old = conn.execute(
+            "SELECT date, from_loc_id, to_loc_id, "
+            "EXISTS (SELECT 1 FROM digests WHERE digests.message_id = rides.message_id) "
+            "FROM rides WHERE id = ? AND user_id = ? AND message_id IS NOT NULL",
+            (edit['id'], update.effective_user.id)
+        ).fetchone()
+        if old is None:
+            return False
+        # Время удаления и окно отправления пересчитываются вместе со временем поездки
+        conn.execute(
+            "UPDATE rides SET time_slot = ?, seats = ?, price = ?, comment = ?, "
+            "delete_at = ?, departure_start = ?, departure_end = ? "
+            "WHERE id = ? AND user_id = ?",
+            params
+        )
+        # Пост обновляет публикатор, и одной транзакцией с правкой: перезапуск её не потеряет
+        if old[3]:
+            for key in {tuple(old[:3]), new_key}:
+                mark_digest_dirty(conn, *key)
+        else:
+            enqueue_edit(conn, GROUP_CHAT_ID, edit['id'], EDIT_DEBOUNCE)
+        return True
+
+    if not await DB.transaction(update_ride):
+        await (target.edit_message_text if update.callback_query else update.message.reply_text)(
+            "❌ Объявление уже снято с публикации."
+        )
+        return ConversationHandler.END
+
+    await show_edit_menu(target, context, note="✅ Сохранено, объявление в канале скоро обновится.")
+    return EDIT_FIELD
+
+async def edit_channel_post(bot, ride_id: int):
+    # Текст строится из базы в момент отправки: все правки за окно — одним вызовом
+    row = await DB.fetchone(f"SELECT {RIDE_COLUMNS} FROM rides WHERE id = ?", (ride_id,))
+    if row is None or row['message_id'] is None:
+        return None
     try:
-        await context.bot.delete_message(chat_id=GROUP_CHAT_ID, message_id=data['message_id'])
-    except Exception:
-        pass
-    c = DB_CONN.cursor()
-    c.execute("DELETE FROM rides WHERE id = ?", (data['ride_id'],))
-    DB_CONN.commit()
+        return await bot.edit_message_text(
+            build_message(ride_from_row(row)), chat_id=GROUP_CHAT_ID,
+            message_id=row['message_id'], parse_mode=ParseMode.HTML
+        )
+    except BadRequest as e:
+        # Правки вернули текст к уже опубликованному
+        if "not modified" in str(e).lower():
+            return None
+        raise
+
+def edit_states() -> dict:
+    # Новые объекты на каждый вызов: одни и те же состояния есть в двух разговорах,
+    # а instrument() оборачивает callback каждого обработчика
+    return {
+        EDIT_FIELD: [CallbackQueryHandler(edit_field_selected, pattern=r"^efield_(time|seats|price|comment|done)$")],
+        EDIT_TIME: [CallbackQueryHandler(edit_time_selected, pattern=r"^time_(manual|\d\d:00_\d\d:00)$")],
+        EDIT_MANUAL_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_manual_time_input)],
+        EDIT_PRICE: [
+            CallbackQueryHandler(edit_price_selected, pattern=r"^price_(text_.+|manual|\d+)$"),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, edit_manual_price_input)
+        ],
+        EDIT_SEATS: [CallbackQueryHandler(edit_seats_selected, pattern=r"^seats_\d+$")],
+        EDIT_COMMENT: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, edit_comment_input),
+            CallbackQueryHandler(edit_remove_comment, pattern=r"^skip_comment$")
+        ]
+    }
+
+# === СВОДКА В КАНАЛЕ (CHANNEL_MODE=digest) ===
+DIGEST_FOOTER = "Создать поездку - @poputchik_asino_bot"
+
+def build_digest_line(row) -> str:
+    role_emoji = "🚗" if row['role'] == 'driver' else "👤"
+    line = f"{role_emoji} <b>{escape_html(row['time_slot'])}</b>, мест: {row['seats']}"
+    if row['role'] == 'driver' and row['price']:
+        line += ", по цене билета" if row['price'] == "По цене билета" else f", {escape_html(row['price'])} ₽"
+    if row['contact'] == "PM":
+        line += f"\n📩 @{escape_html(row['username'])}" if row['username'] else "\n📩 Писать в личку"
+    else:
+        line += f"\n📞 {format_phone(row['contact'])}"
+    if row['comment']:
+        line += f"\n💬 {escape_html(row['comment'])}"
+    return line
+
+async def load_digest(date: str, from_loc_id: str, to_loc_id: str):
+    # Поездки, которые ещё не опубликованы или уже в сводке; отдельные посты
+    # (опубликованные до включения режима) живут своей жизнью до удаления
+    rows = await DB.fetchall(
+        "SELECT id, role, from_loc, to_loc, time_slot, seats, price, contact, username, comment FROM rides "
+        "WHERE role IN ('driver', 'passenger') AND from_loc_id = ? AND to_loc_id = ? AND date = ? "
+        "AND (message_id IS NULL OR EXISTS (SELECT 1 FROM digests WHERE digests.message_id = rides.message_id)) "
+        "ORDER BY departure_start, id",
+        (from_loc_id, to_loc_id, date)
+    )
+    if not rows:
+        return "", []
+    date_str = datetime.fromisoformat(date).strftime("%d.%m.%Y")
+    header = f"📅 <b>{date_str}: {escape_html(rows[0]['from_loc'])} — {escape_html(rows[0]['to_loc'])}</b>"
+    return header, [(row['id'], build_digest_line(row)) for row in rows]
+
+async def send_digest_post(bot, text: str):
+    return await bot.send_message(
+        chat_id=GROUP_CHAT_ID, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True
+    )
+
+async def edit_digest_post(bot, message_id: int, text: str):
+    try:
+        return await bot.edit_message_text(
+            text, chat_id=GROUP_CHAT_ID, message_id=message_id,
+            parse_mode=ParseMode.HTML, disable_web_page_preview=True
+        )
+    except BadRequest as e:
+        # Текст уже такой (правка дошла, а запись о ней — нет) — это успех
+        if "not modified" in str(e).lower():
+            return None
+        raise
+
+async def digest_rides_published(bot, ride_ids: list, message_id: int):
+    # Впервые попавшие в сводку поездки: статус автору и уведомления подписчикам, как при отдельном посте
+    placeholders = ", ".join("?" * len(ride_ids))
+    rows = await DB.fetchall(
+        f"SELECT id, key, kind, chat_id, ride_id, payload, attempts, version FROM outbox "
+        f"WHERE status = 'digest' AND ride_id IN ({placeholders})",
+        ride_ids
+    )
+    if not rows:
+        return
+    await DB.executemany(
+        "UPDATE outbox SET status = 'sent', message_id = ? WHERE id = ?",
+        [(message_id, row['id']) for row in rows]
+    )
+    for row in rows:
+        await outbox_post_sent(bot, OutboxEntry(row), message_id)
+
+# === УДАЛЕНИЕ ПРОСРОЧЕННЫХ ПОЕЗДОК ===
+async def sweep_expired_rides(context: ContextTypes.DEFAULT_TYPE):
+    now = int(datetime.now(TZ).timestamp())
+    pending = await DB.fetchone("SELECT COUNT(*) FROM rides WHERE delete_at IS NOT NULL")
+    PENDING_DELETIONS.set(pending[0])
+    rows = await DB.fetchall(
+        "SELECT id, message_id, date, from_loc_id, to_loc_id, "
+        "EXISTS (SELECT 1 FROM digests WHERE digests.message_id = rides.message_id) AS in_digest "
+        "FROM rides WHERE delete_at <= ? ORDER BY delete_at LIMIT ?",
+        (now, SWEEP_LIMIT)
+    )
+    if not rows:
+        return
+
+    # Пост сводки общий — его не удаляем, а перерисовываем без просроченных поездок
+    message_ids = [row['message_id'] for row in rows if row['message_id'] and not row['in_digest']]
+    digest_keys = {(row['date'], row['from_loc_id'], row['to_loc_id']) for row in rows if row['in_digest']}
+    for i in range(0, len(message_ids), DELETE_BATCH):
+        chunk = message_ids[i:i + DELETE_BATCH]
+        try:
+            await context.bot.delete_messages(chat_id=GROUP_CHAT_ID, message_ids=chunk)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить сообщения {chunk}: {e}")
+
+    def remove(conn):
+        conn.executemany("DELETE FROM rides WHERE id = ?", [(row['id'],) for row in rows])
+        for key in digest_keys:
+            mark_digest_dirty(conn, *key)
+
+    await DB.transaction(remove)
+
+    if len(rows) == SWEEP_LIMIT:
+        # Остались ещё просроченные — продолжаем сразу, не дожидаясь интервала
+        context.job_queue.run_once(sweep_expired_rides, 0)
+
+async def backfill_rides():
+    # Старые записи без delete_at / времени отправления / id мест: считаем так же, как при публикации
+    rows = await DB.fetchall(
+        "SELECT id, date, time_slot, from_loc, to_loc FROM rides "
+        "WHERE delete_at IS NULL OR departure_start IS NULL OR from_loc_id IS NULL"
+    )
+    if rows:
+        params = []
+        for row in rows:
+            ride = {'date': row['date'], 'time': row['time_slot']}
+            departure_start, departure_end = get_departure_window(ride)
+            params.append((
+                int(get_deletion_time(ride).timestamp()), departure_start, departure_end,
+                PLACES.location_id(row['from_loc'] or ""), PLACES.location_id(row['to_loc'] or ""), row['id']
+            ))
+        await DB.executemany(
+            "UPDATE rides SET delete_at = COALESCE(delete_at, ?), departure_start = ?, departure_end = ?, "
+            "from_loc_id = ?, to_loc_id = ? WHERE id = ?",
+            params
+        )
+        logger.info(f"Дополнены данные для {len(rows)} поездок")
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Отменено.")
     return ConversationHandler.END
 
+# === АНТИФЛУД ===
+async def throttle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Группа -1: срабатывает раньше всех обработчиков и останавливает лишние апдейты
+    user = update.effective_user
+    if update.message:
+        kind = "message"
+    elif update.callback_query:
+        kind = "callback_query"
+    else:
+        return
+    if user is None:
+        return
+
+    allowed, warn = THROTTLER.check(user.id, kind)
+    if allowed:
+        return
+    if warn:
+        try:
+            if update.message:
+                await update.message.reply_text(FLOOD_WARNING)
+            else:
+                await update.callback_query.answer(FLOOD_WARNING)
+        except BadRequest:
+            pass
+    raise ApplicationHandlerStop
+
 # === КОМАНДА /info ===
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
@@ -591,39 +1255,412 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "     → <code>вечером, после работы</code>\n"
         "6. Водители укажут цену, пассажиры — сколько нужно мест.\n"
         "7. Оставьте комментарий (по желанию) и укажите контакт.\n\n"
-        "<b>Готово!</b> Ваше объявление появится в канале @poputchik_asino."
+        "<b>Готово!</b> Ваше объявление появится в канале @poputchik_asino.\n"
+        "Изменить время, места, цену или комментарий — /my"
     )
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=BACK_KEYBOARD)
 
 # === КНОПКА "НАЗАД" ===
 async def back_to_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    keyboard = [
-        [InlineKeyboardButton("🚗 Я водитель", callback_data="role_driver")],
-        [InlineKeyboardButton("👤 Я пассажир", callback_data="role_passenger")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(
         "Все поездки публикуются в канале: @poputchik_asino\n\n"
         "Как создать поездку: нажмите МЕНЮ - Инструкция или /info\n\n"
         "Вы водитель или пассажир?",
-        reply_markup=reply_markup
+        reply_markup=ROLE_KEYBOARD
     )
 
+# === ПОИСК ПОЕЗДОК /find ===
+async def find_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['find'] = {}
+    await update.message.reply_text("🔎 Кого ищете?", reply_markup=FIND_ROLE_KEYBOARD)
+    return FIND_ROLE
+
+async def find_role_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    context.user_data['find']['role'] = query.data.split("_", 1)[1]
+    await query.edit_message_text("📍 Выберите маршрут:", reply_markup=FIND_ROUTE_KEYBOARD)
+    return FIND_ROUTE
+
+async def find_route_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+
+    if data == "froute_asino_tomsk":
+        context.user_data['find'].update({'from': "Асино", 'to': "Томск"})
+    elif data == "froute_tomsk_asino":
+        context.user_data['find'].update({'from': "Томск", 'to': "Асино"})
+    else:
+        await query.edit_message_text("📍 Откуда?")
+        return FIND_FROM
+
+    await query.edit_message_text("📅 На какую дату?", reply_markup=get_date_slots("fdate_"))
+    return FIND_DATE
+
+async def find_from_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await ask_location(update, context.user_data['find'], 'from', "floc_from_"):
+        return FIND_FROM
+    await update.message.reply_text("📍 Куда?")
+    return FIND_TO
+
+async def find_from_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = await apply_location_choice(update, context.user_data['find'], 'from', "floc_from_")
+    await query.edit_message_text("📍 Куда?")
+    return FIND_TO
+
+async def find_to_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await ask_location(update, context.user_data['find'], 'to', "floc_to_"):
+        return FIND_TO
+    await update.message.reply_text("📅 На какую дату?", reply_markup=get_date_slots("fdate_"))
+    return FIND_DATE
+
+async def find_to_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = await apply_location_choice(update, context.user_data['find'], 'to', "floc_to_")
+    await query.edit_message_text("📅 На какую дату?", reply_markup=get_date_slots("fdate_"))
+    return FIND_DATE
+
+async def find_date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    context.user_data['find']['date'] = query.data.split("_", 1)[1]
+    await query.edit_message_text("🕗 Когда выезд?", reply_markup=FIND_TIME_KEYBOARD)
+    return FIND_TIME
+
+async def find_time_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    find = context.user_data['find']
+    window = FIND_WINDOWS.get(query.data.split("_", 1)[1], FIND_WINDOWS["any"])
+
+    day_start = TZ.localize(datetime.combine(datetime.fromisoformat(find['date']).date(), datetime.min.time()))
+    find['range'] = (
+        int((day_start + timedelta(hours=window[1])).timestamp()),
+        int((day_start + timedelta(hours=window[2])).timestamp())
+    )
+    await show_find_page(query, find, cursor=(0, 0))
+    return FIND_RESULTS
+
+async def find_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, departure_start, ride_id = query.data.split("_")
+    await show_find_page(query, context.user_data['find'], cursor=(int(departure_start), int(ride_id)))
+    return FIND_RESULTS
+
+async def search_rides(role: str, from_loc: str, to_loc: str, range_start: int, range_end: int,
+                       cursor: tuple, limit: int) -> list:
+    # Маршрут сравнивается по id мест из справочника, а не по введённому тексту.
+    # Keyset-пагинация по (departure_start, id): идём по индексу маршрута без OFFSET
+    return await DB.fetchall('''
+        SELECT id, from_loc, to_loc, date, time_slot, seats, price, message_id, departure_start
+        FROM rides
+        WHERE role = ? AND from_loc_id = ? AND to_loc_id = ?
+          AND departure_start >= ? AND departure_start < ?
+          AND message_id IS NOT NULL
+          AND (departure_start, id) > (?, ?)
+        ORDER BY departure_start, id
+        LIMIT ?
+    ''', (role, PLACES.location_id(from_loc), PLACES.location_id(to_loc), range_start, range_end, cursor[0], cursor[1], limit))
+
+async def show_find_page(query, find: dict, cursor: tuple):
+    rows = await search_rides(find['role'], find['from'], find['to'], *find['range'], cursor, FIND_PAGE_SIZE + 1)
+    has_more = len(rows) > FIND_PAGE_SIZE
+    rows = rows[:FIND_PAGE_SIZE]
+
+    buttons = []
+    if has_more:
+        last = rows[-1]
+        buttons.append([InlineKeyboardButton("➡️ Дальше", callback_data=f"fpage_{last['departure_start']}_{last['id']}")])
+    buttons.append([InlineKeyboardButton("🔔 Сообщать о новых", callback_data="fsub")])
+    reply_markup = InlineKeyboardMarkup(buttons)
+
+    if not rows:
+        text = "😔 Ничего не найдено." if cursor == (0, 0) else "Больше поездок нет."
+        await query.edit_message_text(text + "\n\nНовый поиск - /find", reply_markup=reply_markup)
+        return
+
+    role_title = "Водители" if find['role'] == 'driver' else "Пассажиры"
+    lines = [f"<b>{role_title}: {escape_html(find['from'])} — {escape_html(find['to'])}</b>\n"]
+    for row in rows:
+        date_str = datetime.fromisoformat(row['date']).strftime("%d.%m")
+        line = f"🕗 {date_str} {escape_html(row['time_slot'])}, мест: {row['seats']}"
+        if find['role'] == 'driver' and row['price']:
+            price = row['price'] if row['price'] == "По цене билета" else f"{row['price']} ₽"
+            line += f", {escape_html(price)}"
+        line += f' — {ride_link(row["message_id"])}'
+        lines.append(line)
+
+    await query.edit_message_text(
+        "\n".join(lines), parse_mode=ParseMode.HTML,
+        reply_markup=reply_markup, disable_web_page_preview=True
+    )
+
+def ride_link(message_id: int) -> str:
+    return f'<a href="https://t.me/{CHANNEL_USERNAME}/{message_id}">объявление</a>'
+
+# === ПОДПИСКИ НА НОВЫЕ ПОЕЗДКИ ===
+async def find_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    find = context.user_data.get('find', {})
+    if not all(k in find for k in ('role', 'from', 'to', 'date')):
+        await query.answer("Начните поиск заново: /find")
+        return ConversationHandler.END
+    added = await SUBSCRIPTIONS.add(update.effective_user.id, find['role'], find['from'], find['to'], find['date'])
+    date_str = datetime.fromisoformat(find['date']).strftime("%d.%m")
+    if added:
+        await query.answer(f"🔔 Сообщим о новых поездках {find['from']} — {find['to']} на {date_str}", show_alert=True)
+    else:
+        await query.answer("Вы уже подписаны на этот маршрут")
+    return FIND_RESULTS
+
+async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    removed = await SUBSCRIPTIONS.remove_user(update.effective_user.id)
+    await update.message.reply_text("🔕 Подписки отменены." if removed else "У вас нет подписок.")
+
+async def unsubscribe_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await SUBSCRIPTIONS.remove_user(update.effective_user.id)
+    await query.answer("🔕 Подписки отменены")
+    await query.edit_message_reply_markup(reply_markup=None)
+
+async def notify_subscribers(bot, publisher_id: int, ride: dict, message_id: int):
+    if SHARDS > 1:
+        # Подписки оформляют пользователи всех воркеров — индекс в памяти видит только свои
+        subscribers = await SUBSCRIPTIONS.fetch(ride['role'], ride['from_loc_id'], ride['to_loc_id'], ride['date'])
+    else:
+        subscribers = SUBSCRIPTIONS.match(ride['role'], ride['from_loc_id'], ride['to_loc_id'], ride['date'])
+    subscribers -= {publisher_id}
+    if not subscribers:
+        return
+    role_title = "водитель" if ride['role'] == 'driver' else "пассажир"
+    date_str = datetime.fromisoformat(ride['date']).strftime("%d.%m")
+    text = (
+        f"🔔 Новый {role_title}: {escape_html(ride['from'])} — {escape_html(ride['to'])}, "
+        f"{date_str}, {escape_html(ride['time'])}\n{ride_link(message_id)}"
+    )
+
+    async def send_one(user_id):
+        await bot.send_message(
+            chat_id=user_id, text=text, parse_mode=ParseMode.HTML,
+            reply_markup=UNSUBSCRIBE_KEYBOARD, disable_web_page_preview=True
+        )
+
+    FANOUT.send(subscribers, send_one)
+
+async def prune_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    await SUBSCRIPTIONS.prune(datetime.now(TZ).date().isoformat())
+
+# === ПРОФИЛИРОВАНИЕ /profile ===
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /profile on [доля] [порог_мс] | off | stats
+    await update.message.reply_text(PROFILER.command(context.args))
+
+# === МЕТРИКИ ===
+class MetricsRequest(HTTPXRequest):
+    """HTTP-клиент бота, записывающий длительность и ошибки каждого вызова Bot API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        with API_LATENCY.time(name):
+            try:
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+            except Exception:
+                API_ERRORS.inc(name)
+                raise
+        if code == 429:
+            API_RETRY_AFTER.inc(name)
+        if code >= 400:
+            API_ERRORS.inc(name)
+        return code, payload
+
+def instrument(handler, state: str = "-"):
+    # Оборачивает callback обработчика (и всех вложенных в ConversationHandler) замером времени;
+    # состояние разговора известно заранее — это ключ, под которым обработчик зарегистрирован
+    if isinstance(handler, ConversationHandler):
+        for h in handler.entry_points:
+            instrument(h, "entry")
+        for h in handler.fallbacks:
+            instrument(h, "fallback")
+        for key, state_handlers in handler.states.items():
+            for h in state_handlers:
+                instrument(h, STATE_NAMES.get(key, str(key)))
+        return
+
+    callback = handler.callback
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        UPDATES.inc(name)
+        with HANDLER_LATENCY.time(name):
+            try:
+                if PROFILER.enabled:
+                    return await PROFILER.run(name, state, lambda: callback(update, context))
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                raise
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+
+    handler.callback = timed
+
+def register_gauges(application: Application):
+    REGISTRY.gauge("poput_sessions", "Пользователи с данными в памяти", fn=lambda: len(application.user_data))
+    REGISTRY.gauge("poput_conversations", "Незавершённые разговоры", fn=lambda: application.persistence.conversation_count())
+    REGISTRY.gauge("poput_publish_pending", "Поездки в очереди на публикацию", fn=lambda: PUBLISH_QUEUE.pending())
+    if IS_PUBLISHER:
+        REGISTRY.gauge("poput_outbox_pending", "Неотправленные записи outbox", fn=lambda: getattr(application.bot_data.get('outbox_relay'), 'pending', 0))
+    if IS_PUBLISHER and CHANNEL_MODE == "digest":
+        REGISTRY.gauge(
+            "poput_digests_pending", "Сводки, ждущие перерисовки",
+            fn=lambda: application.bot_data['digest'].pending() if 'digest' in application.bot_data else 0
+        )
+    REGISTRY.gauge("poput_subscriptions", "Активные подписки", fn=lambda: SUBSCRIPTIONS.count())
+    processor = application.update_processor
+    REGISTRY.gauge("poput_updates_in_flight", "Пользователи, чьи апдейты сейчас обрабатываются", fn=processor.users)
+    REGISTRY.gauge("poput_updates_waiting", "Апдейты, ждущие обработки предыдущих того же пользователя", fn=processor.backlog)
+
 # === ЗАПУСК ===
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application):
+    # До первого апдейта — только то, без чего его не обработать. База к этому моменту
+    # уже открыта и смигрирована: initialize() читает разговоры из persistence.
+    # Подписки грузим сразу: load() заменяет индекс целиком и затёр бы подписки, оформленные до него
+    await DB.start()
+    await SUBSCRIPTIONS.load()
+    application.job_queue.run_once(deferred_startup, when=STARTUP_DEFER)
+
+async def deferred_startup(context: ContextTypes.DEFAULT_TYPE):
+    # Всё остальное — после того, как бот начал отвечать; к этому времени
+    # первые апдейты (и накопившиеся за перезапуск) уже разобраны
+    application = context.application
+    if IS_PUBLISHER:
+        await start_publisher(application)
+    # Сервер метрик — последним: занятый порт не должен оставить бота без публикации
+    if not METRICS_PORT:
+        return
+    try:
+        application.bot_data['metrics_runner'] = await start_server(make_metrics_app(), METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        logger.error(f"Сервер метрик не запущен ({METRICS_HOST}:{METRICS_PORT}): {e}")
+
+async def start_publisher(application: Application):
+    await backfill_rides()
+    await SUBSCRIPTIONS.prune(datetime.now(TZ).date().isoformat())
+    relay = application.bot_data['outbox_relay'] = OutboxRelay(
+        DB, PUBLISH_QUEUE,
+        send=functools.partial(send_outbox_post, application.bot),
+        on_sent=functools.partial(outbox_post_sent, application.bot),
+        on_failed=functools.partial(outbox_post_failed, application.bot),
+        delete=functools.partial(delete_channel_post, application.bot)
+    )
+    relay.start()
+    if CHANNEL_MODE == "digest":
+        digest = application.bot_data['digest'] = ChannelDigest(
+            DB, PUBLISH_QUEUE, GROUP_CHAT_ID,
+            load=load_digest,
+            send=functools.partial(send_digest_post, application.bot),
+            edit=functools.partial(edit_digest_post, application.bot),
+            delete=functools.partial(delete_channel_post, application.bot, GROUP_CHAT_ID),
+            on_published=functools.partial(digest_rides_published, application.bot),
+            footer=DIGEST_FOOTER, delay=DIGEST_DELAY, limit=DIGEST_LIMIT
+        )
+        digest.start()
+    application.job_queue.run_repeating(sweep_expired_rides, interval=SWEEP_INTERVAL, first=0)
+    application.job_queue.run_repeating(prune_subscriptions, interval=60 * 60)
+
+async def post_shutdown(application: Application):
+    if 'metrics_runner' in application.bot_data:
+        await application.bot_data['metrics_runner'].cleanup()
+    # Сначала relay перестаёт брать новые записи, затем очередь досылает взятые;
+    # всё неотправленное остаётся в outbox до следующего запуска
+    if 'outbox_relay' in application.bot_data:
+        await application.bot_data['outbox_relay'].stop()
+    if 'digest' in application.bot_data:
+        await application.bot_data['digest'].stop()
+    await PUBLISH_QUEUE.stop()
+    await FANOUT.stop()
+    await DB.close()
+
+async def run_webhook(application: Application):
+    def enqueue(data):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    # Приложение собираем первым: без секрета бот не должен даже запускаться
+    app = make_webhook_app(WEBHOOK_PATH, WEBHOOK_SECRET, enqueue)
+    # Тот же порядок, что и в Application.run_polling
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    runner = await start_server(app, WEBHOOK_HOST, WEBHOOK_PORT)
+    await application.bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+async def run_shard(application: Application):
+    # Воркер многопроцессного режима: апдейты приходят от ингресса через unix-сокет
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+
+    async def put(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    server = await serve_shard(shard_socket(SHARD_SOCKET_DIR, SHARD_INDEX), put)
+    try:
+        await wait_for_stop()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+def build_application() -> Application:
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .persistence(SQLitePersistence(
+            DB, update_interval=PERSISTENCE_INTERVAL,
+            owns=(lambda user_id: shard_of(user_id, SHARDS) == SHARD_INDEX) if SHARD_INDEX is not None else None
+        ))
+        .request(MetricsRequest())
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    )
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL + "/bot").base_file_url(BOT_API_URL + "/file/bot")
+    if BOT_MODE in ("webhook", "sharded"):
+        # Ограниченная очередь: при переполнении вебхук отвечает 503
+        builder = builder.update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE))
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             SELECT_ROLE: [CallbackQueryHandler(role_selected, pattern=r"^role_")],
             SELECT_ROUTE: [CallbackQueryHandler(route_selected, pattern=r"^route_")],
-            FROM_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, from_location)],
-            TO_LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, to_location)],
+            FROM_LOCATION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, from_location),
+                CallbackQueryHandler(from_location_chosen, pattern=r"^loc_from_")
+            ],
+            TO_LOCATION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, to_location),
+                CallbackQueryHandler(to_location_chosen, pattern=r"^loc_to_")
+            ],
             SELECT_DATE: [CallbackQueryHandler(date_selected, pattern=r"^date_")],
             SELECT_TIME: [CallbackQueryHandler(time_selected, pattern=r"^time_")],
             MANUAL_TIME_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, manual_time_input)],
@@ -640,16 +1677,84 @@ def main():
             CONTACT_PHONE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, contact_phone_input),
                 CallbackQueryHandler(publish_decision, pattern=r"^publish_(yes|edit|cancel)$")
-            ]
+            ],
+            **edit_states()
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        per_user=True,
+        name="ride_conversation",
+        persistent=True
+    )
+
+    find_handler = ConversationHandler(
+        entry_points=[CommandHandler("find", find_start)],
+        states={
+            FIND_ROLE: [CallbackQueryHandler(find_role_selected, pattern=r"^frole_(driver|passenger)$")],
+            FIND_ROUTE: [CallbackQueryHandler(find_route_selected, pattern=r"^froute_")],
+            FIND_FROM: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, find_from_input),
+                CallbackQueryHandler(find_from_chosen, pattern=r"^floc_from_")
+            ],
+            FIND_TO: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, find_to_input),
+                CallbackQueryHandler(find_to_chosen, pattern=r"^floc_to_")
+            ],
+            FIND_DATE: [CallbackQueryHandler(find_date_selected, pattern=r"^fdate_")],
+            FIND_TIME: [CallbackQueryHandler(find_time_selected, pattern=r"^ftime_")],
+            FIND_RESULTS: [
+                CallbackQueryHandler(find_next_page, pattern=r"^fpage_\d+_\d+$"),
+                CallbackQueryHandler(find_subscribe, pattern=r"^fsub$")
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", cancel), CommandHandler("find", find_start)],
         per_user=True
     )
 
+    edit_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(edit_start, pattern=r"^edit_\d+$")],
+        states=edit_states(),
+        fallbacks=[CommandHandler("cancel", cancel)],
+        per_user=True,
+        allow_reentry=True,
+        name="edit_conversation",
+        persistent=True
+    )
+
+    application.add_handler(TypeHandler(Update, throttle), group=-1)
+    application.add_handler(CommandHandler("profile", profile_command, filters=filters.User(user_id=ADMIN_IDS)))
     application.add_handler(conv_handler)
+    application.add_handler(find_handler)
+    application.add_handler(edit_handler)
+    application.add_handler(CommandHandler("my", my_rides))
     application.add_handler(CommandHandler("info", info))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
+    application.add_handler(CallbackQueryHandler(unsubscribe_callback, pattern=r"^unsubscribe$"))
     application.add_handler(CallbackQueryHandler(back_to_start, pattern=r"^back_to_start$"))
-    application.run_polling()
+    for group in application.handlers.values():
+        for handler in group:
+            instrument(handler)
+    register_gauges(application)
+    return application
+
+def main():
+    if BOT_MODE == "sharded" and SHARD_INDEX is None:
+        asyncio.run(run_ingress(
+            shards=SHARDS, socket_dir=SHARD_SOCKET_DIR, token=BOT_TOKEN,
+            api_url=BOT_API_URL or "https://api.telegram.org",
+            webhook_url=WEBHOOK_URL, webhook_path=WEBHOOK_PATH, webhook_secret=WEBHOOK_SECRET,
+            webhook_host=WEBHOOK_HOST, webhook_port=WEBHOOK_PORT,
+            allowed_updates=Update.ALL_TYPES,
+            metrics_host=METRICS_HOST, metrics_port=METRICS_PORT, metrics_port_base=METRICS_PORT_BASE,
+            queue_size=WEBHOOK_QUEUE_SIZE
+        ))
+        return
+    application = build_application()
+    if SHARD_INDEX is not None:
+        asyncio.run(run_shard(application))
+    elif BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,48 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Debouncer:
+    """
+    Склеивает частые изменения одного объекта в один вызов.
+    - touch(key) планирует flush(key) через delay секунд; повторные touch
+      того же ключа до срабатывания ничего не добавляют.
+    - flush сам читает актуальное состояние (из базы), поэтому все изменения
+      за окно уходят одним вызовом Bot API.
+    - touch во время flush планирует следующий вызов: последнее изменение
+      не теряется.
+    """
+
+    def __init__(self, delay: float, flush):
+        """flush(key) — корутина, применяющая накопленные изменения."""
+        self.delay = delay
+        self.flush = flush
+        self._tasks = {}
+
+    def touch(self, key):
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def stop(self):
+        # Отложенное не выбрасываем: применяем сразу
+        keys = list(self._tasks)
+        for key in keys:
+            self._tasks.pop(key).cancel()
+        for key in keys:
+            await self._flush(key)
+
+    async def _run(self, key):
+        await asyncio.sleep(self.delay)
+        del self._tasks[key]
+        await self._flush(key)
+
+    async def _flush(self, key):
+        try:
+            await self.flush(key)
+        except Exception as e:
+            logger.error(f"Ошибка отложенного обновления {key}: {e}", exc_info=True)
@@ -0,0 +1,99 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict, deque
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize_text(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def simhash(text: str, shingle: int = 4) -> int:
+    """64-битный SimHash по символьным шинглам нормализованного текста."""
+    text = normalize_text(text)
+    if not text:
+        return 0
+    if len(text) <= shingle:
+        grams = [text]
+    else:
+        grams = [text[i:i + shingle] for i in range(len(text) - shingle + 1)]
+    weights = [0] * 64
+    for gram in grams:
+        h = int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class Fingerprint:
+    __slots__ = ("text_hash", "has_text", "photos", "created_at", "message_ids")
+
+    def __init__(self, text: str, photo_uids):
+        self.text_hash = simhash(text)
+        self.has_text = bool(normalize_text(text))
+        self.photos = frozenset(photo_uids)
+        self.created_at = time.time()
+        self.message_ids = []
+
+
+class DuplicateIndex:
+    """
+    Недавние объявления каждого пользователя для поиска повторов.
+    - Отпечаток: SimHash текста + множество file_unique_id фото.
+    - Повтор: тексты отличаются не больше чем на max_distance бит и фото
+      пересекаются (или их нет у обоих), либо совпадает непустой набор фото.
+    - Хранится окно window секунд, не больше per_user записей на пользователя
+      и max_users пользователей (вытесняются давно не публиковавшие).
+    """
+
+    def __init__(self, window: float = 24 * 60 * 60, max_distance: int = 8,
+                 per_user: int = 10, max_users: int = 10000):
+        self.window = window
+        self.max_distance = max_distance
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users = OrderedDict()    # user_id -> deque[Fingerprint]
+
+    def find(self, user_id: int, fingerprint: Fingerprint):
+        """Последний похожий отпечаток пользователя в окне или None."""
+        entries = self._users.get(user_id)
+        if not entries:
+            return None
+        self._expire(entries)
+        for entry in reversed(entries):
+            if self._similar(entry, fingerprint):
+                return entry
+        return None
+
+    def add(self, user_id: int, fingerprint: Fingerprint):
+        entries = self._users.get(user_id)
+        if entries is None:
+            entries = self._users[user_id] = deque(maxlen=self.per_user)
+        else:
+            self._users.move_to_end(user_id)
+            self._expire(entries)
+        entries.append(fingerprint)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def remove(self, user_id: int, fingerprint: Fingerprint):
+        entries = self._users.get(user_id)
+        if entries is not None and fingerprint in entries:
+            entries.remove(fingerprint)
+
+    def _expire(self, entries):
+        expired_before = time.time() - self.window
+        while entries and entries[0].created_at < expired_before:
+            entries.popleft()
+
+    def _similar(self, a: Fingerprint, b: Fingerprint) -> bool:
+        if a.photos and a.photos == b.photos:
+            return True
+        if a.has_text != b.has_text:
+            return False
+        if a.has_text and bin(a.text_hash ^ b.text_hash).count("1") > self.max_distance:
+            return False
+        return a.photos & b.photos or not (a.photos or b.photos)
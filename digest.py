@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+
+from debounce import Debouncer
+from publish_queue import PublishQueue
+from rides_db import RidesDB
+
+logger = logging.getLogger(__name__)
+
+
+def mark_dirty(conn, date: str, from_loc_id: str, to_loc_id: str):
+    """
+    Помечает сводку (дата, маршрут) к перерисовке. Вызывается внутри
+    RidesDB.transaction вместе с изменением поездки: пометка переживает
+    перезапуск и видна процессу-публикатору из любого воркера. Снимается
+    только после удачной перерисовки; version растёт с каждой пометкой,
+    чтобы не снять пометку, поставленную уже во время перерисовки.
+    """
+    conn.execute(
+        "INSERT INTO digest_dirty (date, from_loc_id, to_loc_id, version) VALUES (?, ?, ?, 1) "
+        "ON CONFLICT (date, from_loc_id, to_loc_id) DO UPDATE SET version = version + 1",
+        (date, from_loc_id, to_loc_id)
+    )
+
+
+def split_parts(header: str, lines: list, footer: str, limit: int) -> list:
+    """
+    Раскладывает строки сводки по постам не длиннее limit символов.
+    lines — [(ride_id, текст)]; возвращает [(текст поста, [ride_id])].
+    """
+    def head(index):
+        return header if index == 0 else f"{header} (продолжение)"
+
+    def compose(index, body):
+        return "\n\n".join(part for part in (head(index), "\n\n".join(body), footer) if part)
+
+    parts = []
+    body, ride_ids = [], []
+    size = len(compose(0, []))
+    for ride_id, line in lines:
+        if body and size + len(line) + 2 > limit:
+            parts.append((compose(len(parts), body), ride_ids))
+            body, ride_ids = [], []
+            size = len(compose(len(parts), []))
+        body.append(line[:limit - size - 2])
+        ride_ids.append(ride_id)
+        size += len(body[-1]) + 2
+    if body:
+        parts.append((compose(len(parts), body), ride_ids))
+    return parts
+
+
+class ChannelDigest:
+    """
+    Сводка поездок в канале: один пост на (дату, маршрут) вместо поста на поездку.
+    - Изменения поездок помечают сводку через mark_dirty; раз в interval секунд
+      (или сразу после wake()) помеченные сводки забираются из базы, и каждая
+      перерисовывается не чаще раза в delay секунд, сколько бы поездок в ней
+      ни поменялось.
+    - Перерисовка строит текст из базы и правит только изменившиеся посты:
+      новый пост — sendMessage, изменившийся — editMessageText, лишний — удаление.
+      Длинная сводка делится на несколько постов не длиннее limit.
+    - Пост -> message_id хранится в таблице digests; у поездок message_id —
+      пост сводки, в котором они перечислены (для ссылок из поиска).
+    Вызовы к каналу идут через PublishQueue. Пометка остаётся в базе до
+    удачной перерисовки: после сбоя или перезапуска сводка перерисуется снова.
+    """
+
+    def __init__(self, db: RidesDB, publish_queue: PublishQueue, chat_id: int, load, send, edit, delete,
+                 on_published=None, footer: str = "", delay: float = 5, interval: float = 1.0, limit: int = 3800):
+        """
+        load(date, from_loc_id, to_loc_id) — корутина, возвращает (заголовок, [(ride_id, строка)])
+        в порядке вывода; пустой список — сводку пора убрать.
+        send(text) / edit(message_id, text) / delete(message_id) — корутины вызовов Bot API.
+        on_published(ride_ids, message_id) — корутина, вызывается для поездок, чей пост сменился.
+        """
+        self.db = db
+        self.publish_queue = publish_queue
+        self.chat_id = chat_id
+        self.load = load
+        self.send = send
+        self.edit = edit
+        self.delete = delete
+        self.on_published = on_published
+        self.footer = footer
+        self.interval = interval
+        self.limit = limit
+        self._renders = Debouncer(delay, self.render)
+        self._rendering = set()
+        self._again = set()
+        self._seen = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="channel-digest")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._renders.stop()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def pending(self) -> int:
+        return self._renders.pending()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Сбой сводки: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def poll(self):
+        rows = await self.db.fetchall("SELECT date, from_loc_id, to_loc_id, version FROM digest_dirty")
+        marked = {(row['date'], row['from_loc_id'], row['to_loc_id']): row['version'] for row in rows}
+        # Пометки не удаляем: их снимает render. Здесь лишь не планируем повторно уже запланированную версию
+        for key, version in marked.items():
+            if self._seen.get(key) != version:
+                self._renders.touch(key)
+        self._seen = marked
+
+    async def render(self, key: tuple):
+        # Одна сводка не перерисовывается параллельно сама с собой, иначе новый пост уйдёт дважды
+        if key in self._rendering:
+            self._again.add(key)
+            return
+        self._rendering.add(key)
+        try:
+            mark = await self.db.fetchone(
+                "SELECT version FROM digest_dirty WHERE date = ? AND from_loc_id = ? AND to_loc_id = ?", key
+            )
+            await self._render(key)
+            if mark is not None:
+                # Пометки новее прочитанной остаются и перерисуют сводку ещё раз
+                await self.db.execute(
+                    "DELETE FROM digest_dirty WHERE date = ? AND from_loc_id = ? AND to_loc_id = ? AND version = ?",
+                    (*key, mark['version'])
+                )
+        except Exception as e:
+            logger.warning(f"Сводка {key} не обновлена ({e}), повтор позже")
+            # Пометка осталась в базе; следующий poll запланирует её снова
+            self._seen.pop(key, None)
+        finally:
+            self._rendering.discard(key)
+        if key in self._again:
+            self._again.discard(key)
+            self._renders.touch(key)
+
+    async def _render(self, key: tuple):
+        header, lines = await self.load(*key)
+        parts = split_parts(header, lines, self.footer, self.limit) if lines else []
+        existing = await self.db.fetchall(
+            "SELECT part, message_id, text FROM digests WHERE date = ? AND from_loc_id = ? AND to_loc_id = ? ORDER BY part",
+            key
+        )
+
+        for index, (text, ride_ids) in enumerate(parts):
+            if index < len(existing):
+                message_id = existing[index]['message_id']
+                if existing[index]['text'] != text:
+                    try:
+                        await self.publish_queue.submit(self.chat_id, lambda: self.edit(message_id, text))
+                    except self.publish_queue.permanent_errors as e:
+                        # Пост удалили руками — публикуем эту часть заново
+                        logger.warning(f"Пост сводки {message_id} не изменить ({e}), отправляем новый")
+                        message_id = (await self.publish_queue.submit(self.chat_id, lambda: self.send(text))).message_id
+            else:
+                message_id = (await self.publish_queue.submit(self.chat_id, lambda: self.send(text))).message_id
+            moved = await self.db.transaction(
+                lambda conn, index=index, message_id=message_id, text=text, ride_ids=ride_ids:
+                    self._record(conn, key, index, message_id, text, ride_ids)
+            )
+            if moved and self.on_published is not None:
+                await self.on_published(moved, message_id)
+
+        for row in existing[len(parts):]:
+            await self.delete(row['message_id'])
+            await self.db.execute(
+                "DELETE FROM digests WHERE date = ? AND from_loc_id = ? AND to_loc_id = ? AND part = ?",
+                (*key, row['part'])
+            )
+
+    @staticmethod
+    def _record(conn, key: tuple, index: int, message_id: int, text: str, ride_ids: list) -> list:
+        conn.execute(
+            "INSERT OR REPLACE INTO digests (date, from_loc_id, to_loc_id, part, message_id, text, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*key, index, message_id, text, int(time.time()))
+        )
+        placeholders = ", ".join("?" * len(ride_ids))
+        moved = [row[0] for row in conn.execute(
+            f"SELECT id FROM rides WHERE id IN ({placeholders}) AND message_id IS NOT ?",
+            (*ride_ids, message_id)
+        )]
+        conn.executemany("UPDATE rides SET message_id = ? WHERE id = ?", [(message_id, ride_id) for ride_id in moved])
+        return moved
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в локальном SQLite.
+    - Чтение и запись идут в кэш в памяти; из базы ключ подгружается один раз.
+    - Изменённые ключи копятся и пишутся пачкой раз в flush_interval секунд
+      (одна транзакция на пачку, а не запись на каждый set_state).
+    - Записи, не менявшиеся expire_after секунд, удаляются из базы.
+    """
+
+    def __init__(self, path: str = 'fsm.db', flush_interval: float = 1.0,
+                 max_cached: int = 10000, expire_after: float = 7 * 24 * 60 * 60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_cached = max_cached
+        self.expire_after = expire_after
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._cache = OrderedDict()    # key -> [state, data]
+        self._dirty = set()
+        self._conn = None
+        self._db_lock = asyncio.Lock()
+        self._flush_task = None
+
+    # --- Жизненный цикл ---
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at INTEGER
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm (updated_at)")
+        return conn
+
+    async def start(self):
+        if self._conn is None:
+            self._conn = await asyncio.to_thread(self._open)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        if self._conn is not None:
+            await self.flush()
+            self._conn.close()
+            self._conn = None
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._dirty.add(self.key_builder.build(key))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = await self._entry(key)
+        entry[1] = dict(data)
+        self._dirty.add(self.key_builder.build(key))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict((await self._entry(key))[1])
+
+    # --- Кэш ---
+
+    async def _entry(self, key: StorageKey) -> list:
+        k = self.key_builder.build(key)
+        entry = self._cache.get(k)
+        if entry is None:
+            if self._conn is None:
+                await self.start()
+            async with self._db_lock:
+                row = await asyncio.to_thread(self._load, k)
+            # Пока ждали базу, ключ мог быть уже записан — кэш важнее
+            entry = self._cache.setdefault(k, row)
+        self._cache.move_to_end(k)
+        self._shrink()
+        return entry
+
+    def _load(self, k: str) -> list:
+        row = self._conn.execute("SELECT state, data FROM fsm WHERE key = ?", (k,)).fetchone()
+        if row is None:
+            return [None, {}]
+        return [row[0], json.loads(row[1]) if row[1] else {}]
+
+    def _shrink(self):
+        # Вытесняем только уже сохранённые записи: грязные должны дождаться сброса
+        excess = len(self._cache) - self.max_cached
+        if excess <= 0:
+            return
+        for k in list(self._cache):
+            if excess <= 0:
+                break
+            if k not in self._dirty:
+                del self._cache[k]
+                excess -= 1
+
+    # --- Сброс на диск ---
+
+    async def flush(self):
+        if not self._dirty or self._conn is None:
+            return
+        keys, self._dirty = self._dirty, set()
+        now = int(time.time())
+        upserts, deletes = [], []
+        for k in keys:
+            state, data = self._cache[k]
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), now))
+        try:
+            async with self._db_lock:
+                await asyncio.to_thread(self._write, upserts, deletes, now - self.expire_after)
+        except Exception:
+            # Не потеряем изменения: вернём ключи, они уйдут со следующей пачкой
+            self._dirty |= keys
+            raise
+
+    def _write(self, upserts, deletes, expired_before):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)", upserts)
+            self._conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+            self._conn.execute("DELETE FROM fsm WHERE updated_at < ?", (expired_before,))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить состояния FSM: {e}", exc_info=True)
@@ -0,0 +1,107 @@
+import re
+from collections import namedtuple
+
+Location = namedtuple("Location", "id name")
+
+# === Справочник населённых пунктов ===
+# (id, каноническое название, варианты написания). Варианты сравниваются
+# после normalize(), поэтому регистр, "ё", "г." и пунктуация не важны.
+GAZETTEER = [
+    ("asino", "Асино", ("асино город",)),
+    ("tomsk", "Томск", ("томск 1", "томск 2", "томск первый", "томск второй", "tomsk")),
+    ("seversk", "Северск", ("зато северск",)),
+    ("novokuskovo", "Новокусково", ("н кусково", "новое кусково")),
+    ("pervomayskoe", "Первомайское", ("первомайка",)),
+    ("zyryanskoe", "Зырянское", ("зырянка",)),
+    ("baturino", "Батурино", ()),
+    ("yagodnoe", "Ягодное", ()),
+    ("minaevka", "Минаевка", ()),
+    ("bolshe_dorokhovo", "Больше-Дорохово", ("большое дорохово", "б дорохово")),
+    ("teguldet", "Тегульдет", ()),
+    ("krivosheino", "Кривошеино", ()),
+    ("melnikovo", "Мельниково", ()),
+    ("kozhevnikovo", "Кожевниково", ()),
+    ("kolpashevo", "Колпашево", ()),
+    ("strezhevoy", "Стрежевой", ()),
+    ("bogashevo", "Богашёво", ("аэропорт богашево", "аэропорт томск")),
+    ("timiryazevskoe", "Тимирязевское", ()),
+    ("kopylovo", "Копылово", ()),
+    ("moryakovsky_zaton", "Моряковский Затон", ("моряковка",)),
+    ("bely_yar", "Белый Яр", ()),
+    ("mariinsk", "Мариинск", ()),
+    ("yurga", "Юрга", ()),
+    ("kemerovo", "Кемерово", ()),
+    ("novosibirsk", "Новосибирск", ("нск", "новосиб")),
+]
+
+_PREFIXES = re.compile(r"^(город|г|село|с|поселок|пос|п|пгт|деревня|дер|д)\s+")
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = _NON_WORD.sub(" ", text).strip()
+    text = _PREFIXES.sub("", text)
+    return " ".join(text.split())
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Gazetteer:
+    """
+    Справочник с триграммным индексом, строится один раз при старте.
+    - lookup: точное совпадение по нормализованному названию или варианту
+    - suggest: нечёткий поиск для "возможно, вы имели в виду"
+    """
+
+    def __init__(self, entries, threshold: float = 0.35):
+        self.threshold = threshold
+        self._by_id = {}
+        self._exact = {}
+        self._keys = []          # (нормализованный вариант, id, число триграмм)
+        self._index = {}         # триграмма -> номера вариантов в _keys
+        for loc_id, name, aliases in entries:
+            location = Location(loc_id, name)
+            self._by_id[loc_id] = location
+            for variant in (name, *aliases):
+                key = normalize(variant)
+                self._exact[key] = location
+                grams = trigrams(key)
+                self._keys.append((key, loc_id, len(grams)))
+                for gram in grams:
+                    self._index.setdefault(gram, []).append(len(self._keys) - 1)
+
+    def get(self, loc_id: str):
+        return self._by_id.get(loc_id)
+
+    def lookup(self, text: str):
+        return self._exact.get(normalize(text))
+
+    def suggest(self, text: str, limit: int = 3) -> list:
+        grams = trigrams(normalize(text))
+        shared = {}
+        for gram in grams:
+            for i in self._index.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+
+        best = {}
+        for i, common in shared.items():
+            _, loc_id, size = self._keys[i]
+            score = common / (len(grams) + size - common)
+            if score >= self.threshold and score > best.get(loc_id, 0):
+                best[loc_id] = score
+        ranked = sorted(best, key=best.get, reverse=True)[:limit]
+        return [self._by_id[loc_id] for loc_id in ranked]
+
+    def location_id(self, text: str) -> str:
+        """id из справочника, а для неизвестных мест — нормализованный текст, чтобы равенство оставалось точным."""
+        location = self.lookup(text)
+        if location is not None:
+            return location.id
+        return "raw:" + normalize(text)
+
+
+PLACES = Gazetteer(GAZETTEER)
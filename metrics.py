@@ -0,0 +1,157 @@
+import time
+from bisect import bisect_left
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+# Границы бакетов гистограмм по умолчанию, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels_text(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, value in list(self._values.items()):
+            yield f"{self.name}{_labels_text(self.labels, values)} {value}"
+
+
+class Gauge:
+    """Значение задаётся через set() или вычисляется при каждом сборе функцией fn()."""
+
+    def __init__(self, name: str, help: str, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.fn() if self.fn is not None else self.value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}    # значения меток -> [счётчики бакетов..., +Inf, сумма]
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, series in list(self._series.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                total += count
+                le = _labels_text((*self.labels, "le"), (*values, bound))
+                yield f"{self.name}_bucket{le} {total}"
+            labels = _labels_text(self.labels, values)
+            yield f"{self.name}_sum{labels} {series[-1]}"
+            yield f"{self.name}_count{labels} {total}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class Registry:
+    """
+    Набор метрик процесса в текстовом формате Prometheus.
+    Все записи делаются из потока event loop, поэтому обновление — обычная
+    операция со словарём, без блокировок.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._metrics.get(name) or self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, fn=None) -> Gauge:
+        return self._metrics.get(name) or self.register(Gauge(name, help, fn))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.get(name) or self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Общие для обоих ботов метрики ---
+UPDATES = REGISTRY.counter("bot_updates_total", "Обработанные апдейты по обработчикам", ("handler",))
+HANDLER_LATENCY = REGISTRY.histogram("bot_handler_seconds", "Время работы обработчика", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+API_LATENCY = REGISTRY.histogram("bot_api_seconds", "Длительность вызовов Bot API", ("method",))
+API_ERRORS = REGISTRY.counter("bot_api_errors_total", "Ошибки вызовов Bot API", ("method",))
+API_RETRY_AFTER = REGISTRY.counter("bot_api_retry_after_total", "Ответы 429 от Bot API", ("method",))
+DB_LATENCY = REGISTRY.histogram(
+    "bot_db_seconds", "Длительность запросов к SQLite с учётом ожидания потока", ("db", "op"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+
+
+def make_metrics_app(registry: Registry = REGISTRY) -> "web.Application":
+    # aiohttp импортируется здесь, а не при импорте модуля: PTB-боту он нужен только
+    # для этого сервера, а его импорт — заметная часть холодного старта
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    return app
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from publish_queue import PublishQueue
+from rides_db import RidesDB
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(conn, key: str, chat_id: int, ride_id: int, payload: dict, status: str = 'pending') -> int:
+    """
+    Кладёт пост в outbox. Вызывается внутри RidesDB.transaction вместе со
+    вставкой строки поездки, так что в базе оказываются либо обе, либо ни одной.
+    key — ключ идемпотентности: повтор с тем же ключом (тот же апдейт, доставленный
+    второй раз) падает на UNIQUE и откатывает всю операцию вместе с поездкой.
+    status='digest' — пост публикует сводка (digest.py), а relay запись не трогает:
+    она нужна только для идемпотентности и сообщения о статусе.
+    """
+    return conn.execute(
+        "INSERT INTO outbox (key, chat_id, ride_id, payload, status, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (key, chat_id, ride_id, json.dumps(payload, ensure_ascii=False), status, 0, int(time.time()))
+    ).lastrowid
+
+
+def enqueue_edit(conn, chat_id: int, ride_id: int, delay: float) -> int:
+    """
+    Просит обновить уже опубликованный пост поездки. Одна запись на поездку:
+    пока она ждёт отправки, новые правки лишь поднимают version, и пост
+    обновится один раз — не раньше чем через delay секунд после первой правки.
+    Текст строит send в момент отправки из текущей строки rides.
+    """
+    return conn.execute(
+        "INSERT INTO outbox (key, kind, chat_id, ride_id, payload, next_attempt_at, created_at) "
+        "VALUES (?, 'edit', ?, ?, '{}', ?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET version = version + 1, attempts = 0, last_error = NULL, "
+        "next_attempt_at = CASE WHEN status = 'pending' THEN next_attempt_at ELSE excluded.next_attempt_at END, "
+        "status = 'pending', created_at = excluded.created_at",
+        (f"edit:{ride_id}", chat_id, ride_id, int(time.time() + delay), int(time.time()))
+    ).lastrowid
+
+
+class OutboxEntry:
+    __slots__ = ("id", "key", "kind", "chat_id", "ride_id", "payload", "attempts", "version")
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.key = row['key']
+        self.kind = row['kind']
+        self.chat_id = row['chat_id']
+        self.ride_id = row['ride_id']
+        self.payload = json.loads(row['payload'])
+        self.attempts = row['attempts']
+        self.version = row['version']
+
+
+class OutboxRelay:
+    """
+    Фоновая доставка постов из таблицы outbox в канал.
+    - Раз в interval секунд (или сразу после wake()) выбирает пачку до
+      batch_size готовых записей и отдаёт их в PublishQueue: лимиты канала,
+      429 и короткие повторы остаются на ней.
+    - Удачная отправка одной транзакцией записывает message_id в поездку
+      и помечает запись отправленной. Если у поездки message_id уже есть
+      (повторная доставка) или её успели удалить — лишний пост удаляется.
+    - Если PublishQueue сдалась, запись откладывается с экспоненциальной
+      задержкой; после max_attempts или ошибки из permanent_errors запись
+      помечается failed, а неопубликованная поездка удаляется.
+    Записи kind='edit' (enqueue_edit) обновляют уже опубликованный пост: после
+    отправки помечаются отправленными, только если за это время не пришла новая
+    правка, а при сбое поездку не трогают.
+    Доставка "хотя бы один раз": при падении процесса между отправкой и
+    записью message_id пост после перезапуска уйдёт повторно — у Bot API нет
+    ключей идемпотентности, так что этот узкий промежуток закрыть нельзя.
+    """
+
+    def __init__(self, db: RidesDB, publish_queue: PublishQueue, send, on_sent=None, on_failed=None,
+                 delete=None, batch_size: int = 50, interval: float = 1.0, max_attempts: int = 5,
+                 base_delay: float = 30, max_delay: float = 1800, keep_days: int = 7):
+        """
+        send(entry) — корутина, публикует entry.payload и возвращает отправленное сообщение.
+        on_sent(entry, message_id) / on_failed(entry, error) — корутины, вызываются по итогу.
+        delete(chat_id, message_id) — корутина для удаления лишнего поста.
+        """
+        self.db = db
+        self.publish_queue = publish_queue
+        self.send = send
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.delete = delete
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.keep_days = keep_days
+        self.pending = 0
+        self._inflight = set()
+        self._finished = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._pruned_at = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox-relay")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        """Разбудить relay, не дожидаясь interval (например, сразу после новой записи)."""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"Сбой outbox: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def drain(self):
+        # Итог завершённых записей уже в базе, и выборка ниже их не вернёт. Завершившиеся
+        # во время выборки остаются в _inflight до следующего прохода — иначе их устаревшая
+        # копия из выборки ушла бы повторно
+        self._inflight -= self._finished
+        self._finished.clear()
+        now = int(time.time())
+        if now - self._pruned_at >= 3600:
+            await self.prune(now)
+        # Поездку удалили раньше, чем её успели опубликовать (истекла) — публиковать нечего
+        await self.db.execute(
+            "UPDATE outbox SET status = 'dropped' WHERE status = 'pending' "
+            "AND NOT EXISTS (SELECT 1 FROM rides WHERE rides.id = outbox.ride_id)"
+        )
+        rows = await self.db.fetchall(
+            "SELECT id, key, kind, chat_id, ride_id, payload, attempts, version FROM outbox "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (now, self.batch_size + len(self._inflight))
+        )
+        count = await self.db.fetchone("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+        self.pending = count[0]
+        for row in rows:
+            if row['id'] in self._inflight:
+                continue
+            entry = OutboxEntry(row)
+            self._inflight.add(entry.id)
+            self.publish_queue.submit(
+                entry.chat_id, lambda entry=entry: self.send(entry),
+                on_success=lambda sent, entry=entry: self._sent(entry, sent),
+                on_failure=lambda error, entry=entry: self._failed(entry, error)
+            )
+
+    async def prune(self, now: int):
+        self._pruned_at = now
+        await self.db.execute(
+            "DELETE FROM outbox WHERE status != 'pending' AND created_at < ?",
+            (now - self.keep_days * 86400,)
+        )
+
+    async def _sent(self, entry: OutboxEntry, sent):
+        if entry.kind == 'edit':
+            try:
+                # Правка, пришедшая во время отправки, подняла version — запись остаётся в очереди
+                await self.db.execute(
+                    "UPDATE outbox SET status = 'sent', attempts = attempts + 1 WHERE id = ? AND version = ?",
+                    (entry.id, entry.version)
+                )
+            finally:
+                self._finished.add(entry.id)
+            return
+        message_id = sent.message_id
+
+        def record(conn):
+            updated = conn.execute(
+                "UPDATE rides SET message_id = ? WHERE id = ? AND message_id IS NULL",
+                (message_id, entry.ride_id)
+            ).rowcount
+            conn.execute(
+                "UPDATE outbox SET status = 'sent', message_id = ?, attempts = attempts + 1 WHERE id = ?",
+                (message_id, entry.id)
+            )
+            return updated
+
+        try:
+            recorded = await self.db.transaction(record)
+        finally:
+            self._finished.add(entry.id)
+        if not recorded:
+            logger.warning(f"Лишний пост {message_id} для поездки {entry.ride_id}, удаляем")
+            if self.delete is not None:
+                await self.delete(entry.chat_id, message_id)
+            return
+        if self.on_sent is not None:
+            await self.on_sent(entry, message_id)
+
+    async def _failed(self, entry: OutboxEntry, error: Exception):
+        attempts = entry.attempts + 1
+        permanent = isinstance(error, self.publish_queue.permanent_errors)
+        try:
+            if permanent or attempts >= self.max_attempts:
+                def give_up(conn):
+                    conn.execute(
+                        "UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ? AND version = ?",
+                        (attempts, str(error), entry.id, entry.version)
+                    )
+                    if entry.kind == 'post':
+                        conn.execute("DELETE FROM rides WHERE id = ? AND message_id IS NULL", (entry.ride_id,))
+
+                await self.db.transaction(give_up)
+            else:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                await self.db.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (attempts, int(time.time() + delay), str(error), entry.id)
+                )
+                logger.warning(f"Публикация {entry.key} не удалась ({error}), повтор через {delay:.0f} с")
+                return
+        finally:
+            self._finished.add(entry.id)
+        if self.on_failed is not None:
+            await self.on_failed(entry, error)
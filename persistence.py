@@ -0,0 +1,156 @@
+import json
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from rides_db import RidesDB
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence для PTB поверх RidesDB (хранит user_data и состояния ConversationHandler).
+    - Пишутся только изменившиеся записи: для каждой помним хэш последней
+      сохранённой версии и пропускаем неизменённые.
+    - Application вызывает update_* пачкой раз в update_interval секунд через
+      asyncio.gather, а поток-писатель RidesDB собирает их в одну транзакцию.
+    - user_data загружается лениво: при старте ничего не читается, данные
+      пользователя подтягиваются в refresh_user_data перед его первым апдейтом.
+      Состояния разговоров PTB забирает целиком при старте, поэтому их строки
+      удаляются сразу по завершении разговора и по истечении expire_after.
+    - Загруженных пользователей и их хэши помним не больше max_users (LRU).
+      Вытесненный пользователь при следующем апдейте перечитывается из базы
+      (один SELECT), а его первая запись после этого уходит без сверки хэша.
+    - owns(user_id) — в многопроцессном режиме воркер забирает только
+      разговоры своих пользователей.
+    """
+
+    def __init__(self, db: RidesDB, update_interval: float = 10,
+                 expire_after: float = 7 * 24 * 60 * 60, owns=None, max_users: int = 10000):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        self.expire_after = expire_after
+        self.owns = owns
+        self.max_users = max_users
+        self._users = OrderedDict()     # user_id -> хэш сохранённой версии (None — строки нет), давние в начале
+        self._conversation_states = {}
+
+    # --- user_data ---
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._users:
+            self._users.move_to_end(user_id)
+            return
+        self._remember(user_id, None)
+        row = await self.db.fetchone("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+        if row is not None:
+            stored = json.loads(row['data'])
+            # Свежие значения из текущего апдейта важнее сохранённых
+            for k, v in stored.items():
+                user_data.setdefault(k, v)
+            self._remember(user_id, hash(row['data']))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        known = user_id in self._users
+        # Про вытесненного пользователя не знаем, есть ли его строка, — пустые данные удаляем
+        if not data and known and self._users[user_id] is None:
+            return
+        serialized = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        if known and self._users[user_id] == hash(serialized):
+            self._users.move_to_end(user_id)
+            return
+        if not data:
+            await self.drop_user_data(user_id)
+            return
+        await self.db.execute(
+            "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+            (user_id, serialized, int(time.time()))
+        )
+        self._remember(user_id, hash(serialized))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._users:
+            self._users[user_id] = None
+        await self.db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    def _remember(self, user_id: int, digest):
+        self._users[user_id] = digest
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    # --- Разговоры ---
+
+    async def get_conversations(self, name: str) -> dict:
+        await self.db.start()
+        await self.db.execute(
+            "DELETE FROM conversations WHERE updated_at < ?",
+            (int(time.time() - self.expire_after),)
+        )
+        rows = await self.db.fetchall("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        conversations = {}
+        for row in rows:
+            key = tuple(json.loads(row['key']))
+            # Ключ разговора per_user заканчивается user_id
+            if self.owns is not None and not self.owns(key[-1]):
+                continue
+            state = json.loads(row['state'])
+            conversations[key] = state
+            self._conversation_states[(name, key)] = state
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        if self._conversation_states.get((name, key)) == new_state:
+            return
+        key_json = json.dumps(list(key))
+        if new_state is None:
+            self._conversation_states.pop((name, key), None)
+            await self.db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key_json))
+        else:
+            self._conversation_states[(name, key)] = new_state
+            await self.db.execute(
+                "INSERT OR REPLACE INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)",
+                (name, key_json, json.dumps(new_state), int(time.time()))
+            )
+
+    def conversation_count(self) -> int:
+        return len(self._conversation_states)
+
+    async def flush(self) -> None:
+        # Каждая запись уже подтверждена потоком-писателем, буфера нет
+        pass
+
+    # --- Не используются ---
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
@@ -0,0 +1,132 @@
+import cProfile
+import logging
+import os
+import random
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+_UNSAFE = re.compile(r"[^\w.-]+")
+
+
+class HandlerStats:
+    __slots__ = ("count", "wall", "cpu", "max_wall")
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+
+class Profiler:
+    """
+    Профилирование обработчиков, включается на лету командой администратора.
+    - Для каждой пары (обработчик, состояние) копится число вызовов, время
+      по часам (wall) и процессорное время (CPU).
+    - cProfile снимается с доли sample_rate апдейтов; при заданном
+      slow_threshold профилируется каждый апдейт, а сохраняется выборка
+      плюс все медленнее порога.
+    - Профили пишутся в out_dir как pstats-файлы с именем обработчика и состояния.
+    Одновременно активен только один cProfile, поэтому параллельные апдейты
+    в это время только замеряются. CPU-время считается для процесса целиком
+    и при параллельной обработке включает чужие апдейты — это оценка.
+    """
+
+    def __init__(self, out_dir: str = "profiles"):
+        self.out_dir = out_dir
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.slow_threshold = None
+        self.stats = {}
+        self.dumped = 0
+        self._active = None
+
+    def enable(self, sample_rate: float = 0.01, slow_threshold: float = None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.stats = {}
+        self.dumped = 0
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    async def run(self, handler: str, state, call):
+        """Выполняет call() (корутину без аргументов) с замером, если профилирование включено."""
+        if not self.enabled:
+            return await call()
+
+        sampled = random.random() < self.sample_rate
+        profile = None
+        if self._active is None and (sampled or self.slow_threshold is not None):
+            profile = self._active = cProfile.Profile()
+            profile.enable()
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        try:
+            return await call()
+        finally:
+            wall = time.perf_counter() - wall_started
+            cpu = time.process_time() - cpu_started
+            if profile is not None:
+                profile.disable()
+                self._active = None
+            self._record(handler, state, wall, cpu)
+            if profile is not None and (sampled or wall >= self.slow_threshold):
+                self._dump(profile, handler, state, wall)
+
+    def _record(self, handler, state, wall, cpu):
+        stats = self.stats.get((handler, state))
+        if stats is None:
+            stats = self.stats[(handler, state)] = HandlerStats()
+        stats.count += 1
+        stats.wall += wall
+        stats.cpu += cpu
+        stats.max_wall = max(stats.max_wall, wall)
+
+    def _dump(self, profile, handler, state, wall):
+        name = _UNSAFE.sub("_", f"{int(time.time() * 1000)}_{handler}_{state}_{int(wall * 1000)}ms")
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(self.out_dir, name + ".prof"))
+            self.dumped += 1
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить профиль {name}: {e}")
+
+    def report(self, limit: int = 15) -> str:
+        if not self.stats:
+            return "Нет данных."
+        rows = sorted(self.stats.items(), key=lambda item: item[1].wall, reverse=True)[:limit]
+        lines = []
+        for (handler, state), s in rows:
+            lines.append(
+                f"{handler} [{state}]: {s.count} шт, "
+                f"wall ср. {s.wall / s.count * 1000:.1f} мс / макс. {s.max_wall * 1000:.1f} мс, "
+                f"CPU ср. {s.cpu / s.count * 1000:.1f} мс"
+            )
+        lines.append(f"Профилей сохранено: {self.dumped} ({self.out_dir})")
+        return "\n".join(lines)
+
+    def command(self, args: list) -> str:
+        """Разбор аргументов команды /profile: on [доля] [порог_мс] | off | stats."""
+        action = args[0] if args else "stats"
+        if action == "on":
+            try:
+                sample_rate = float(args[1]) if len(args) > 1 else 0.01
+                slow_threshold = float(args[2]) / 1000 if len(args) > 2 else None
+            except ValueError:
+                return "Использование: /profile on [доля 0..1] [порог, мс]"
+            self.enable(sample_rate, slow_threshold)
+            threshold = f", порог {slow_threshold * 1000:.0f} мс" if slow_threshold is not None else ""
+            return f"Профилирование включено: выборка {sample_rate:.0%}{threshold}."
+        if action == "off":
+            report = self.report()
+            self.disable()
+            return "Профилирование выключено.\n\n" + report
+        return ("Профилирование включено.\n\n" if self.enabled else "Профилирование выключено.\n\n") + self.report()
+
+
+def parse_admin_ids(value: str) -> set:
+    return {int(part) for part in value.replace(" ", "").split(",") if part}
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def get_retry_after(error: Exception):
+    """Секунды из 429 (aiogram TelegramRetryAfter / PTB RetryAfter) или None."""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        return None
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, cost: float = 1):
+        cost = min(cost, self.burst)
+        while True:
+            self._refill()
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return
+            await asyncio.sleep((cost - self.tokens) / self.rate)
+
+    def drain(self):
+        # После 429 считаем, что бюджет чата исчерпан
+        self._refill()
+        self.tokens = 0
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def remaining(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class PublishJob:
+    def __init__(self, send, cost, on_success, on_failure):
+        self.send = send
+        self.cost = cost
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.attempts = 0
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class PublishQueue:
+    """
+    Общая очередь отправки в каналы.
+    - Для каждого чата свой воркер и свой token bucket (лимиты Telegram на чат).
+    - 429: ждём retry_after и повторяем, не считая это ошибкой.
+    - Прочие временные ошибки: экспоненциальная задержка; после threshold
+      ошибок подряд автомат размыкается на cooldown секунд, задания ждут в очереди.
+    - Ошибки из permanent_errors не повторяются.
+    """
+
+    def __init__(self, rate: float = 20 / 60, burst: float = 3, max_retries: int = 5,
+                 base_delay: float = 1, max_delay: float = 60,
+                 breaker_threshold: int = 5, breaker_cooldown: float = 60,
+                 permanent_errors: tuple = ()):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.permanent_errors = permanent_errors
+        self._queues = {}
+        self._workers = {}
+        self._buckets = {}
+        self._breakers = {}
+        self._closed = False
+
+    def submit(self, chat_id, send, cost: float = 1, on_success=None, on_failure=None) -> asyncio.Future:
+        """
+        send — корутинная функция без аргументов, выполняющая сам вызов Bot API.
+        cost — сколько сообщений она создаёт (для альбома — число фото).
+        on_success(result) / on_failure(error) — корутины, вызываются по итогу.
+        Возвращает future с результатом send().
+        """
+        if self._closed:
+            raise RuntimeError("Очередь публикации остановлена")
+        job = PublishJob(send, cost, on_success, on_failure)
+        if chat_id not in self._queues:
+            self._queues[chat_id] = asyncio.Queue()
+            self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+            self._breakers[chat_id] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id), name=f"publish-{chat_id}")
+        self._queues[chat_id].put_nowait(job)
+        return job.future
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self._queues.values())
+
+    async def stop(self, timeout: float = 10):
+        # Даём очереди немного времени дослать накопленное
+        self._closed = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues.values())), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь публикации остановлена, не отправлено: {self.pending()}")
+        for task in self._workers.values():
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear()
+
+    async def _worker(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._buckets[chat_id]
+        breaker = self._breakers[chat_id]
+        while True:
+            job = await queue.get()
+            try:
+                await self._process(job, bucket, breaker)
+            except Exception as e:
+                logger.error(f"Сбой очереди публикации для {chat_id}: {e}", exc_info=True)
+            finally:
+                queue.task_done()
+
+    async def _process(self, job, bucket, breaker):
+        while True:
+            wait = breaker.remaining()
+            if wait:
+                await asyncio.sleep(wait)
+            await bucket.acquire(job.cost)
+            try:
+                result = await job.send()
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    logger.warning(f"429 от Telegram, ждём {retry_after} с")
+                    bucket.drain()
+                    await asyncio.sleep(retry_after)
+                    continue
+                job.attempts += 1
+                if isinstance(e, self.permanent_errors) or job.attempts > self.max_retries:
+                    await self._finish(job, None, e)
+                    return
+                breaker.failure()
+                delay = min(self.max_delay, self.base_delay * 2 ** (job.attempts - 1))
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+                continue
+            breaker.success()
+            await self._finish(job, result, None)
+            return
+
+    async def _finish(self, job, result, error):
+        if error is None:
+            job.future.set_result(result)
+            callback, arg = job.on_success, result
+        else:
+            job.future.set_exception(error)
+            # Исключение уже передано в on_failure, не шумим "never retrieved"
+            job.future.exception()
+            callback, arg = job.on_failure, error
+        if callback is not None:
+            try:
+                await callback(arg)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике результата публикации: {e}", exc_info=True)
@@ -0,0 +1,326 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import DB_LATENCY
+
+# === Схема ===
+# Каждая миграция применяется один раз, номер хранится в PRAGMA user_version.
+MIGRATIONS = [
+    '''
+        CREATE TABLE IF NOT EXISTS rides (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            role TEXT,
+            from_loc TEXT,
+            to_loc TEXT,
+            date TEXT,
+            time_slot TEXT,
+            seats INTEGER,
+            comment TEXT,
+            contact TEXT,
+            username TEXT,
+            message_id INTEGER,
+            price TEXT
+        )
+    ''',
+    '''
+        ALTER TABLE rides ADD COLUMN delete_at INTEGER;
+        CREATE INDEX IF NOT EXISTS idx_rides_delete_at ON rides (delete_at)
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT,
+            updated_at INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT,
+            key TEXT,
+            state TEXT,
+            updated_at INTEGER,
+            PRIMARY KEY (name, key)
+        )
+    ''',
+    '''
+        ALTER TABLE rides ADD COLUMN departure_start INTEGER;
+        ALTER TABLE rides ADD COLUMN departure_end INTEGER;
+        CREATE INDEX IF NOT EXISTS idx_rides_route_departure ON rides (role, from_loc, to_loc, departure_start)
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            role TEXT,
+            from_loc TEXT,
+            to_loc TEXT,
+            date TEXT,
+            created_at INTEGER,
+            UNIQUE (user_id, role, from_loc, to_loc, date)
+        );
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_date ON subscriptions (date)
+    ''',
+    '''
+        ALTER TABLE rides ADD COLUMN from_loc_id TEXT;
+        ALTER TABLE rides ADD COLUMN to_loc_id TEXT;
+        DROP INDEX IF EXISTS idx_rides_route_departure;
+        CREATE INDEX IF NOT EXISTS idx_rides_route_departure ON rides (role, from_loc_id, to_loc_id, departure_start)
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            chat_id INTEGER NOT NULL,
+            ride_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            message_id INTEGER,
+            last_error TEXT,
+            created_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS idx_rides_user ON rides (user_id, message_id)
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS digests (
+            date TEXT NOT NULL,
+            from_loc_id TEXT NOT NULL,
+            to_loc_id TEXT NOT NULL,
+            part INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (date, from_loc_id, to_loc_id, part)
+        );
+        CREATE INDEX IF NOT EXISTS idx_digests_message ON digests (message_id);
+        CREATE TABLE IF NOT EXISTS digest_dirty (
+            date TEXT NOT NULL,
+            from_loc_id TEXT NOT NULL,
+            to_loc_id TEXT NOT NULL,
+            PRIMARY KEY (date, from_loc_id, to_loc_id)
+        )
+    ''',
+    '''
+        ALTER TABLE subscriptions ADD COLUMN from_loc_id TEXT;
+        ALTER TABLE subscriptions ADD COLUMN to_loc_id TEXT;
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_route ON subscriptions (date, role, from_loc_id, to_loc_id)
+    ''',
+    '''
+        ALTER TABLE digest_dirty ADD COLUMN version INTEGER NOT NULL DEFAULT 1
+    ''',
+    '''
+        ALTER TABLE outbox ADD COLUMN kind TEXT NOT NULL DEFAULT 'post';
+        ALTER TABLE outbox ADD COLUMN version INTEGER NOT NULL DEFAULT 0
+    ''',
+]
+
+_STOP = object()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def split_statements(script: str):
+    # Делим по ";", но не внутри тела триггера (BEGIN ... END;)
+    buffer = ""
+    for part in script.split(";"):
+        buffer += part + ";"
+        if sqlite3.complete_statement(buffer):
+            if buffer.strip(" \n;"):
+                yield buffer
+            buffer = ""
+    if buffer.strip(" \n;"):
+        yield buffer
+
+
+def migrate(conn: sqlite3.Connection, migrations: list = MIGRATIONS):
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Версию читаем под блокировкой записи: базу могут мигрировать сразу несколько процессов
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(migrations):
+                conn.execute("COMMIT")
+                return
+            for statement in split_statements(migrations[version]):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class RidesDB:
+    """
+    Асинхронный доступ к rides.db без блокировки event loop.
+    - Все записи идут через один поток-писатель, который собирает
+      накопившиеся операции в одну короткую транзакцию (один fsync на пачку).
+    - Чтение — через небольшой пул потоков, у каждого своё соединение (WAL
+      позволяет читать параллельно с записью).
+    Схема задаётся атрибутом migrations; подклассы для других баз
+    переопределяют только его.
+    """
+
+    migrations = MIGRATIONS
+
+    def __init__(self, path: str = 'rides.db', readers: int = 2,
+                 batch_size: int = 100, batch_window: float = 0.005):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.readers = readers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._writes = queue.Queue()
+        self._writer = None
+        self._read_pool = None
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+
+    # --- Жизненный цикл ---
+
+    async def start(self):
+        if self._writer is not None:
+            return
+        ready = asyncio.get_running_loop().create_future()
+        self._writer = threading.Thread(target=self._writer_loop, args=(ready,), name="rides-db-writer", daemon=True)
+        self._writer.start()
+        await ready
+        self._read_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="rides-db-reader")
+
+    async def close(self):
+        if self._writer is None:
+            return
+        self._writes.put(_STOP)
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.join)
+        self._writer = None
+        self._read_pool.shutdown(wait=True)
+        self._read_pool = None
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+
+    # --- Запись ---
+
+    def _submit(self, fn):
+        if self._writer is None:
+            raise RuntimeError("RidesDB не запущена: вызовите start()")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put((fn, loop, future))
+        return future
+
+    async def transaction(self, fn):
+        """Выполняет fn(conn) в потоке-писателе атомарно (в своей точке сохранения) и возвращает результат."""
+        return await self._timed("transaction", self._submit(fn))
+
+    async def execute(self, sql: str, params=()) -> int:
+        """INSERT/UPDATE/DELETE. Возвращает lastrowid."""
+        return await self._timed("execute", self._submit(lambda conn: conn.execute(sql, params).lastrowid))
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        """Возвращает количество затронутых строк."""
+        rows = list(seq_of_params)
+        return await self._timed("executemany", self._submit(lambda conn: conn.executemany(sql, rows).rowcount))
+
+    async def _timed(self, op: str, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, self.name, op)
+
+    def _writer_loop(self, ready):
+        loop = ready.get_loop()
+        try:
+            conn = _connect(self.path)
+            migrate(conn, self.migrations)
+        except Exception as e:
+            loop.call_soon_threadsafe(_resolve, ready, None, e)
+            return
+        loop.call_soon_threadsafe(_resolve, ready, None, None)
+
+        stopping = False
+        while not stopping:
+            batch = [self._writes.get()]
+            # Короткое окно, чтобы параллельные записи попали в ту же транзакцию
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._writes.get(timeout=self.batch_window))
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not _STOP]
+            if batch:
+                self._run_batch(conn, batch)
+        conn.close()
+
+    def _run_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, loop, future in batch:
+                # Ошибка одной операции откатывает только её точку сохранения
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((loop, future, fn(conn), None))
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((loop, future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(loop, future, None, e) for fn, loop, future in batch]
+        for loop, future, result, error in results:
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+
+    # --- Чтение ---
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connect(self.path)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    async def _read(self, fn):
+        if self._read_pool is None:
+            raise RuntimeError("RidesDB не запущена: вызовите start()")
+        return await asyncio.get_running_loop().run_in_executor(self._read_pool, lambda: fn(self._reader_conn()))
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        return await self._timed("fetchall", self._read(lambda conn: conn.execute(sql, params).fetchall()))
+
+    async def fetchone(self, sql: str, params=()):
+        return await self._timed("fetchone", self._read(lambda conn: conn.execute(sql, params).fetchone()))
+
+
+def _resolve(future, result, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
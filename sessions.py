@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+EVICTED = REGISTRY.counter("bot_sessions_evicted_total", "Вытесненные сессии: по TTL или по размеру (LRU)", ("reason",))
+
+
+class SessionStore(MutableMapping):
+    """
+    Словарь черновиков пользователей с вытеснением.
+    - Запись, к которой не обращались ttl секунд, удаляется фоновой очисткой.
+    - При превышении max_size вытесняется давно не использованная запись (LRU).
+    - on_evict(key, value) — корутина, вызывается для каждой вытесненной записи
+      (но не для удалённых явно через pop/del).
+    Используется как обычный dict: store[user_id]["text"] = ...
+    """
+
+    def __init__(self, ttl: float = 3600, max_size: int = 10000, on_evict=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._data = OrderedDict()     # key -> (value, last_access), самые старые в начале
+        self._purge_task = None
+        self.evicted_ttl = 0
+        self.evicted_lru = 0
+
+    # --- Доступ ---
+
+    def __getitem__(self, key):
+        value, _ = self._data[key]
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            old_key, (old_value, _) = self._data.popitem(last=False)
+            self.evicted_lru += 1
+            EVICTED.inc("lru")
+            self._notify(old_key, old_value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    # --- Вытеснение ---
+
+    def purge(self) -> int:
+        deadline = time.monotonic() - self.ttl
+        expired = 0
+        while self._data:
+            key, (value, last_access) = next(iter(self._data.items()))
+            if last_access > deadline:
+                break
+            del self._data[key]
+            self.evicted_ttl += 1
+            EVICTED.inc("ttl")
+            expired += 1
+            self._notify(key, value)
+        return expired
+
+    def _notify(self, key, value):
+        if self.on_evict is None:
+            return
+        task = asyncio.get_running_loop().create_task(self.on_evict(key, value))
+        task.add_done_callback(_log_evict_error)
+
+    def start_purge(self, interval: float = 60):
+        self._purge_task = asyncio.create_task(self._purge_loop(interval))
+
+    async def stop_purge(self):
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    async def _purge_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            expired = self.purge()
+            if expired:
+                logger.info(f"Удалено устаревших сессий: {expired}, активных: {len(self)}")
+
+    def stats(self) -> dict:
+        return {
+            "live": len(self._data),
+            "evicted_ttl": self.evicted_ttl,
+            "evicted_lru": self.evicted_lru,
+        }
+
+
+def _log_evict_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка при вытеснении сессии: {task.exception()}")
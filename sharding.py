@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import zlib
+
+from metrics import REGISTRY, make_metrics_app
+from webhook import make_webhook_app, start_server
+
+logger = logging.getLogger(__name__)
+
+# Номер воркера; задаётся ингрессом при запуске дочернего процесса
+SHARD_ENV = "SHARD_INDEX"
+
+INGRESS_UPDATES = REGISTRY.counter("bot_ingress_updates_total", "Апдейты, переданные воркерам", ("shard",))
+INGRESS_REJECTED = REGISTRY.counter("bot_ingress_rejected_total", "Апдейты, отклонённые из-за переполнения очереди", ("shard",))
+WORKER_RESTARTS = REGISTRY.counter("bot_worker_restarts_total", "Перезапуски упавших воркеров", ("shard",))
+
+
+def update_key(data: dict) -> int:
+    """Чьё состояние меняет сырой апдейт: from_user, для апдейтов без него — чат."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+
+def shard_of(key: int, shards: int) -> int:
+    # Стабильный между процессами и перезапусками хэш (встроенный hash() для этого не годится)
+    return zlib.crc32(key.to_bytes(8, "little", signed=True)) % shards
+
+
+def shard_socket(socket_dir: str, index: int) -> str:
+    return os.path.join(socket_dir, f"shard-{index}.sock")
+
+
+# === Воркер ===
+
+async def serve_shard(path: str, put) -> asyncio.AbstractServer:
+    """
+    Принимает апдейты от ингресса: по строке JSON на апдейт.
+    put(data) — корутина постановки в очередь воркера; пока она ждёт места,
+    чтение из сокета стоит, и ингресс упирается в свою ограниченную очередь.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    logger.warning("Некорректный апдейт от ингресса пропущен")
+                    continue
+                await put(data)
+        finally:
+            writer.close()
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return await asyncio.start_unix_server(handle, path, limit=2 ** 20)
+
+
+async def wait_for_stop():
+    """Ждёт SIGTERM/SIGINT или завершения родителя (ингресса)."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    parent = os.getppid()
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                if os.getppid() != parent:
+                    logger.warning("Ингресс завершился, воркер останавливается")
+                    return
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+
+
+# === Ингресс ===
+
+class ShardRouter:
+    """
+    Раскладывает апдейты по воркерам: номер воркера — хэш from_user.id,
+    поэтому все апдейты одного пользователя (и его состояние в памяти)
+    живут в одном процессе.
+    - У каждого воркера своя ограниченная очередь и своё соединение через
+      unix-сокет; при переполнении put_nowait бросает asyncio.QueueFull,
+      и вебхук отвечает 503.
+    - Пока воркер запускается или перезапускается, апдейты ждут в очереди;
+      апдейт, на котором оборвалось соединение, отправляется повторно.
+    """
+
+    def __init__(self, paths: list, maxsize: int = 1000):
+        self.paths = paths
+        self.queues = [asyncio.Queue(maxsize=maxsize) for _ in paths]
+        self._tasks = []
+
+    def put_nowait(self, data: dict):
+        index = shard_of(update_key(data), len(self.paths))
+        try:
+            self.queues[index].put_nowait(data)
+        except asyncio.QueueFull:
+            INGRESS_REJECTED.inc(str(index))
+            raise
+        INGRESS_UPDATES.inc(str(index))
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._sender(i), name=f"shard-{i}") for i in range(len(self.paths))]
+
+    async def stop(self, timeout: float = 10):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Ингресс остановлен, не передано воркерам: {self.pending()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _sender(self, index: int):
+        queue = self.queues[index]
+        data = None
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(self.paths[index])
+            except OSError:
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                while True:
+                    if data is None:
+                        data = await queue.get()
+                    writer.write(json.dumps(data, ensure_ascii=False).encode() + b"\n")
+                    await writer.drain()
+                    data = None
+                    queue.task_done()
+            except (ConnectionError, OSError) as e:
+                logger.warning(f"Соединение с воркером {index} потеряно: {e}")
+            finally:
+                writer.close()
+
+
+class WorkerPool:
+    """Запускает воркеры дочерними процессами (тот же скрипт с SHARD_INDEX) и перезапускает упавшие."""
+
+    def __init__(self, argv: list, shards: int, env_for=None, restart_delay: float = 1.0):
+        self.argv = argv
+        self.shards = shards
+        self.env_for = env_for
+        self.restart_delay = restart_delay
+        self._procs = {}
+        self._tasks = []
+        self._stopping = False
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._keep_alive(i)) for i in range(self.shards)]
+
+    async def _keep_alive(self, index: int):
+        while not self._stopping:
+            env = dict(os.environ, **{SHARD_ENV: str(index)})
+            if self.env_for is not None:
+                env.update(self.env_for(index))
+            proc = self._procs[index] = await asyncio.create_subprocess_exec(*self.argv, env=env)
+            code = await proc.wait()
+            if self._stopping:
+                return
+            WORKER_RESTARTS.inc(str(index))
+            logger.error(f"Воркер {index} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(self.restart_delay)
+
+    async def stop(self, timeout: float = 15):
+        self._stopping = True
+        procs = [p for p in self._procs.values() if p.returncode is None]
+        for proc in procs:
+            proc.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in procs)), timeout)
+        except asyncio.TimeoutError:
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def set_webhook(api_url: str, token: str, url: str, secret_token: str, allowed_updates: list):
+    # Ингресс не поднимает aiogram/PTB ради одного вызова — обычный POST в Bot API
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/bot{token}/setWebhook", json={
+            "url": url, "secret_token": secret_token, "allowed_updates": allowed_updates
+        }) as response:
+            result = await response.json()
+    if not result.get("ok"):
+        raise RuntimeError(f"setWebhook: {result.get('description')}")
+
+
+async def run_ingress(*, shards: int, socket_dir: str, token: str, api_url: str,
+                      webhook_url: str, webhook_path: str, webhook_secret: str,
+                      webhook_host: str, webhook_port: int, allowed_updates: list,
+                      metrics_host: str, metrics_port: int, metrics_port_base: int, queue_size: int = 1000):
+    """
+    Многопроцессный режим: этот процесс только принимает вебхук и раскладывает
+    апдейты по shards воркерам, которые запускаются тем же скриптом.
+    Метрики ингресса — на metrics_port, воркера i — на metrics_port_base + i;
+    metrics_port=0 отключает метрики и у воркеров.
+    """
+    paths = [shard_socket(socket_dir, i) for i in range(shards)]
+    pool = WorkerPool(
+        [sys.executable, os.path.abspath(sys.argv[0])], shards,
+        env_for=lambda i: {"METRICS_PORT": str(metrics_port_base + i) if metrics_port else "0"}
+    )
+    router = ShardRouter(paths, maxsize=queue_size)
+    # До запуска воркеров: без секрета ингресс не стартует
+    webhook_app = make_webhook_app(webhook_path, webhook_secret, router.put_nowait)
+    REGISTRY.gauge("bot_ingress_pending", "Апдейты в очередях ингресса", fn=router.pending)
+
+    metrics_runner = await start_server(make_metrics_app(), metrics_host, metrics_port) if metrics_port else None
+    await pool.start()
+    await router.start()
+    runner = await start_server(webhook_app, webhook_host, webhook_port)
+    try:
+        await set_webhook(api_url, token, webhook_url + webhook_path, webhook_secret, allowed_updates)
+        logger.info(f"Ингресс принимает апдейты, воркеров: {shards}")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await router.stop()
+        await pool.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+
+from publish_queue import TokenBucket, get_retry_after
+from rides_db import RidesDB
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionIndex:
+    """
+    Подписки "сообщите о водителях Асино → Томск на 21.10".
+    Хранятся в SQLite, а для поиска держится обратный индекс в памяти:
+    (role, from_loc_id, to_loc_id, date) -> множество user_id. Маршрут
+    сравнивается по id мест (location_id), как в поиске, а не по введённому
+    тексту. Поиск подписчиков при публикации — один словарный доступ, O(совпадений).
+    """
+
+    def __init__(self, db: RidesDB, location_id):
+        """location_id(text) — id места из справочника (PLACES.location_id)."""
+        self.db = db
+        self.location_id = location_id
+        self._index = {}
+
+    async def load(self):
+        await self._backfill()
+        rows = await self.db.fetchall("SELECT user_id, role, from_loc_id, to_loc_id, date FROM subscriptions")
+        self._index = {}
+        for row in rows:
+            key = (row['role'], row['from_loc_id'], row['to_loc_id'], row['date'])
+            self._index.setdefault(key, set()).add(row['user_id'])
+
+    async def _backfill(self):
+        # Подписки, оформленные до появления id мест
+        rows = await self.db.fetchall("SELECT id, from_loc, to_loc FROM subscriptions WHERE from_loc_id IS NULL OR to_loc_id IS NULL")
+        if rows:
+            await self.db.executemany(
+                "UPDATE subscriptions SET from_loc_id = ?, to_loc_id = ? WHERE id = ?",
+                [(self.location_id(row['from_loc'] or ""), self.location_id(row['to_loc'] or ""), row['id']) for row in rows]
+            )
+            logger.info(f"Дополнены id мест для {len(rows)} подписок")
+
+    def match(self, role: str, from_loc_id: str, to_loc_id: str, date: str) -> set:
+        return self._index.get((role, from_loc_id, to_loc_id, date), set())
+
+    async def fetch(self, role: str, from_loc_id: str, to_loc_id: str, date: str) -> set:
+        """То же, что match, но из базы — когда подписки меняют и другие процессы."""
+        rows = await self.db.fetchall(
+            "SELECT user_id FROM subscriptions WHERE date = ? AND role = ? AND from_loc_id = ? AND to_loc_id = ?",
+            (date, role, from_loc_id, to_loc_id)
+        )
+        return {row['user_id'] for row in rows}
+
+    def count(self) -> int:
+        return sum(len(users) for users in self._index.values())
+
+    async def add(self, user_id: int, role: str, from_loc: str, to_loc: str, date: str) -> bool:
+        from_loc_id, to_loc_id = self.location_id(from_loc), self.location_id(to_loc)
+        key = (role, from_loc_id, to_loc_id, date)
+        if user_id in self._index.get(key, ()):
+            return False
+        await self.db.execute(
+            "INSERT OR IGNORE INTO subscriptions (user_id, role, from_loc, to_loc, date, created_at, from_loc_id, to_loc_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, role, from_loc, to_loc, date, int(time.time()), from_loc_id, to_loc_id)
+        )
+        self._index.setdefault(key, set()).add(user_id)
+        return True
+
+    async def remove(self, user_id: int, role: str, from_loc: str, to_loc: str, date: str):
+        key = (role, self.location_id(from_loc), self.location_id(to_loc), date)
+        await self.db.execute(
+            "DELETE FROM subscriptions WHERE user_id = ? AND role = ? AND from_loc_id = ? AND to_loc_id = ? AND date = ?",
+            (user_id, *key)
+        )
+        self._discard(key, user_id)
+
+    async def remove_user(self, user_id: int) -> int:
+        removed = 0
+        for key in [k for k, users in self._index.items() if user_id in users]:
+            self._discard(key, user_id)
+            removed += 1
+        await self.db.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+        return removed
+
+    async def prune(self, today: str):
+        # Даты в ISO-формате сравниваются как строки
+        await self.db.execute("DELETE FROM subscriptions WHERE date < ?", (today,))
+        for key in [k for k in self._index if k[3] < today]:
+            del self._index[key]
+
+    def _discard(self, key, user_id):
+        users = self._index.get(key)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._index[key]
+
+
+class FanOut:
+    """
+    Рассылка уведомлений в фоне, не задерживая обработчик публикации.
+    - Общий для всех рассылок семафор ограничивает число одновременных запросов.
+    - Общий token bucket держит темп ниже глобального лимита Bot API;
+      на 429 ждём retry_after и повторяем.
+    - Ошибки из permanent_errors (пользователь заблокировал бота) передаются
+      в on_permanent(user_id), например чтобы удалить подписки.
+    """
+
+    def __init__(self, concurrency: int = 10, rate: float = 25, max_retries: int = 3,
+                 permanent_errors: tuple = (), on_permanent=None):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.permanent_errors = permanent_errors
+        self.on_permanent = on_permanent
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate, rate)
+        self._tasks = set()
+
+    def send(self, user_ids, send_one):
+        """Запускает рассылку send_one(user_id) по user_ids и сразу возвращает управление."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return None
+        task = asyncio.create_task(self._run(user_ids, send_one))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self, user_ids, send_one):
+        pending = iter(user_ids)
+
+        async def worker():
+            for user_id in pending:
+                async with self._semaphore:
+                    await self._deliver(user_id, send_one)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(user_ids)))))
+
+    async def _deliver(self, user_id, send_one):
+        for _ in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                await send_one(user_id)
+                return
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    self._bucket.drain()
+                    await asyncio.sleep(retry_after)
+                    continue
+                if isinstance(e, self.permanent_errors) and self.on_permanent is not None:
+                    await self.on_permanent(user_id)
+                else:
+                    logger.warning(f"Не удалось отправить уведомление {user_id}: {e}")
+                return
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+
+# Лимиты по типу апдейта: (токенов в секунду, размер пачки)
+DEFAULT_LIMITS = {
+    "message": (1, 12),           # пачка вмещает альбом из 10 фото
+    "callback_query": (2, 6),
+    "inline_query": (2, 10),
+}
+
+
+class Throttler:
+    """
+    Антифлуд: token bucket на каждую пару (пользователь, тип апдейта).
+    - check() — O(1): корзина пополняется лениво по времени последнего обращения.
+    - Корзины лежат в OrderedDict в порядке обращения, поэтому простаивающие
+      дольше idle_after снимаются с начала при каждой проверке (амортизированно O(1)).
+    - Предупреждение "не так быстро" отдаётся один раз на серию отброшенных
+      апдейтов; флаг снимается, когда пользователь снова проходит лимит.
+    """
+
+    def __init__(self, limits: dict = None, default: tuple = (1, 5), idle_after: float = 600):
+        self.limits = limits if limits is not None else DEFAULT_LIMITS
+        self.default = default
+        self.idle_after = idle_after
+        self._buckets = OrderedDict()    # (user_id, kind) -> [tokens, updated_at, warned]
+        self.dropped = 0
+
+    def check(self, user_id: int, kind: str) -> tuple:
+        """Возвращает (пропустить, нужно_предупредить)."""
+        now = time.monotonic()
+        rate, burst = self.limits.get(kind, self.default)
+        key = (user_id, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now, False]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        self._evict(now)
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, False
+        self.dropped += 1
+        warn = not bucket[2]
+        bucket[2] = True
+        return False, warn
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket[1] < self.idle_after:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,84 @@
+import logging
+from collections import deque
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update):
+    """Чьи апдейты нельзя переставлять: пользователь, а без него — чат. None — порядок не важен."""
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов разных пользователей при строгом порядке
+    апдейтов одного пользователя — иначе состояние ConversationHandler
+    перепутается (кнопка обгонит текст, на который отвечает).
+    - Общее число одновременно обрабатываемых апдейтов ограничено
+      max_concurrent_updates (семафор BaseUpdateProcessor).
+    - Пока апдейт пользователя обрабатывается, следующие его апдейты встают
+      в очередь этого пользователя и сразу освобождают слот семафора;
+      очередь разбирает тот же вызов, что занял слот. Так один пользователь
+      держит не больше одного слота, сколько бы он ни прислал.
+    - Очередь удаляется, как только опустела: память растёт с числом
+      пользователей, у которых прямо сейчас есть необработанные апдейты,
+      а не со всеми, кто когда-либо писал боту.
+    Application.stop() дожидается разбора очередей: апдейт, занявший слот,
+    отмечается обработанным в update_queue только после опустошения очереди.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}    # ключ пользователя -> deque ожидающих корутин
+        self.queued = 0      # сколько апдейтов когда-либо ждали своей очереди
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        pending = self._queues.get(key)
+        if pending is not None:
+            pending.append(coroutine)
+            self.queued += 1
+            return
+
+        pending = self._queues[key] = deque()
+        try:
+            await self._run(coroutine)
+            while pending:
+                await self._run(pending.popleft())
+        finally:
+            # Сюда попадаем и при отмене: недоставшиеся корутины закрываем, чтобы не было
+            # предупреждений "coroutine was never awaited"
+            del self._queues[key]
+            for rest in pending:
+                rest.close()
+
+    @staticmethod
+    async def _run(coroutine):
+        # Ошибки обработчиков Application разбирает сам; здесь страхуемся от
+        # прочих, чтобы одна ошибка не оставила без обработки остальную очередь
+        try:
+            await coroutine
+        except Exception:
+            logger.exception("Ошибка при обработке апдейта")
+
+    def users(self) -> int:
+        return len(self._queues)
+
+    def backlog(self) -> int:
+        return sum(len(pending) for pending in self._queues.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,93 @@
+import asyncio
+import hmac
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_webhook_app(path: str, secret_token: str, enqueue) -> "web.Application":
+    """
+    aiohttp-приложение для приёма апдейтов от Telegram.
+    Проверяет секретный токен, кладёт апдейт в очередь через enqueue(data)
+    и сразу отвечает 200, не дожидаясь обработки. Если очередь переполнена
+    (asyncio.QueueFull) — отвечает 503, и Telegram повторит доставку позже.
+    Пустой secret_token — ValueError: с ним проверка пропускала бы любой POST.
+    """
+    from aiohttp import web
+
+    if not secret_token:
+        raise ValueError("Не задан WEBHOOK_SECRET: без него вебхук примет апдейт от кого угодно")
+    expected = secret_token.encode()
+
+    async def handle(request: web.Request) -> web.Response:
+        received = request.headers.get(SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(received, expected):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            enqueue(data)
+        except asyncio.QueueFull:
+            logger.warning("Очередь апдейтов переполнена, просим Telegram повторить")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+async def start_server(app: "web.Application", host: str, port: int) -> "web.AppRunner":
+    from aiohttp import web
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов и пул воркеров, вызывающих process(data)."""
+
+    def __init__(self, process, maxsize: int = 1000, workers: int = 8):
+        self.process = process
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = workers
+        self._tasks = []
+
+    def put_nowait(self, data):
+        self.queue.put_nowait(data)
+
+    async def put(self, data):
+        await self.queue.put(data)
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Остановка с необработанными апдейтами: {self.queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                await self.process(data)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()